@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import contextlib
+import traceback
+import concurrent.futures
+import argparse as ap
+
+import main
+import person_tracker as pt
+import movie_maker as mm
+import bounds_track as bt
+import video_tools as vt
+import eyepop_manager as em
+import inference_cache as ic
+import inference_io as iio
+import sampling
+
+#
+# batch.py
+#
+# Runs main.py over many videos, a process pool working through them a video per job, so
+#  one video's inference overlaps another's rendering. The videos come from a directory or
+#  a manifest with one JSON object per line, the video, optionally its target jersey numbers
+#  and a results file to use instead of the inference cache:
+#
+#   {"video": "clips/game1.mp4", "targets": ["7", "9"]}
+#   {"video": "clips/game2.mp4", "results": "clips/game2.jsonl"}
+#
+#   python batch.py --manifest season.jsonl --workers 4 --analyze
+#   python batch.py --videos clips/ --targets 7 9
+#
+# With --analyze the videos without cached results are first uploaded together over the
+#  asynchronous EyePop client, --uploads at a time over a connection per worker, and their
+#  results stored in the cache before the pool renders them.
+#
+# Every video gets its own working directory under --output_dir with its reels, its log and a
+#  stamp of what they were rendered from. A video whose stamp matches its inputs and whose
+#  reels still exist is skipped, so a rerun only does the work that changed. A summary of
+#  what was done, the throughput and the failures is printed and written to summary.json.
+#
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.avi', '.mkv')
+
+# main() arguments that change how fast a video renders but not what its reels look like
+UNSTAMPED_OPTIONS = ('workers', 'threads', 'chunk_seconds', 'cache_dir', 'cache_size')
+
+STAMP_FILE = 'batch.json'
+LOG_FILE = 'log.txt'
+
+
+def normalize_targets(targets):
+    """ A sorted list of jersey number strings, None to render every player. """
+    if targets is None or targets == []:
+        return None
+    if isinstance(targets, (str, int)):
+        targets = [targets]
+    return sorted({str(target) for target in targets})
+
+
+def read_manifest(manifest_path, targets=None):
+    """ The (video, targets, results) entries of a manifest, paths relative to the manifest's folder. """
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+
+    with open(manifest_path, "r") as manifest_file:
+        for line_number, line in enumerate(manifest_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            entry = json.loads(line)
+            if 'video' not in entry:
+                raise ValueError(
+                    f"{manifest_path}:{line_number}: entry has no 'video'")
+
+            results = entry.get('results')
+            entries.append((os.path.join(base, entry['video']),
+                            normalize_targets(entry.get('targets', targets)),
+                            os.path.join(base, results) if results else None))
+
+    return entries
+
+
+def list_videos(folder, targets=None):
+    """ The (video, targets, results) entries of every video in a folder. """
+    return [(os.path.join(folder, name), normalize_targets(targets), None)
+            for name in sorted(os.listdir(folder))
+            if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS]
+
+
+def job_name(video_path):
+    """ A working directory name for a video, the file name plus a hash of its path so same-named videos don't collide. """
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    stem = ''.join(c if c.isalnum() or c in '-_' else '_' for c in stem)
+    return f"{stem}_{hashlib.sha1(video_path.encode()).hexdigest()[:8]}"
+
+
+def file_stamp(path):
+    """ [size, mtime] of a file, None when there is no file. """
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_stamp(work_dir):
+    try:
+        with open(os.path.join(work_dir, STAMP_FILE), "r") as stamp_file:
+            return json.load(stamp_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(work_dir, inputs, outputs):
+    stamp_path = os.path.join(work_dir, STAMP_FILE)
+    with open(stamp_path + '.tmp', "w") as stamp_file:
+        json.dump({'inputs': inputs, 'outputs': outputs}, stamp_file, indent=2)
+    os.replace(stamp_path + '.tmp', stamp_path)
+
+
+def is_up_to_date(work_dir, inputs):
+    """ Whether the video's reels were rendered from exactly these inputs and are all still there. """
+    stamp = read_stamp(work_dir)
+    return stamp is not None and stamp['inputs'] == inputs and all(
+        os.path.exists(os.path.join(work_dir, output)) for output in stamp['outputs'])
+
+
+def plan_jobs(entries, output_dir, options, analyze=False, force=False):
+    """
+    Turns the entries into jobs, one per video, a video listed twice rendering the targets of
+    both from the first results file given. Returns (jobs to run, records of the videos that
+    need no run): missing videos and, unless `force`, the ones already up to date.
+    """
+    videos = {}
+    for video_path, targets, results in entries:
+        video_path = os.path.abspath(video_path)
+        if video_path in videos:
+            other_targets, other_results = videos[video_path]
+            targets = None if targets is None or other_targets is None else sorted(
+                set(targets) | set(other_targets))
+            results = other_results or results
+        videos[video_path] = (targets, results)
+
+    stamped_options = {name: value for name, value in options.items()
+                       if name not in UNSTAMPED_OPTIONS}
+
+    jobs = []
+    records = []
+    for video_path, (targets, results) in videos.items():
+        name = job_name(video_path)
+        work_dir = os.path.join(output_dir, name)
+
+        if not os.path.exists(video_path):
+            records.append(new_record(name, video_path, work_dir,
+                                      status='failed', error='video not found'))
+            continue
+
+        results = os.path.abspath(results) if results else None
+        inputs = {
+            'video': video_path,
+            'video_stamp': file_stamp(video_path),
+            'results': results,
+            'results_stamp': file_stamp(results),
+            'targets': targets,
+            'options': stamped_options,
+        }
+
+        if not force and is_up_to_date(work_dir, inputs):
+            records.append(new_record(name, video_path, work_dir, status='up to date',
+                                      outputs=read_stamp(work_dir)['outputs']))
+            continue
+
+        jobs.append({'name': name, 'video': video_path, 'work_dir': work_dir, 'targets': targets,
+                     'results': results, 'inputs': inputs, 'analyze': analyze, 'options': options})
+
+    return jobs, records
+
+
+def new_record(name, video_path, work_dir, status=None, outputs=(), error=None):
+    return {'name': name, 'video': video_path, 'work_dir': work_dir, 'status': status,
+            'outputs': list(outputs), 'error': error, 'seconds': 0.0, 'video_seconds': 0.0}
+
+
+@contextlib.contextmanager
+def redirect_output(log_path):
+    """ Sends everything this process and its children print to a log file. """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+
+    with open(log_path, "a") as log_file:
+        os.dup2(log_file.fileno(), 1)
+        os.dup2(log_file.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+
+
+def is_cached(video_path, options):
+    cache = ic.InferenceCache(options['cache_dir'], max_bytes=options['cache_size'])
+    signature = em.pop_signature() + sampling.signature(
+        options['sample_every'], options['sample_motion'])
+    return os.path.exists(cache.path(video_path, signature))
+
+
+def analyze_jobs(jobs, connections=2, concurrency=4, retries=3, backoff=2.0, endpoint_factory=None, progress_callback=print):
+    """
+    Runs the inference of every job that needs it with em.analyze_videos and stores the results
+    in the inference cache. A video with the log of an interrupted run is left to its job, which
+    continues it. Returns (jobs to render, records of the videos whose inference failed).
+    """
+    uploads = []
+    for job in jobs:
+        if not job['analyze'] or job['results'] or is_cached(job['video'], job['options']):
+            continue
+
+        options = job['options']
+        cache = ic.InferenceCache(options['cache_dir'], max_bytes=options['cache_size'])
+        signature = em.pop_signature() + sampling.signature(
+            options['sample_every'], options['sample_motion'])
+
+        # two copies of a video share a cache entry, the first one is analyzed for both
+        log_path = os.path.join(cache.cache_dir, cache.key(job['video'], signature) + '.jsonl')
+        if os.path.exists(log_path) or any(upload[3] == log_path for upload in uploads):
+            continue
+
+        upload_path, remap = main.prepare_upload(job['video'], cache, signature, sample_every=options['sample_every'],
+                                                 sample_motion=options['sample_motion'])
+        uploads.append((job, cache, signature, log_path, upload_path, remap))
+
+    if not uploads:
+        return jobs, []
+
+    if progress_callback:
+        progress_callback(f"Analyzing {len(uploads)} videos, {concurrency} uploads at a time")
+
+    try:
+        outcomes = asyncio.run(em.analyze_videos(
+            [(upload_path, log_path) for _, _, _, log_path, upload_path, _ in uploads],
+            concurrency=concurrency, connections=connections, retries=retries, backoff=backoff,
+            endpoint_factory=endpoint_factory))
+    finally:
+        for job, _, _, _, upload_path, _ in uploads:
+            if upload_path != job['video']:
+                with contextlib.suppress(OSError):
+                    os.remove(upload_path)
+
+    failed = {}
+    for job, cache, signature, log_path, upload_path, remap in uploads:
+        error = outcomes.get(upload_path)
+        if error is None:
+            cache.put(job['video'], signature, remap(iio.iter_results(log_path)))
+            iio.remove_log(log_path)
+        else:
+            failed[job['video']] = new_record(job['name'], job['video'], job['work_dir'], status='failed',
+                                              error=f"inference failed: {type(error).__name__}: {error}")
+
+    return [job for job in jobs if job['video'] not in failed], list(failed.values())
+
+
+def run_job(job):
+    """
+    Analyzes and renders one video in its working directory, a process pool task. Only
+    videos without results are sent for inference, continuing a run that stopped early.
+    Returns the video's record.
+    """
+    start = time.perf_counter()
+    work_dir = job['work_dir']
+    record = new_record(job['name'], job['video'], work_dir)
+
+    os.makedirs(work_dir, exist_ok=True)
+    reel_dir = os.path.join(work_dir, 'output')
+
+    with redirect_output(os.path.join(work_dir, LOG_FILE)):
+        try:
+            reader = vt.FrameReader(job['video'])
+            if reader.frame_rate:
+                record['video_seconds'] = reader.frame_count / reader.frame_rate
+            reader.release()
+
+            analyze = job['analyze'] and not job['results'] and not is_cached(
+                job['video'], job['options'])
+
+            output_files = main.main(job['video'], job['targets'], analyze=analyze, resume=analyze,
+                                     results_path=job['results'], output_dir=reel_dir, **job['options'])
+
+            if output_files is None:
+                record['status'] = 'no results'
+                record['error'] = 'no inference results, run with --analyze' if not job['analyze'] \
+                    else 'inference stopped early, run again to continue it'
+            else:
+                record['outputs'] = sorted(os.path.relpath(output_file, work_dir)
+                                           for output_file in output_files if os.path.exists(output_file))
+                record['status'] = 'rendered' if record['outputs'] else 'no players'
+
+                # reels of an earlier run that this one didn't render again, e.g. of other targets
+                previous = read_stamp(work_dir)
+                for output in previous['outputs'] if previous else []:
+                    if output not in record['outputs']:
+                        with contextlib.suppress(OSError):
+                            os.remove(os.path.join(work_dir, output))
+
+                write_stamp(work_dir, job['inputs'], record['outputs'])
+        except Exception as e:
+            traceback.print_exc()
+            record['status'] = 'failed'
+            record['error'] = f"{type(e).__name__}: {e}"
+
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def run_batch(jobs, workers=2, progress_callback=print):
+    """ Runs the jobs across a process pool, returns their records in completion order. """
+    records = []
+    if not jobs:
+        return records
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. killed for running out of memory
+                record = new_record(job['name'], job['video'], job['work_dir'], status='failed',
+                                    error=f"{type(e).__name__}: {e}")
+            records.append(record)
+
+            if progress_callback:
+                line = f"[{len(records)}/{len(jobs)}] {record['name']}: {record['status']} in {record['seconds']:.1f}s"
+                if record['outputs']:
+                    line += f", {len(record['outputs'])} reels"
+                if record['error']:
+                    line += f" ({record['error']})"
+                progress_callback(line)
+
+    return records
+
+
+def summarize(records, wall_seconds):
+    """ Totals, throughput and failures of a batch. The throughput counts the videos that were processed, not skipped or failed. """
+    statuses = {}
+    for record in records:
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+
+    ran = [record for record in records if record['status'] in ('rendered', 'no players')]
+    video_seconds = sum(record['video_seconds'] for record in ran)
+
+    return {
+        'videos': len(records),
+        'statuses': statuses,
+        'wall_seconds': wall_seconds,
+        'job_seconds': sum(record['seconds'] for record in ran),
+        'video_seconds': video_seconds,
+        # seconds of video processed per second of wall time
+        'realtime_factor': video_seconds / wall_seconds if wall_seconds > 0 else None,
+        'videos_per_hour': len(ran) / wall_seconds * 3600 if wall_seconds > 0 else None,
+        'reels': sum(len(record['outputs']) for record in records),
+        'failures': [{'name': record['name'], 'video': record['video'], 'status': record['status'],
+                      'error': record['error'],
+                      'log': os.path.join(record['work_dir'], LOG_FILE) if record['seconds'] > 0 else None}
+                     for record in records if record['status'] in ('failed', 'no results')],
+        'jobs': sorted(records, key=lambda record: record['name']),
+    }
+
+
+def format_summary(summary):
+    lines = [f"{summary['videos']} videos: " + ', '.join(
+        f"{count} {status}" for status, count in sorted(summary['statuses'].items()))]
+
+    lines.append(f"{summary['reels']} reels, {summary['video_seconds']:.0f}s of video run in "
+                 f"{summary['wall_seconds']:.1f}s")
+    if summary['video_seconds'] > 0:
+        lines.append(f"{summary['realtime_factor']:.2f}x realtime, {summary['videos_per_hour']:.1f} videos per hour")
+
+    for failure in summary['failures']:
+        line = f"  {failure['status']}: {failure['video']}: {failure['error']}"
+        if failure['log']:
+            line += f" (see {failure['log']})"
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    args = ap.ArgumentParser(
+        description="Analyze and render the highlight reels of many videos")
+    source = args.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", type=str,
+                        help="JSON lines of {\"video\": ..., \"targets\": [...], \"results\": ...}")
+    source.add_argument("--videos", type=str,
+                        help="render every video in this folder")
+    args.add_argument("--targets", type=str, nargs='*', default=None,
+                      help="jersey numbers to render for videos without targets of their own, every player by default")
+    args.add_argument("--output_dir", type=str, default='batch',
+                      help="each video gets a working directory with its reels and log in here")
+    args.add_argument("--workers", type=int, default=2,
+                      help="videos processed at the same time")
+    args.add_argument("--render_workers", type=int, default=1,
+                      help="render processes per video, see main.py --workers")
+    args.add_argument("--analyze", action="store_true",
+                      help="send videos without cached results for inference, continuing runs that stopped early")
+    args.add_argument("--uploads", type=int, default=4,
+                      help="with --analyze, videos uploaded for inference at the same time")
+    args.add_argument("--force", action="store_true",
+                      help="render every video again, even when its reels are up to date")
+    args.add_argument("--summary", type=str, default=None,
+                      help="write the summary here, by default summary.json in --output_dir")
+    args.add_argument("--smoothing", type=str, default='.95')
+    args.add_argument("--encoder", type=str, default='pipe',
+                      choices=['pipe', 'jpeg', 'opencv'])
+    args.add_argument("--backend", type=str, default='opencv', choices=list(mm.BACKENDS))
+    args.add_argument("--threads", type=int, default=0)
+    args.add_argument("--chunk_seconds", type=float, default=None)
+    args.add_argument("--interpolation", type=str, default='linear',
+                      choices=bt.INTERPOLATIONS)
+    args.add_argument("--trace_resolution", type=str, default='recent',
+                      choices=pt.TRACE_RESOLUTIONS)
+    args.add_argument("--min_label_reads", type=int, default=pt.MIN_LABEL_READS)
+    args.add_argument("--ball_distance", type=float, default=None)
+    args.add_argument("--sample_every", type=int, default=1)
+    args.add_argument("--sample_motion", type=float, default=None)
+    args.add_argument("--cache_dir", type=str, default=ic.DEFAULT_CACHE_DIR)
+    args.add_argument("--cache_size_gb", type=float,
+                      default=ic.DEFAULT_MAX_BYTES / 1024 ** 3)
+    args = args.parse_args()
+
+    if args.manifest:
+        entries = read_manifest(args.manifest, targets=args.targets)
+    else:
+        entries = list_videos(args.videos, targets=args.targets)
+
+    options = {
+        'smoothing': args.smoothing,
+        'encoder': args.encoder,
+        'backend': args.backend,
+        'threads': args.threads,
+        'workers': args.render_workers,
+        'chunk_seconds': args.chunk_seconds,
+        'interpolation': args.interpolation,
+        'trace_resolution': args.trace_resolution,
+        'min_label_reads': args.min_label_reads,
+        'ball_distance': args.ball_distance,
+        'sample_every': args.sample_every,
+        'sample_motion': args.sample_motion,
+        # the cache is shared by every video, each entry is keyed by its video's contents
+        'cache_dir': os.path.abspath(args.cache_dir),
+        'cache_size': int(args.cache_size_gb * 1024 ** 3),
+    }
+
+    start = time.perf_counter()
+    jobs, records = plan_jobs(entries, args.output_dir, options,
+                              analyze=args.analyze, force=args.force)
+
+    if args.analyze:
+        jobs, failed = analyze_jobs(jobs, connections=args.workers, concurrency=args.uploads)
+        records += failed
+
+    print(f"{len(jobs)} of {len(jobs) + len(records)} videos to run across {args.workers} workers")
+    records += run_batch(jobs, workers=args.workers)
+
+    summary = summarize(records, time.perf_counter() - start)
+    print(format_summary(summary))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(args.summary or os.path.join(args.output_dir, 'summary.json'), "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
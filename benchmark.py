@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import argparse as ap
+
+import numpy as np
+import cv2
+
+import main
+import person_tracker as pt
+import movie_maker as mm
+import bounds_track as bt
+import video_tools as vt
+import video_writer as vw
+import inference_io as iio
+import filtergraph
+import profiling
+
+#
+# benchmark.py
+#
+# Times every stage of the pipeline on a synthetic video and synthetic EyePop results, so
+#  no real footage or paid inference run is needed. Stages are collected with profiling, the
+#  ones the pipeline records itself plus the box lookups timed here. With --parity the reel is
+#  also rendered by the ffmpeg backend and compared with the OpenCV render. Results are written as
+#  JSON, one file per run, so runs can be compared across commits:
+#
+#   python benchmark.py --width 1920 --height 1080 --seconds 30 --players 10 --output bench.json
+#
+
+
+def make_tracks(players, seconds, fps, width, height, seed=0):
+    """
+    Returns (labels, boxes) for `players` players wandering around the field: their jersey
+    numbers and a (frames x players x 4) array of [x, y, w, h] boxes, one row per frame.
+    """
+    rng = np.random.default_rng(seed)
+    frames = int(seconds * fps)
+
+    labels = [str(label) for label in rng.choice(
+        np.arange(1, 100), size=players, replace=False)]
+
+    sizes = rng.uniform(0.12, 0.3, size=players) * height
+    box_w = np.broadcast_to(sizes * 0.4, (frames, players))
+    box_h = np.broadcast_to(sizes, (frames, players))
+
+    # smooth random walks, reflected at the edges of the field
+    velocity = np.cumsum(rng.normal(0, 0.3, size=(frames, players, 2)), axis=0)
+    velocity = np.clip(velocity, -8, 8) * (width / 1280)
+    start = rng.uniform(0, 1, size=(players, 2)) * (width, height)
+    position = start + np.cumsum(velocity, axis=0)
+
+    span_x = width - box_w
+    span_y = height - box_h
+    x = np.abs((position[:, :, 0] + span_x) % (2 * span_x) - span_x)
+    y = np.abs((position[:, :, 1] + span_y) % (2 * span_y) - span_y)
+
+    return labels, np.stack([x, y, box_w, box_h], axis=2)
+
+
+def make_video(video_path, boxes, fps, width, height):
+    """ Writes a synthetic video of textured players moving over a pitch, one frame per row of `boxes`. """
+    rng = np.random.default_rng(1)
+
+    # a textured pitch so the encoder and blur have real work to do
+    pitch = cv2.resize(rng.integers(40, 120, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8),
+                       (width, height), interpolation=cv2.INTER_CUBIC)
+    pitch[:, :, 1] = np.maximum(pitch[:, :, 1], 110)
+
+    colors = rng.integers(0, 255, size=(boxes.shape[1], 3)).tolist()
+
+    with vw.open_writer('opencv', video_path, fps) as writer:
+        for frame_boxes in boxes:
+            frame = pitch.copy()
+            for (x, y, w, h), color in zip(frame_boxes.astype(int), colors):
+                cv2.rectangle(frame, (x, y), (x + w, y + h), color, -1)
+            writer.write(frame)
+
+
+def make_results(labels, boxes, fps, width, height, label_rate=0.1, label_noise=0.05, trace_switch=0.001, seed=2):
+    """
+    Yields EyePop-shaped results for the synthetic tracks, one per frame.
+
+    Each person carries a trace id, and with `label_rate` probability a jersey number read by
+    OCR, which is a wrong number with `label_noise` probability. With `trace_switch`
+    probability per frame, two players swap trace ids, as the tracker does when players cross.
+    The ball is at the feet of a different player every few seconds.
+    """
+    rng = np.random.default_rng(seed)
+    players = len(labels)
+    trace_ids = list(range(players))
+    next_trace_id = players
+
+    for frame, frame_boxes in enumerate(boxes):
+
+        if players > 1 and rng.random() < trace_switch:
+            a, b = rng.choice(players, size=2, replace=False)
+            trace_ids[a], trace_ids[b] = trace_ids[b], trace_ids[a]
+
+        # now and then a trace is lost and the player picks up a new one
+        if rng.random() < trace_switch:
+            trace_ids[rng.integers(players)] = next_trace_id
+            next_trace_id += 1
+
+        objects = []
+        for player, (x, y, w, h) in enumerate(frame_boxes.tolist()):
+            obj = {'classLabel': 'person', 'confidence': 0.9, 'traceId': trace_ids[player],
+                   'x': x, 'y': y, 'width': w, 'height': h}
+
+            if rng.random() < label_rate:
+                label = labels[player]
+                if rng.random() < label_noise:
+                    label = str(rng.integers(1, 100))
+                obj['objects'] = [{'classLabel': 'text', 'labels': [
+                    {'label': label}]}]
+
+            objects.append(obj)
+
+        x, y, w, h = frame_boxes[(frame // int(fps * 3)) % players]
+        objects.append({'classLabel': 'sports ball', 'confidence': 0.8,
+                        'x': x + w / 2 - 10, 'y': y + h - 20, 'width': 20, 'height': 20})
+
+        yield {'seconds': frame / fps, 'source_width': width, 'source_height': height, 'objects': objects}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    profiling.enable()
+    profiling.reset()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    video_path = os.path.join(
+        args.work_dir, f"synthetic_{args.width}x{args.height}_{args.seconds}s.mp4")
+    results_path = os.path.join(args.work_dir, 'data.jsonl')
+    output_path = os.path.join(args.work_dir, 'output.mp4')
+
+    #
+    #  0. synthetic inputs, not timed as part of the pipeline
+    #
+    labels, boxes = make_tracks(
+        args.players, args.seconds, args.fps, args.width, args.height)
+
+    if not os.path.exists(video_path):
+        make_video(video_path, boxes, args.fps, args.width, args.height)
+
+    with iio.ResultWriter(results_path) as writer:
+        writer.write_many(make_results(labels, boxes, args.fps, args.width, args.height, label_rate=args.label_rate,
+                                       label_noise=args.label_noise, trace_switch=args.trace_switch))
+
+    #
+    #  1. ingestion and tracking
+    #
+    person_tracker = pt.PersonTracker(
+        smoothing=args.smoothing, ball_distance=args.ball_distance, min_label_reads=args.min_label_reads)
+
+    main.ingest_results(iio.iter_results(results_path), person_tracker)
+
+    detections = sum(len(person)
+                     for person in person_tracker.people.values())
+
+    person_tracker.filter_map(args.width, args.height, threshold=2)
+
+    # the player with the most detections is rendered
+    person = max(person_tracker.people.values(), key=len)
+
+    #
+    #  2. box lookups, once per output frame through get_bounds_at_time and as one resample, and the render plan
+    #
+    reader = vt.FrameReader(video_path)
+    frame_times = reader.segment_frames(person.time_segments)
+    times = [t for t, _ in frame_times]
+
+    start = time.perf_counter()
+    for t in times:
+        mm.get_bounds_at_time(person.track, t, interpolation=args.interpolation)
+    profiling.add('get_bounds_at_time', time.perf_counter() - start, len(times))
+
+    start = time.perf_counter()
+    frame_boxes = bt.as_track(person.track).resample(
+        times, interpolation=args.interpolation)
+    profiling.add('resample', time.perf_counter() - start, len(times))
+
+    with profiling.stage('plan', count=len(times)):
+        plan = mm.get_render_plan(
+            (reader.width, reader.height), (720, 600), frame_boxes)
+
+    #
+    #  3. decode, composite and encode the player's reel
+    #
+
+    writer = vw.open_writer(args.encoder, output_path, reader.frame_rate)
+
+    with reader:
+        try:
+            for frame, users in reader.shared_frames({'reel': frame_times}):
+                for _, k, _ in users:
+                    with profiling.stage('composite'):
+                        output = mm.compose_frame(frame, plan, k)
+
+                    with profiling.stage('encode'):
+                        writer.write(output)
+        except BaseException:
+            writer.abort()
+            raise
+
+    # the pipe writer encodes in the background, what is left is recorded as ffmpeg on close
+    writer.close()
+
+    #
+    #  4. optionally the same reel with the ffmpeg backend, compared against the OpenCV render
+    #
+    parity = None
+    if args.parity:
+        ffmpeg_output_path = os.path.join(args.work_dir, 'output_ffmpeg.mp4')
+        mm.render_with_ffmpeg(video_path, ffmpeg_output_path,
+                              frame_times, plan, reader.frame_rate)
+
+        mean_psnr, min_psnr, frames = filtergraph.video_psnr(
+            output_path, ffmpeg_output_path)
+        parity = {'mean_psnr': mean_psnr, 'min_psnr': min_psnr, 'frames': frames}
+
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'config': vars(args),
+        'players_tracked': len(person_tracker.people),
+        'detections': detections,
+        'parity': parity,
+        **profiling.report(),
+    }
+
+
+if __name__ == "__main__":
+    args = ap.ArgumentParser(
+        description="Time each pipeline stage on a synthetic video and synthetic EyePop results")
+    args.add_argument("--width", type=int, default=1920)
+    args.add_argument("--height", type=int, default=1080)
+    args.add_argument("--seconds", type=float, default=20)
+    args.add_argument("--fps", type=float, default=30)
+    args.add_argument("--players", type=int, default=10)
+    args.add_argument("--label_rate", type=float, default=0.1,
+                      help="probability a person's jersey number is read in a frame")
+    args.add_argument("--label_noise", type=float, default=0.05,
+                      help="probability a read jersey number is wrong")
+    args.add_argument("--trace_switch", type=float, default=0.001,
+                      help="probability per frame that two players swap trace ids")
+    args.add_argument("--smoothing", type=str, default='.95')
+    args.add_argument("--ball_distance", type=float, default=None)
+    args.add_argument("--min_label_reads", type=int, default=pt.MIN_LABEL_READS)
+    args.add_argument("--interpolation", type=str, default='linear',
+                      choices=bt.INTERPOLATIONS)
+    args.add_argument("--encoder", type=str, default='pipe',
+                      choices=list(vw.WRITERS))
+    args.add_argument("--parity", action="store_true",
+                      help="also render the reel with the ffmpeg backend and report its PSNR against the OpenCV render")
+    args.add_argument("--work_dir", type=str,
+                      default=os.path.join('.cache', 'benchmark'))
+    args.add_argument("--output", type=str, default=None,
+                      help="write the report here instead of stdout")
+    args = args.parse_args()
+
+    report = run(args)
+
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
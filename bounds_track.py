@@ -0,0 +1,85 @@
+import numpy as np
+
+#
+# bounds_track.py
+#
+# A player's bounding boxes over time, stored as sorted NumPy arrays so a lookup is a
+#  binary search instead of a scan over every detection.
+#
+
+INTERPOLATIONS = ('linear', 'hold', 'nearest')
+
+
+class BoundsTrack:
+    """
+    Time-indexed [x, y, w, h] boxes.
+
+    `interpolation` decides the box between two detections:
+        linear  - blend the two neighbouring detections, smooth motion between them
+        hold    - keep the most recent detection until the next one arrives
+        nearest - snap to the closest detection, the original get_bounds_at_time behaviour
+    Times before the first or after the last detection clamp to that detection.
+    """
+
+    def __init__(self, times, boxes):
+        times = np.asarray(times, dtype=np.float64)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.boxes = boxes[order]
+
+    @classmethod
+    def from_dict(cls, time_bounds):
+        """ Builds a track from the {seconds: [x, y, w, h]} dicts PersonTracker used to keep. """
+        return cls(list(time_bounds.keys()), list(time_bounds.values()))
+
+    def __len__(self):
+        return len(self.times)
+
+    def resample(self, times, interpolation='linear'):
+        """ Returns an N x 4 array with the box at each of `times`, in one vectorized pass. """
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(
+                f"Unknown interpolation '{interpolation}', expected one of {', '.join(INTERPOLATIONS)}")
+
+        times = np.asarray(times, dtype=np.float64)
+        if len(self.times) == 0:
+            if len(times) == 0:
+                return np.empty((0, 4))
+            raise ValueError("Can't look up boxes in a track without detections")
+
+        last = len(self.times) - 1
+
+        # index of the detection at or before each time, and the one after it
+        after = np.searchsorted(self.times, times, side='right')
+        before = np.clip(after - 1, 0, last)
+        after = np.clip(after, 0, last)
+
+        t0 = self.times[before]
+        t1 = self.times[after]
+
+        if interpolation == 'hold':
+            # times before the first detection clamp forward to it
+            return self.boxes[np.where(times < t0, after, before)]
+
+        if interpolation == 'nearest':
+            return self.boxes[np.where(times - t0 <= t1 - times, before, after)]
+
+        span = t1 - t0
+        fraction = np.divide(times - t0, span,
+                             out=np.zeros_like(span), where=span > 0)
+        fraction = np.clip(fraction, 0.0, 1.0)[:, None]
+
+        return self.boxes[before] * (1.0 - fraction) + self.boxes[after] * fraction
+
+    def at(self, t, interpolation='linear'):
+        """ Returns the box at time `t`. """
+        return self.resample([t], interpolation=interpolation)[0]
+
+
+def as_track(bounds):
+    """ Accepts a BoundsTrack or a {seconds: [x, y, w, h]} dict and returns a BoundsTrack. """
+    if isinstance(bounds, BoundsTrack):
+        return bounds
+    return BoundsTrack.from_dict(bounds)
@@ -2,141 +2,377 @@ from eyepop import EyePopSdk
 
 import os
 import asyncio
+import concurrent.futures
+import contextlib
+import itertools
 import logging
 import time
 import json
 import aiofiles
 
+import inference_io as iio
+import sampling
+import profiling
 
-def get_inference_data(location, pop_id, timeout=None):
+
+# EYEPOP_URL = 'https://staging-api.eyepop.ai'
+EYEPOP_URL = 'https://api.eyepop.ai'
+
+# manifests added to the endpoint's own manifest
+MANIFEST_ADDITIONS = [
+    # manifest for PARSeq
+    {
+        "authority": "PARSeq",
+        "manifest": "https://s3.amazonaws.com/models.eyepop.ai/releases/PARSeq/1.0.2/manifest.json",
+    },
+    # manifest for eyepop-text
+    {
+        "authority": "eyepop-text",
+        "manifest": "https://s3.amazonaws.com/models.eyepop.ai/releases/eptext/1.0.3/manifest.json",
+    },
+]
+
+# models loaded before the pop composition is set
+MODEL_DEFINITIONS = [
+    # PARSeq model
+    {
+        'model_id': 'PARSeq:PARSeq',
+        'dataset': 'TextDataset',
+        'format': 'TorchScriptCuda',
+        'type': 'float32'
+    },
+    # eyepop-text model
+    {
+        'model_id': 'eyepop-text:EPTextB1',
+        'dataset': 'Text',
+        'format': 'TorchScriptCuda',
+        'type': 'float32'
+    },
+]
+
+POP_COMP = """
+                ep_infer id=1
+                model=eyepop-person:EPPersonB1_Person_TorchScriptCuda_float32 threshold=0.8
+                ! ep_infer id=2
+                tracing=deepsort
+                model=legacy:reid-mobilenetv2_x1_4_ImageNet_TensorFlowLite_int8
+                secondary-to-id=1
+                secondary-for-class-ids=<0>
+                ! ep_infer id=3  category-name="text"
+                model=eyepop-text:EPTextB1_Text_TorchScriptCuda_float32 threshold=0.6
+                secondary-to-id=1
+                secondary-for-class-ids=<0>
+                ! ep_infer id=4 category-name="text"
+                secondary-to-id=3
+                model=PARSeq:PARSeq_TextDataset_TorchScriptCuda_float32 threshold=0.1
+                ! ep_infer id=5 category-name="sports equipment"
+                model=eyepop-sports:EPSportsB1_Sports_TorchScriptCuda_float32 threshold=0.55
+            """
+
+
+def pop_signature():
     """
-    Perform inference on the given video using the EyePop SDK.
+    A string describing everything about the pop that shapes its results: the added manifests,
+    the loaded models and the pop composition. Results are only reusable for the same signature.
+    """
+    return json.dumps({
+        'manifest': MANIFEST_ADDITIONS,
+        'models': MODEL_DEFINITIONS,
+        # whitespace in the composition does not change the pop
+        'pop_comp': ' '.join(POP_COMP.split()),
+    }, sort_keys=True)
+
+
+def configure_pop(endpoint):
+    """ Sets up the manifests, models and pop composition on a synchronous endpoint. """
+    manifest = endpoint.get_manifest()
+    manifest.extend(MANIFEST_ADDITIONS)
+    endpoint.set_manifest(manifest)
+
+    for model_definition in MODEL_DEFINITIONS:
+        endpoint.load_model(model_definition)
+
+    endpoint.set_pop_comp(POP_COMP)
+
+
+def read_credentials():
+    """ Returns the (pop id, secret key) pair from the eyepop_id.env and eyepop_secret.env files. """
+    try:
+        EYEPOP_POP_ID = open("eyepop_id.env", "r").read()
+        EYEPOP_SECRET_KEY = open("eyepop_secret.env", "r").read()
+    except OSError:
+        print("Error reading EyePop credentials, ensure the eyepop_id.env and eyepop_secret.env files are present in the root directory.")
+        exit()
+
+    return EYEPOP_POP_ID, EYEPOP_SECRET_KEY
+
+
+def open_endpoint(is_async=False):
+    """ Opens an EyePop endpoint with the credentials from the .env files. """
+    EYEPOP_POP_ID, EYEPOP_SECRET_KEY = read_credentials()
+    return EyePopSdk.endpoint(pop_id=EYEPOP_POP_ID, secret_key=EYEPOP_SECRET_KEY, eyepop_url=EYEPOP_URL, is_async=is_async)
+
+
+def iter_inference(location, timeout=None, output_path=None, resume=False):
+    """
+    Perform inference on the given video using the EyePop SDK, yielding each result as soon
+    as it arrives so callers can work on the video while inference is still running.
 
     Args:
         location (str): The location of the video to perform inference on.
         timeout (int, optional): The maximum seconds of prediction data. Defaults to None, which means process all frames data.
+        output_path (str, optional): Where the results are also written, one compact JSON result per line, with checkpoints.
+        resume (bool, optional): Continue the interrupted run logged at `output_path`. The results
+            up to its last checkpoint are yielded from the log, and only the rest of the video is uploaded.
+
+    Yields:
+        dict: Every non-empty frame result, in the order the pop returns them.
+    """
+    checkpoint = iio.read_checkpoint(
+        output_path) if resume and output_path else None
+    start_seconds = checkpoint['seconds'] if checkpoint else None
+
+    if checkpoint is not None:
+        print(f"Resuming inference after {checkpoint['count']} results, at {start_seconds} seconds")
+
+        # the run finished, only the packing into the cache was cut short
+        if checkpoint['complete']:
+            yield from iio.iter_results(output_path)
+            return
+
+    with contextlib.ExitStack() as stack:
+        data_file = stack.enter_context(
+            iio.ResultWriter(output_path, resume=resume)) if output_path else None
+
+        # the results already on disk come first, then the pop picks up from the next frame
+        remap = None
+        if start_seconds is not None:
+            logged = iio.iter_results(output_path)
+            yield from itertools.islice(logged, data_file.count)
+            logged.close()
+
+            if timeout is not None and start_seconds > timeout:
+                return
+
+            upload_path = output_path + '.resume.mp4'
+            times, frame_rate, _ = sampling.write_sampled_video(
+                location, upload_path, every=1, start_seconds=start_seconds)
+
+            @stack.callback
+            def remove_upload():
+                if os.path.exists(upload_path):
+                    os.remove(upload_path)
+
+            # nothing left after the checkpoint
+            if len(times) == 0:
+                return
+
+            location = upload_path
+            remap = lambda results: sampling.remap_results(results, times, frame_rate)
+
+        endpoint = stack.enter_context(open_endpoint(is_async=False))
+        configure_pop(endpoint)
+
+        # Upload video for inference
+        job = endpoint.upload(location)
 
-    Raises:
-        Exception: If an error occurs during the inference process.
+        def predictions():
+            while True:
+                with profiling.stage('inference'):
+                    result = job.predict()
+                if not result:
+                    return
+                yield result
+
+        results = predictions()
+        for result in (remap(results) if remap else results):
+
+            # skip any empty results
+            if 'seconds' not in result:
+                continue
+
+            # write the result to the results file as soon as it arrives
+            if data_file is not None:
+                data_file.write(result)
+
+            #  stop job if timeout is reached
+            if timeout is not None and result['seconds'] > timeout:
+                job.cancel()
+
+            yield result
+
+
+def get_inference_data(location, pop_id=None, timeout=None, output_path="data.jsonl", resume=False):
+    """
+    Perform inference on the given video using the EyePop SDK.
+
+    Args:
+        location (str): The location of the video to perform inference on.
+        timeout (int, optional): The maximum seconds of prediction data. Defaults to None, which means process all frames data.
+        output_path (str, optional): Where the results are written, one compact JSON result per line, with checkpoints.
+        resume (bool, optional): Continue the interrupted run logged at `output_path`.
 
     Returns:
-        None
+        bool: True if the inference ran to the end, False if it stopped on an error. The
+            results up to the error stay in the log, and a run with `resume` continues from them.
     """
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('eyepop').setLevel(level=logging.DEBUG)
 
-    # EyePop SDK configuration
-    EYEPOP_POP_ID = ""
-    EYEPOP_SECRET_KEY = ""
-
     try:
-        EYEPOP_POP_ID = open("eyepop_id.env", "r").read()
-        EYEPOP_SECRET_KEY = open("eyepop_secret.env", "r").read()
-    except (e):
-        print("Error reading EyePop credentials, ensure the eyepop_id.env and eyepop_secret.env files are present in the root directory.")
-        exit()
+        for result in iter_inference(location, timeout=timeout, output_path=output_path, resume=resume):
+            print(result['seconds'])
 
-    # EYEPOP_URL = 'https://staging-api.eyepop.ai'
-    EYEPOP_URL = 'https://api.eyepop.ai'
+    except Exception as e:
+        print('\n\n\n\n\n\n\n\n')
+        print(e)
+        print('\n\n\n\n\n\n\n\n')
+        return False
 
-    with EyePopSdk.endpoint(pop_id=EYEPOP_POP_ID, secret_key=EYEPOP_SECRET_KEY, eyepop_url=EYEPOP_URL, is_async=False) as endpoint:
+    return True
 
-        manifest = endpoint.get_manifest()
 
-        # set manifest for PARSeq
-        manifest.append(
-            {
-                "authority": "PARSeq",
-                "manifest": "https://s3.amazonaws.com/models.eyepop.ai/releases/PARSeq/1.0.2/manifest.json",
-            }
-        )
+#
+# Asynchronous, concurrent inference over many videos
+#
 
-        # set manifest for eyepop-text
-        manifest.append(
-            {
-                "authority": "eyepop-text",
-                "manifest": "https://s3.amazonaws.com/models.eyepop.ai/releases/eptext/1.0.3/manifest.json",
-            }
-        )
 
-        endpoint.set_manifest(manifest)
+async def configure_pop_async(endpoint):
+    """ Sets up the manifests, models and pop composition on an asynchronous endpoint. """
+    manifest = await endpoint.get_manifest()
+    manifest.extend(MANIFEST_ADDITIONS)
+    await endpoint.set_manifest(manifest)
 
-        # load PARSeq model
-        inner_model_def = {
-            'model_id': 'PARSeq:PARSeq',
-            'dataset': 'TextDataset',
-            'format': 'TorchScriptCuda',
-            'type': 'float32'
-        }
+    for model_definition in MODEL_DEFINITIONS:
+        await endpoint.load_model(model_definition)
 
-        endpoint.load_model(inner_model_def)
+    await endpoint.set_pop_comp(POP_COMP)
 
-        # load eyepop-text model
-        inner_model_def = {
-            'model_id': 'eyepop-text:EPTextB1',
-            'dataset': 'Text',
-            'format': 'TorchScriptCuda',
-            'type': 'float32'
-        }
 
-        endpoint.load_model(inner_model_def)
+async def _infer_to_file(endpoint, location, output_path, executor, timeout=None, batch_size=64):
+    """
+    Runs one upload on the endpoint and writes its results to `output_path`. Results are written
+    in batches on `executor`, a single thread per job, so the event loop never blocks on disk.
+    """
+    loop = asyncio.get_running_loop()
+    writer = await loop.run_in_executor(executor, iio.ResultWriter, output_path)
 
-        endpoint.set_pop_comp(
-            """
-                ep_infer id=1
-                model=eyepop-person:EPPersonB1_Person_TorchScriptCuda_float32 threshold=0.8
-                ! ep_infer id=2
-                tracing=deepsort
-                model=legacy:reid-mobilenetv2_x1_4_ImageNet_TensorFlowLite_int8
-                secondary-to-id=1
-                secondary-for-class-ids=<0>
-                ! ep_infer id=3  category-name="text"
-                model=eyepop-text:EPTextB1_Text_TorchScriptCuda_float32 threshold=0.6
-                secondary-to-id=1
-                secondary-for-class-ids=<0>
-                ! ep_infer id=4 category-name="text"
-                secondary-to-id=3
-                model=PARSeq:PARSeq_TextDataset_TorchScriptCuda_float32 threshold=0.1
-                ! ep_infer id=5 category-name="sports equipment"
-                model=eyepop-sports:EPSportsB1_Sports_TorchScriptCuda_float32 threshold=0.55
-            """
-        )
+    job = None
+    try:
+        job = await endpoint.upload(location)
 
-        with open("data.json", "w") as data_file:
+        batch = []
+        while result := await job.predict():
 
-            try:
-                # Upload video for inference
-                job = endpoint.upload(location)
+            # skip any empty results
+            if 'seconds' not in result:
+                continue
 
-                data_file.write("[")
+            batch.append(result)
+            if len(batch) >= batch_size:
+                await loop.run_in_executor(executor, writer.write_many, batch)
+                batch = []
 
-                while result := job.predict():
+            #  stop job if timeout is reached
+            if timeout is not None and result['seconds'] > timeout:
+                await job.cancel()
 
-                    # skip any empty results
-                    if 'seconds' not in result:
-                        continue
+        if batch:
+            await loop.run_in_executor(executor, writer.write_many, batch)
+    except BaseException:
+        # stop the failed job on the pop before it is retried, so the two don't run side by side
+        if job is not None:
+            with contextlib.suppress(Exception):
+                await job.cancel()
+        await loop.run_in_executor(executor, writer.close, False)
+        raise
 
-                    # write the result to the data.json file
-                    data_file.write(json.dumps(
-                        result, indent=4, sort_keys=True))
+    await loop.run_in_executor(executor, writer.close)
 
-                    data_file.write(",")
 
-                    #  stop job if timeout is reached
-                    if timeout is not None and result['seconds'] > timeout:
-                        job.cancel()
+async def analyze_videos(jobs, concurrency=4, connections=1, retries=3, backoff=2.0, timeout=None, endpoint_factory=None):
+    """
+    Runs inference on many videos concurrently.
 
-                    print(result['seconds'])
+    Args:
+        jobs (list): (location, output_path) pairs, each video's results go to its output path.
+        concurrency (int): The maximum number of uploads in flight at once.
+        connections (int): The number of endpoints opened, each configured with the pop once and
+            shared by concurrency / connections uploads.
+        retries (int): How many times a failed upload, or a failed connection setup, is retried,
+            waiting backoff * 2^attempt seconds in between.
+        timeout (int, optional): The maximum seconds of prediction data per video.
+        endpoint_factory (callable, optional): Returns an async endpoint context manager. Defaults to
+            the EyePop endpoint.
 
-                # remove the last comma
-                data_file.seek(data_file.tell() - 1, os.SEEK_SET)
-                data_file.truncate()
-                data_file.write("]")
+    Returns:
+        dict: location -> None on success, or the exception of the last failed attempt. Videos
+            left over when every connection failed get the last connection error.
+    """
+    endpoint_factory = endpoint_factory or (
+        lambda: open_endpoint(is_async=True))
+
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    outcomes = {}
+
+    async def run_uploads(endpoint):
+        # one thread per upload keeps each file's writes in order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                try:
+                    location, output_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                for attempt in range(retries + 1):
+                    try:
+                        await _infer_to_file(endpoint, location, output_path, executor, timeout=timeout)
+                        outcomes[location] = None
+                        break
+                    except Exception as e:
+                        outcomes[location] = e
+                        logging.warning(
+                            f"Inference of {location} failed on attempt {attempt + 1}: {e}")
+                        if attempt < retries:
+                            await asyncio.sleep(backoff * 2 ** attempt)
+
+                # don't leave a partial result file behind for a video that never finished
+                if outcomes[location] is not None:
+                    iio.remove_log(output_path)
 
-                data_file.close()
+    connection_errors = []
 
+    async def run_connection(uploads):
+        # opening and configuring the endpoint is retried like an upload; the uploads themselves
+        #  record their own failures, so whatever reaches here is the connection's
+        for attempt in range(retries + 1):
+            try:
+                async with endpoint_factory() as endpoint:
+                    await configure_pop_async(endpoint)
+                    await asyncio.gather(*(run_uploads(endpoint) for _ in range(uploads)))
+                return
             except Exception as e:
-                print('\n\n\n\n\n\n\n\n')
-                print(e)
-                print('\n\n\n\n\n\n\n\n')
-                data_file.close()
+                logging.warning(f"Connection failed on attempt {attempt + 1}: {e}")
+                if attempt < retries:
+                    await asyncio.sleep(backoff * 2 ** attempt)
+                else:
+                    connection_errors.append(e)
+
+    connections = max(1, min(connections, concurrency, len(jobs)))
+    concurrency = max(connections, min(concurrency, len(jobs)))
+
+    # spread the upload slots over the connections as evenly as possible. A connection that
+    #  gives up leaves its jobs in the queue for the others, so one bad connection never aborts the batch
+    await asyncio.gather(*(run_connection(concurrency // connections + (c < concurrency % connections))
+                           for c in range(connections)))
+
+    # every connection gave up before the queue ran dry
+    while not queue.empty():
+        location, _ = queue.get_nowait()
+        outcomes[location] = connection_errors[-1]
+
+    return outcomes
+
@@ -0,0 +1,195 @@
+import os
+import subprocess
+
+import numpy as np
+import cv2
+
+import profiling
+
+#
+# filtergraph.py
+#
+# The ffmpeg render backend. Instead of decoding, compositing and encoding every output frame
+#  in Python, a player's output frames and their layouts are compiled into one ffmpeg filter
+#  graph, so the whole render runs inside ffmpeg:
+#
+#   select        the source frames of the player's segments, by frame index from a seek to the first
+#   overlay       the indicator sprite, scaled and moved per frame
+#   scale, crop   the square region around the player, zoomed and moved per frame
+#   avgblur       the blurred background, the same crop, scale and box blur as get_background_plan
+#   overlay       the region over the background, then encoded
+#
+# The per-frame sizes and positions are compiled into expressions of the frame number. The
+#  layouts come from movie_maker's RenderPlan, so both backends place everything in the
+#  same spot.
+#
+
+
+class FilterGraphError(Exception):
+    pass
+
+
+def select_expression(frame_indices):
+    """ A select expression passing the given sorted source frame indices, one between() per run. """
+    runs = []
+    for frame_index in frame_indices:
+        if runs and frame_index == runs[-1][1] + 1:
+            runs[-1][1] = frame_index
+        else:
+            runs.append([frame_index, frame_index])
+
+    return '+'.join(f"between(n\\,{first}\\,{last})" for first, last in runs)
+
+
+def frame_expression(values):
+    """
+    An ffmpeg expression of the frame number `n` that gives values[n]: a balanced tree of
+    if(lt(n,k),...) over the runs of equal values, so evaluating it is a binary search.
+    """
+    runs = []
+    for n, value in enumerate(values):
+        if not runs or runs[-1][1] != value:
+            runs.append((n, value))
+
+    def build(first, last):
+        if last - first == 1:
+            return str(runs[first][1])
+        middle = (first + last) // 2
+        return f"if(lt(n,{runs[middle][0]}),{build(first, middle)},{build(middle, last)})"
+
+    return build(0, len(runs))
+
+
+def frame_geometry(roi, sprite, frame_size, dst_rect):
+    """
+    Per output frame sizes and positions of the sprite and the region, as lists by name,
+    from the N x 4 [x, y, w, h] roi and sprite rows of a RenderPlan.
+
+    ffmpeg can't change a crop's size mid-stream, so the region is zoomed instead: the whole
+    frame is scaled so the region comes out at the output size, then a fixed size crop
+    picks it out.
+    """
+    width, height = frame_size
+    size = dst_rect['w']
+
+    zoom = size / roi[:, 2]
+    zoom_w = np.round(width * zoom).astype(np.int64)
+    zoom_h = np.round(height * zoom).astype(np.int64)
+
+    geometry = {
+        'sprite_w': sprite[:, 2],
+        'sprite_h': sprite[:, 3],
+        'sprite_x': sprite[:, 0],
+        'sprite_y': sprite[:, 1],
+        'zoom_w': zoom_w,
+        'zoom_h': zoom_h,
+        'roi_x': np.minimum(np.round(roi[:, 0] * zoom).astype(np.int64), zoom_w - size),
+        'roi_y': np.minimum(np.round(roi[:, 1] * zoom).astype(np.int64), zoom_h - size),
+    }
+    return {name: values.tolist() for name, values in geometry.items()}
+
+
+def filter_graph(frame_indices, roi, sprite, frame_rate, frame_size, background, dst_rect):
+    """
+    The filter graph rendering the selected frames. `background` is the plan from
+    movie_maker.get_background_plan, `roi` and `sprite` the selected frames' rows of a RenderPlan. Every filter that moves or resizes per frame gets its
+    values from an expression of its own frame number, which after select and setpts is the
+    output frame number, so no value can land on the wrong frame.
+    """
+    (rows, cols), scaled_size, kernel, output_slice = background
+    output_rows, output_cols = output_slice
+
+    expressions = {name: frame_expression(values) for name, values in frame_geometry(
+        roi, sprite, frame_size, dst_rect).items()}
+
+    return ';'.join([
+        f"[0:v]select='{select_expression(frame_indices)}',setpts=N/{frame_rate}/TB[source]",
+        f"[1:v]format=rgba,scale=w='{expressions['sprite_w']}':h='{expressions['sprite_h']}':eval=frame[sprite]",
+        f"[source][sprite]overlay=x='{expressions['sprite_x']}':y='{expressions['sprite_y']}':eval=frame:shortest=1,"
+        "split[marked][behind]",
+        f"[behind]crop={cols.stop - cols.start}:{rows.stop - rows.start}:{cols.start}:{rows.start},"
+        f"scale={scaled_size[0]}:{scaled_size[1]},"
+        f"avgblur=sizeX={max(1, kernel[0] // 2)}:sizeY={max(1, kernel[1] // 2)},"
+        f"crop={output_cols.stop - output_cols.start}:{output_rows.stop - output_rows.start}:"
+        f"{output_cols.start}:{output_rows.start}[background]",
+        f"[marked]scale=w='{expressions['zoom_w']}':h='{expressions['zoom_h']}':eval=frame,"
+        f"crop=w={dst_rect['w']}:h={dst_rect['h']}:x='{expressions['roi_x']}':y='{expressions['roi_y']}':exact=1[roi]",
+        f"[background][roi]overlay=x={dst_rect['x']}:y={dst_rect['y']},format=yuv420p[output]",
+    ])
+
+
+def render(video_path, output_path, frame_indices, roi, sprite, frame_rate, frame_size, background, dst_rect, sprite_path, codec="libx264"):
+    """
+    Renders one player's output frames with a single ffmpeg run. `frame_indices` are the
+    source frames in output order and `roi` and `sprite` their N x 4 [x, y, w, h] rows of a
+    movie_maker.RenderPlan. Only the frames from the first selected one on are decoded, so
+    the parts of a long video each cost their own length, not the length up to them.
+    """
+    # decode from the first selected frame instead of the start of the video: the input seek lands
+    #  a quarter frame before it (some demuxers round a half-frame tie down), and accurate seeking
+    #  drops every frame before that, so frame n of the stream is source frame first + n and the
+    #  select indices are rebased by first
+    first = frame_indices[0]
+    seek = ["-ss", str((first - 0.25) / frame_rate)] if first > 0 else []
+    frame_indices = [frame_index - first for frame_index in frame_indices]
+
+    # the graph grows with the number of frames, so it is passed in a file rather than on the command line
+    graph_path = output_path + '.graph'
+    with open(graph_path, "w") as graph_file:
+        graph_file.write(filter_graph(frame_indices, roi, sprite, frame_rate, frame_size, background, dst_rect))
+
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        *seek,
+        # nothing after the last selected frame needs decoding
+        "-t", str((frame_indices[-1] + 1.5) / frame_rate),
+        "-i", video_path,
+        "-loop", "1",
+        "-framerate", str(frame_rate),
+        "-i", sprite_path,
+        "-filter_complex_script", graph_path,
+        "-map", "[output]",
+        "-frames:v", str(len(frame_indices)),
+        "-r", str(frame_rate),
+        "-c:v", codec,
+        "-pix_fmt", "yuv420p",
+        output_path,
+        '-y'
+    ]
+
+    try:
+        with profiling.stage('filtergraph', count=len(frame_indices)):
+            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
+    finally:
+        os.remove(graph_path)
+
+    if result.returncode != 0:
+        raise FilterGraphError(
+            f"ffmpeg failed rendering {output_path} (exit code {result.returncode}): {result.stderr.strip()}")
+
+
+def video_psnr(reference_path, candidate_path):
+    """
+    Compares two renders frame by frame, for checking the ffmpeg backend against the OpenCV one.
+    Returns (mean PSNR, min PSNR in dB, frames compared), PSNRs None when no frames could be read.
+    """
+    reference = cv2.VideoCapture(reference_path)
+    candidate = cv2.VideoCapture(candidate_path)
+
+    psnrs = []
+    try:
+        while True:
+            read_reference, reference_frame = reference.read()
+            read_candidate, candidate_frame = candidate.read()
+            if not read_reference or not read_candidate:
+                break
+            psnrs.append(cv2.PSNR(reference_frame, candidate_frame))
+    finally:
+        reference.release()
+        candidate.release()
+
+    if not psnrs:
+        return None, None, 0
+
+    return float(np.mean(psnrs)), float(np.min(psnrs)), len(psnrs)
@@ -0,0 +1,280 @@
+import array
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+#
+# inference_cache.py
+#
+# EyePop results cached on disk by the contents of the video and the pop that analyzed it,
+#  so a video is only sent for inference once per pop configuration and is never matched
+#  with another video's detections.
+#
+# Each entry is an .npz of columnar tables:
+#   frame_*   one row per frame result: seconds, source width and height
+#   person_*  one row per person: frame row, [x, y, w, h], trace id (-1 when missing)
+#   text_*    one row per text label read on a person: person row, label
+#   object_*  one row per other top-level object such as the sports ball: frame row, [x, y, w, h], class label,
+#             confidence
+#
+
+DEFAULT_CACHE_DIR = os.path.join('.cache', 'inference')
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+NO_TRACE_ID = -1
+
+# a key whose inference log or upload changed this recently may belong to a run still going, it is never evicted
+IN_PROGRESS_SECONDS = 3600
+
+
+def video_digest(video_path, chunk_size=1 << 20):
+    """ sha256 of the video file contents. """
+    digest = hashlib.sha256()
+    with open(video_path, "rb") as video_file:
+        while chunk := video_file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_results(results):
+    """ Packs an iterable of EyePop results into the columnar tables, reading one result at a time. """
+    frame_seconds = array.array('d')
+    frame_size = array.array('i')
+    person_frame = array.array('i')
+    person_box = array.array('f')
+    person_trace = array.array('q')
+    text_person = array.array('i')
+    text_label = []
+    object_frame = array.array('i')
+    object_box = array.array('f')
+    object_class = []
+    object_confidence = array.array('f')
+
+    for result in results:
+        if 'seconds' not in result:
+            continue
+
+        frame = len(frame_seconds)
+        frame_seconds.append(result['seconds'])
+        frame_size.extend(
+            (result.get('source_width', 0), result.get('source_height', 0)))
+
+        for obj in result.get('objects', []):
+            box = (obj['x'], obj['y'], obj['width'], obj['height'])
+
+            if obj['classLabel'] != 'person':
+                object_frame.append(frame)
+                object_box.extend(box)
+                object_class.append(obj['classLabel'])
+                object_confidence.append(obj.get('confidence', 0))
+                continue
+
+            person = len(person_frame)
+            person_frame.append(frame)
+            person_box.extend(box)
+            person_trace.append(obj.get('traceId', NO_TRACE_ID))
+
+            for child in obj.get('objects', []):
+                if child['classLabel'] != 'text':
+                    continue
+                for label in child.get('labels', []):
+                    text_person.append(person)
+                    text_label.append(label['label'])
+
+    return {
+        'frame_seconds': np.frombuffer(frame_seconds, dtype=np.float64),
+        'frame_size': np.frombuffer(frame_size, dtype=np.int32).reshape(-1, 2),
+        'person_frame': np.frombuffer(person_frame, dtype=np.int32),
+        'person_box': np.frombuffer(person_box, dtype=np.float32).reshape(-1, 4),
+        'person_trace': np.frombuffer(person_trace, dtype=np.int64),
+        'text_person': np.frombuffer(text_person, dtype=np.int32),
+        'text_label': np.array(text_label, dtype=str),
+        'object_frame': np.frombuffer(object_frame, dtype=np.int32),
+        'object_box': np.frombuffer(object_box, dtype=np.float32).reshape(-1, 4),
+        'object_class': np.array(object_class, dtype=str),
+        'object_confidence': np.frombuffer(object_confidence, dtype=np.float32),
+    }
+
+
+def decode_results(tables):
+    """
+    Yields results shaped like the EyePop results again, with the fields the tracker reads:
+    seconds, source size, and the persons with their trace ids and text labels, and the other
+    objects with their confidences.
+    """
+    frame_seconds = tables['frame_seconds']
+    frame_size = tables['frame_size']
+    person_box = tables['person_box'].tolist()
+    person_trace = tables['person_trace'].tolist()
+    object_box = tables['object_box'].tolist()
+    object_class = tables['object_class'].tolist()
+    # entries cached before confidences were stored have none, every object then ties at 0
+    object_confidence = tables['object_confidence'].tolist() if 'object_confidence' in tables \
+        else [0.0] * len(object_class)
+    text_label = tables['text_label'].tolist()
+
+    # row ranges of each frame's persons and objects, and each person's labels
+    person_starts = np.searchsorted(
+        tables['person_frame'], np.arange(len(frame_seconds) + 1))
+    object_starts = np.searchsorted(
+        tables['object_frame'], np.arange(len(frame_seconds) + 1))
+    text_starts = np.searchsorted(
+        tables['text_person'], np.arange(len(person_box) + 1))
+
+    for frame in range(len(frame_seconds)):
+        objects = []
+
+        for person in range(person_starts[frame], person_starts[frame + 1]):
+            x, y, w, h = person_box[person]
+            obj = {'classLabel': 'person', 'x': x,
+                   'y': y, 'width': w, 'height': h}
+
+            if person_trace[person] != NO_TRACE_ID:
+                obj['traceId'] = person_trace[person]
+
+            labels = text_label[text_starts[person]:text_starts[person + 1]]
+            if labels:
+                obj['objects'] = [{'classLabel': 'text', 'labels': [
+                    {'label': label} for label in labels]}]
+
+            objects.append(obj)
+
+        for row in range(object_starts[frame], object_starts[frame + 1]):
+            x, y, w, h = object_box[row]
+            objects.append({'classLabel': object_class[row], 'confidence': object_confidence[row],
+                           'x': x, 'y': y, 'width': w, 'height': h})
+
+        yield {
+            'seconds': float(frame_seconds[frame]),
+            'source_width': int(frame_size[frame][0]),
+            'source_height': int(frame_size[frame][1]),
+            'objects': objects,
+        }
+
+
+class InferenceCache:
+    """
+    Results keyed by sha256(video contents + pop signature), evicted least recently used
+    first once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # hashing a multi-GB video takes a while, remember digests by path, size and mtime
+        self.digests_path = os.path.join(cache_dir, 'digests.json')
+
+    def _digest(self, video_path):
+        stat = os.stat(video_path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        path = os.path.abspath(video_path)
+
+        try:
+            with open(self.digests_path, "r") as digests_file:
+                digests = json.load(digests_file)
+        except (OSError, ValueError):
+            digests = {}
+
+        entry = digests.get(path)
+        if entry and entry['stamp'] == stamp:
+            return entry['digest']
+
+        digest = video_digest(video_path)
+        digests[path] = {'stamp': stamp, 'digest': digest}
+
+        # batch workers can hash videos at the same time, each writes its own temporary file
+        temp_path = f"{self.digests_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as digests_file:
+            json.dump(digests, digests_file)
+        os.replace(temp_path, self.digests_path)
+
+        return digest
+
+    def key(self, video_path, signature):
+        return hashlib.sha256((self._digest(video_path) + signature).encode()).hexdigest()
+
+    def path(self, video_path, signature):
+        return os.path.join(self.cache_dir, self.key(video_path, signature) + '.npz')
+
+    def get(self, video_path, signature):
+        """ Returns a generator over the cached results, or None on a miss. """
+        path = self.path(video_path, signature)
+        if not os.path.exists(path):
+            return None
+
+        # mark the entry as recently used for eviction
+        os.utime(path)
+
+        with np.load(path) as data:
+            tables = {name: data[name] for name in data.files}
+
+        return decode_results(tables)
+
+    def put(self, video_path, signature, results):
+        """ Stores an iterable of results for the video and pop signature, returns the entry path. """
+        path = self.path(video_path, signature)
+
+        # write under a temporary name so a crash never leaves a truncated entry behind
+        temp_path = path + '.tmp.npz'
+        np.savez_compressed(temp_path, **encode_results(results))
+        os.replace(temp_path, path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used keys until the cache directory fits in max_bytes.
+
+        A key's files are its entry and whatever main.py writes next to it, the inference log,
+        its checkpoint and the sampled or resumed upload, all counted and removed together.
+        Temporary files are not counted, and a key with one, being written by another process,
+        is left alone, as is a key whose log or upload changed in the last IN_PROGRESS_SECONDS.
+        """
+        now = time.time()
+        keep_key = os.path.basename(keep).partition('.')[0] if keep else None
+
+        # key -> [last used, bytes, paths, in progress]
+        keys = {}
+        for name in os.listdir(self.cache_dir):
+            key, dot, suffix = name.partition('.')
+            if not dot or len(key) != 64:
+                continue
+
+            entry_path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                # removed by another process since the listing
+                continue
+
+            files = keys.setdefault(key, [0.0, 0, [], False])
+            if name.endswith(('.tmp', '.tmp.npz')):
+                files[3] = True
+                continue
+
+            files[0] = max(files[0], stat.st_mtime)
+            files[1] += stat.st_size
+            files[2].append(entry_path)
+            if suffix != 'npz' and now - stat.st_mtime < IN_PROGRESS_SECONDS:
+                files[3] = True
+
+        total = sum(files[1] for files in keys.values())
+
+        for key, (_, size, paths, in_progress) in sorted(keys.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            if key == keep_key or in_progress:
+                continue
+
+            for entry_path in paths:
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+            total -= size
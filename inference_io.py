@@ -0,0 +1,204 @@
+import json
+import os
+import time
+
+#
+# inference_io.py
+#
+# Reading and writing EyePop results one frame result at a time. Results are written as
+#  newline-delimited compact JSON, one result per line. The reader also streams the older
+#  pretty-printed JSON array files, so peak memory never depends on the length of the video.
+#
+# The writer is an append-only log with checkpoints. Every few seconds the log is flushed and
+#  fsynced, and a small <log>.checkpoint file records how many bytes and results of it are
+#  safely on disk and the `seconds` of the last one. After a crash or a dropped connection
+#  the log is cut back to the checkpoint and inference continues from there, see
+#  eyepop_manager.iter_inference(resume=True).
+#
+
+CHUNK_SIZE = 1 << 20
+
+
+def _skip_separators(buffer, pos):
+    while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+        pos += 1
+    return pos
+
+
+def _iter_json_array(file, chunk_size=CHUNK_SIZE):
+    """ Yields the elements of a JSON array file one by one, decoding from a sliding buffer. """
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size)
+    eof = len(buffer) == 0
+
+    # leading whitespace can run past the first chunk
+    pos = _skip_separators(buffer, 0)
+    while pos == len(buffer) and not eof:
+        buffer = file.read(chunk_size)
+        eof = len(buffer) == 0
+        pos = _skip_separators(buffer, 0)
+
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError("Expected a JSON array of results")
+    pos += 1
+
+    while True:
+        pos = _skip_separators(buffer, pos)
+
+        # the next element may start in the next chunk
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Results array ended without a closing bracket")
+            chunk = file.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            result, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the element runs past the end of the buffer, read more and try again
+            if eof:
+                raise
+            chunk = file.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        yield result
+        pos = end
+
+        # drop what has been decoded so the buffer stays around one chunk
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+
+def _iter_json_lines(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_results(path):
+    """
+    Yields the EyePop results stored at `path` one frame result at a time, from either
+    a newline-delimited file written by ResultWriter or a JSON array as older versions wrote.
+    """
+    with open(path, "r") as file:
+        first = file.read(1)
+        while first.isspace():
+            first = file.read(1)
+        file.seek(0)
+
+        if first == '[':
+            yield from _iter_json_array(file)
+        else:
+            yield from _iter_json_lines(file)
+
+
+def checkpoint_path(path):
+    return path + '.checkpoint'
+
+
+def read_checkpoint(path):
+    """
+    Returns the last checkpoint of the results log at `path` as a dict with the `offset` and
+    `count` of the results on disk, the `seconds` of the last one (None before the first) and
+    whether the log is `complete`, or None when there is no usable checkpoint.
+    """
+    try:
+        with open(checkpoint_path(path), "r") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+
+    # a log shorter than its checkpoint was not written by this run
+    if not os.path.exists(path) or os.path.getsize(path) < checkpoint['offset']:
+        return None
+
+    return checkpoint
+
+
+def remove_log(path):
+    """ Removes a results log and its checkpoint. """
+    for log_path in (path, checkpoint_path(path)):
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+
+class ResultWriter:
+    """
+    Appends results to `path` as newline-delimited compact JSON, checkpointing at most every
+    `checkpoint_interval` seconds and on close. With `resume` an existing log is cut back to
+    its last checkpoint and appended to, otherwise the log starts empty.
+    """
+
+    def __init__(self, path, checkpoint_interval=5.0, resume=False):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+
+        checkpoint = read_checkpoint(path) if resume else None
+
+        if checkpoint is not None:
+            # drop whatever was written after the checkpoint, it may end in a torn line
+            os.truncate(path, checkpoint['offset'])
+            self.file = open(path, "a")
+            self.count = checkpoint['count']
+            self.last_seconds = checkpoint['seconds']
+        else:
+            self.file = open(path, "w")
+            self.count = 0
+            self.last_seconds = None
+
+        self.complete = False
+        self.next_checkpoint = time.monotonic() + checkpoint_interval
+        self.checkpoint()
+
+    def write(self, result):
+        self.file.write(json.dumps(result, separators=(',', ':')))
+        self.file.write('\n')
+        self.count += 1
+        self.last_seconds = result.get('seconds', self.last_seconds)
+
+        if time.monotonic() >= self.next_checkpoint:
+            self.checkpoint()
+
+    def write_many(self, results):
+        for result in results:
+            self.write(result)
+
+    def checkpoint(self):
+        """ Flushes and fsyncs the log, then records how much of it is on disk. """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        state = {'offset': os.fstat(self.file.fileno()).st_size, 'count': self.count,
+                 'seconds': self.last_seconds, 'complete': self.complete}
+
+        # replace the checkpoint in one step so a crash leaves the old or the new one
+        temp_path = checkpoint_path(self.path) + '.tmp'
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(state, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_path, checkpoint_path(self.path))
+
+        self.next_checkpoint = time.monotonic() + self.checkpoint_interval
+
+    def close(self, complete=True):
+        """ Checkpoints and closes the log, marking it complete unless the run was cut short. """
+        if self.file.closed:
+            return
+        self.complete = complete
+        self.checkpoint()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
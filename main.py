@@ -3,6 +3,7 @@ from eyepop import EyePopSdk
 import os
 import asyncio
 import logging
+import math
 import time
 import person_tracker as pt
 import json
@@ -10,127 +11,332 @@ import argparse as ap
 
 import movie_maker as mm
 import eyepop_manager as em
+import inference_io as iio
+import inference_cache as ic
+import sampling
+import profiling
+
+
+def ingest_results(results, person_tracker):
+    """
+    Adds the people of every EyePop frame result to the person tracker. `results` can be any
+    iterable of results, such as the inference_io.iter_results generator, so only one frame
+    result needs to be in memory at a time. Returns the source (width, height).
+    """
+    source_width = 0
+    source_height = 0
+    count = 0
+    start = time.perf_counter()
+    for result in results:
+
+        source_width = result['source_width']
+        source_height = result['source_height']
+
+        ingest_result(result, person_tracker)
+        count += 1
+
+    # includes reading and decoding the results, which the generator does lazily
+    profiling.add('ingest', time.perf_counter() - start, count)
+
+    return source_width, source_height
+
+
+# class labels of the ball detections the players are measured against
+BALL_LABELS = ('sports ball',)
+
+
+def ingest_result(result, person_tracker):
+    """ Adds the people and the ball of one EyePop frame result to the person tracker. """
+    source_width = result['source_width']
+    source_height = result['source_height']
+
+    # skip any empty results
+    if 'objects' not in result:
+        return
+
+    # the most confident ball detection is the ball, the tracker measures every player's
+    #  distance to it in one batch when it builds the segments
+    balls = [obj for obj in result['objects']
+             if obj['classLabel'] in BALL_LABELS]
+    if balls:
+        ball = max(balls, key=lambda obj: obj.get('confidence', 0))
+        person_tracker.add_ball(result['seconds'], [ball['x'], ball['y'], ball['width'], ball['height']],
+                                source_width, source_height)
+
+    # iterate through the people in the video
+    for obj in result['objects']:
 
+        if obj['classLabel'] != 'person':
+            continue
+
+        # Out primary data points for the players
+        labels = []
+        trace_id = None
+
+        # grab the labels from the person if it exists
+        if 'objects' in obj:
+            for child in obj['objects']:
+                if child['classLabel'] == 'text' and 'labels' in child and len(child['labels']) > 0:
+                    # flattens the labels objects into a list of strings from child['labels'][i]['label]
+                    child_labels = [label['label']
+                                    for label in child['labels']]
+                    labels.extend(child_labels)
+
+        # grab the trace id from the person if it exists
+        if 'traceId' in obj:
+            trace_id = obj['traceId']
+
+        # if there is no trace id, we ignore the person
+        if (trace_id == None and labels == []):
+            continue
 
-def main(video_file_path: str, target_jersey_number: str, analyze=False, smoothing=20, draw_bounds=False, debug=False):
+        # add the person to the person tracker
+        person_tracker.add_person(
+            labels=labels,
+            trace_id=trace_id,
+            frame_time=result['seconds'],
+            bounds=[obj['x'], obj['y'],
+                    obj['width'], obj['height']]
+        )
+
+
+def prepare_upload(video_path, cache, signature, sample_every=1, sample_motion=None):
+    """
+    Returns (upload path, remap): the video to send for inference, and a function moving
+    the results of that upload back onto the video's timeline. With sampling the upload is
+    a shorter video of the sampled frames written next to the cache entry, see sampling.py.
+    """
+    if not sampling.signature(sample_every, sample_motion):
+        return video_path, lambda results: results
+
+    upload_path = os.path.join(
+        cache.cache_dir, cache.key(video_path, signature) + '.sampled.mp4')
+    times, frame_rate, total_frames = sampling.write_sampled_video(
+        video_path, upload_path, every=sample_every, motion_threshold=sample_motion)
+
+    print(f"Sending {len(times)} of {total_frames} frames for inference")
+
+    return upload_path, lambda results: sampling.remap_results(results, times, frame_rate)
+
+
+def load_results(video_path, cache, analyze=False, results_path=None, sample_every=1, sample_motion=None, resume=False):
+    """
+    Returns an iterable over the EyePop results for the video, or None if there are none.
+
+    Results come from `results_path` when one is given. Otherwise they are looked up in the
+    inference cache by the video contents, the pop signature and the sampling setting, and
+    `analyze` runs the inference (replacing any cached entry) and stores its results in the cache.
+    An inference run that fails keeps its checkpointed results log, and `resume` continues it.
+    """
+    if results_path:
+        return iio.iter_results(results_path)
+
+    signature = em.pop_signature() + sampling.signature(sample_every, sample_motion)
+
+    if analyze:
+        print("Analyzing video")
+
+        upload_path, remap = prepare_upload(
+            video_path, cache, signature, sample_every=sample_every, sample_motion=sample_motion)
+
+        # inference streams into a results log next to the cache entry, then is packed into it
+        log_path = os.path.join(
+            cache.cache_dir, cache.key(video_path, signature) + '.jsonl')
+        try:
+            completed = em.get_inference_data(
+                upload_path, output_path=log_path, resume=resume)
+        finally:
+            if upload_path != video_path:
+                os.remove(upload_path)
+
+        if not completed:
+            print("Inference stopped early, run again with --resume to continue from " + log_path)
+            return None
+
+        cache.put(video_path, signature, remap(iio.iter_results(log_path)))
+        iio.remove_log(log_path)
+
+    results = cache.get(video_path, signature)
+
+    if results is None:
+        print("No cached inference for " + video_path +
+              ", run with --analyze to analyze it or pass --results")
+
+    return results
+
+
+def is_target(label, target_jersey_number):
+    """ Whether a player is rendered: every player without a target, else the target jersey number or one of a list of them. """
+    if not target_jersey_number:
+        return True
+    if isinstance(target_jersey_number, str):
+        return label == target_jersey_number
+    return label in target_jersey_number
+
+
+def select_players(person_tracker, target_jersey_number=None, min_detections=pt.MIN_DETECTIONS):
+    """ Yields the (label, person) of every target player with at least `min_detections` detections and footage near the ball. """
+    for label, person in person_tracker.people.items():
+        if not is_target(label, target_jersey_number):
+            continue
+
+        # if the player has too few frames of video, we ignore them
+        if len(person) < min_detections:
+            continue
+
+        # nothing to render when the player was never near the ball
+        if not person.time_segments:
+            continue
+
+        yield label, person
+
+
+def run_pipeline(video_path, results, person_tracker, target_jersey_number=None, min_detections=pt.MIN_DETECTIONS, threshold=2, renderer=None):
+    """
+    Tracks and renders while the results are still arriving, e.g. from em.iter_inference.
+
+    After every result, each player run that ended more than `threshold` seconds ago can't
+    grow any more. It is smoothed on its own and handed to the renderer, so encoding overlaps
+    inference instead of waiting for the whole video. A player's runs are held back until
+    it has `min_detections` detections and its number was read the tracker's min_label_reads
+    times, like the batch path drops players with fewer, and runs of numbers that never get
+    there are dropped. When a run is handed out, its detections whose trace belongs to another
+    player by the labels read so far are left out, as PersonTracker.consolidate_people would
+    move them. Returns the output files.
+    """
+    # label -> (start row, end row) runs waiting for their player to be confirmed
+    pending = {}
 
-    def upload_video(video_path: str):
-        #
-        #  0. Obtain the EyePop inference data from the video
-        #
-        if analyze:
-            print("Analyzing video")
-            em.get_inference_data(video_path)
+    # labels whose runs are handed out as soon as they close
+    confirmed = set()
+
+    def is_confirmed(label, identities):
+        person = person_tracker.people[label]
+        if len(person) < min_detections or person_tracker.label_reads.get(label, 0) < person_tracker.min_label_reads:
+            return False
+        # counted after the detections of other players' traces are taken out, as the batch path counts
+        return identities is None or \
+            person_tracker.owned_rows(label, 0, len(person), identities).sum() >= min_detections
+
+    def submit_closed(now):
+        closed = person_tracker.close_segments(now, threshold=threshold)
+        for label, start_row, end_row in closed:
+            if is_target(label, target_jersey_number):
+                pending.setdefault(label, []).append((start_row, end_row))
+
+        if not closed or not pending:
+            return
 
-        # The PersonTracker class is used to track people in the video
-        person_tracker = pt.PersonTracker(smoothing=smoothing)
+        identities = person_tracker.identities() if person_tracker.min_label_reads else None
+        confirmed.update(label for label in pending
+                         if label not in confirmed and is_confirmed(label, identities))
 
-        time.sleep(1)
+        for label in [label for label in pending if label in confirmed]:
+            file_name = 'player_' + label + '.mp4'
+            for start_row, end_row in pending.pop(label):
+                rows = person_tracker.owned_rows(label, start_row, end_row, identities) if identities else None
+                if rows is not None and not rows.any():
+                    continue
 
-        # read the data.json files which contains the results of the eyepop inference
-        json_data = open("data.json", "r")
-        json_data = json.load(json_data)
+                segments, track = person_tracker.segment_track(
+                    label, start_row, end_row, threshold=threshold, rows=rows)
 
+                # a run that never came near the ball has nothing to render
+                if not segments:
+                    continue
+                print(video_path, file_name, segments)
+                renderer.submit(file_name, segments, track)
+
+    try:
+        for result in results:
+            with profiling.stage('ingest'):
+                ingest_result(result, person_tracker)
+            submit_closed(result['seconds'])
+
+        # the video is over, every run still open is closed
+        submit_closed(math.inf)
+    except BaseException:
+        # e.g. inference failed, stop the parts already queued and remove their files
+        renderer.close()
+        raise
+
+    return renderer.finish()
+
+
+def main(video_file_path: str, target_jersey_number: str, analyze=False, smoothing=20, draw_bounds=False, debug=False, encoder='pipe', workers=1, chunk_seconds=None, interpolation='linear', trace_resolution='recent', results_path=None, cache_dir=ic.DEFAULT_CACHE_DIR, cache_size=ic.DEFAULT_MAX_BYTES, pipeline=False, preview_every=0, ball_distance=None, sample_every=1, sample_motion=None, resume=False, backend='opencv', threads=0, min_label_reads=pt.MIN_LABEL_READS, output_dir=mm.OUTPUT_DIR):
+    """
+    Analyzes and renders one video, see the command line flags below. `target_jersey_number`
+    can also be a list of jersey numbers. Returns the rendered files, or None when there
+    were no results to render from.
+    """
+    # the thresholds count the detections and reads of a full run, a sampled run sees every Nth of them
+    min_detections = sampling.scale_count(pt.MIN_DETECTIONS, sample_every)
+    min_label_reads = sampling.scale_count(min_label_reads, sample_every)
+
+    def pipeline_video(video_path, cache, person_tracker):
         #
-        #  1. iterate through the eyepop results and add the people to the person tracker
+        #  Track and render each player's segments as soon as they close, while inference is still running
         #
-        source_width = 0
-        source_height = 0
-        for result in json_data:
-
-            source_width = result['source_width']
-            source_height = result['source_height']
-
-            sports_ball_location = {
-                'x': -1, 'y': -1, 'width': -1, 'height': -1
-            }
+        log_path = None
+        if analyze and not results_path:
+            print("Analyzing video")
 
-            # skip any empty results
-            if 'objects' not in result:
-                continue
+            signature = em.pop_signature() + sampling.signature(sample_every, sample_motion)
+            upload_path, remap = prepare_upload(
+                video_path, cache, signature, sample_every=sample_every, sample_motion=sample_motion)
+
+            # the results stream through a log that is packed into the cache once inference is done
+            log_path = os.path.join(
+                cache.cache_dir, cache.key(video_path, signature) + '.jsonl')
+            results = remap(em.iter_inference(
+                upload_path, output_path=log_path, resume=resume))
+        else:
+            results = load_results(
+                video_path, cache, results_path=results_path, sample_every=sample_every, sample_motion=sample_motion)
+            if results is None:
+                return None
+
+        try:
+            renderer = mm.StreamingRenderer(video_path, resolution=(720, 600), draw_bounds=draw_bounds,
+                                            encoder=encoder, workers=workers, interpolation=interpolation, backend=backend,
+                                            threads=threads, output_dir=output_dir)
+            output_files = run_pipeline(video_path, results, person_tracker,
+                                        target_jersey_number=target_jersey_number, min_detections=min_detections,
+                                        renderer=renderer)
+
+            if log_path:
+                cache.put(video_path, signature, remap(iio.iter_results(log_path)))
+                iio.remove_log(log_path)
+        finally:
+            if log_path and upload_path != video_path:
+                os.remove(upload_path)
+
+        return output_files
 
-            # if not draw_bounds:
-            #     # find the sports ball location
-            #     for obj in result['objects']:
+    def upload_video(video_path: str):
+        #
+        #  0. Obtain the EyePop inference data from the video, cached by the video contents and pop
+        #
+        cache = ic.InferenceCache(cache_dir, max_bytes=cache_size)
 
-            #         if obj['classLabel'] == 'sports ball':
+        # The PersonTracker class is used to track people in the video
+        person_tracker = pt.PersonTracker(
+            smoothing=smoothing, trace_resolution=trace_resolution, ball_distance=ball_distance,
+            min_label_reads=min_label_reads)
 
-            #             sports_ball_location['x'] = obj['x']
-            #             sports_ball_location['y'] = obj['y']
-            #             sports_ball_location['width'] = obj['width']
-            #             sports_ball_location['height'] = obj['height']
+        if pipeline and not debug:
+            return pipeline_video(video_path, cache, person_tracker)
 
-            # iterate through the people in the video
-            for obj in result['objects']:
+        results = load_results(video_path, cache, analyze=analyze, results_path=results_path,
+                               sample_every=sample_every, sample_motion=sample_motion, resume=resume)
 
-                if obj['classLabel'] != 'person':
-                    continue
+        if results is None:
+            return None
 
-                # Out primary data points for the players
-                ball_distance = -1
-                labels = []
-                trace_id = None
-
-                # grab the labels from the person if it exists
-                if 'objects' in obj:
-                    for child in obj['objects']:
-                        if child['classLabel'] == 'text' and 'labels' in child and len(child['labels']) > 0:
-                            # flattens the labels objects into a list of strings from child['labels'][i]['label]
-                            child_labels = [label['label']
-                                            for label in child['labels']]
-                            labels.extend(child_labels)
-
-                # grab the trace id from the person if it exists
-                if 'traceId' in obj:
-                    trace_id = obj['traceId']
-
-                # expand the bounds of the person to contain the sports ball location
-                if sports_ball_location['x'] != -1:
-
-                    # Calculate new bounding box coordinates and dimensions
-                    new_min_x = min(obj['x'], sports_ball_location['x'])
-                    new_max_x = max(obj['x'] + obj['width'],
-                                    sports_ball_location['x'] + sports_ball_location['width'])
-                    new_min_y = min(obj['y'], sports_ball_location['y'])
-                    new_max_y = max(obj['y'] + obj['height'],
-                                    sports_ball_location['y'] + sports_ball_location['height'])
-
-                    obj['x'] = new_min_x
-                    obj['y'] = new_min_y
-                    obj['width'] = new_max_x - new_min_x
-                    obj['height'] = new_max_y - new_min_y
-
-                # Calculate the normalized distance between the person and the ball
-                if sports_ball_location['x'] != -1:
-                    # Calculate normalized center coordinates of the sports ball
-                    x1 = (sports_ball_location['x'] +
-                          (sports_ball_location['width'] / 2)) / source_width
-                    y1 = (sports_ball_location['y'] +
-                          (sports_ball_location['height'] / 2)) / source_height
-
-                    # Calculate normalized center coordinates of the object (person)
-                    x2 = (obj['x'] + (obj['width'] / 2)) / source_width
-                    y2 = (obj['y'] + (obj['height'] / 2)) / source_height
-
-                    # Euclidean distance between the two normalized points
-                    ball_distance = ((x1 - x2)**2 + (y1 - y2)**2)**0.5
-
-                # if there is no trace id, we ignore the person
-                if (trace_id == None and labels == []):
-                    continue
-
-                # # if the ball distance is 20% or more of the screen width, we ignore the person
-                # if ball_distance > 0.4 or ball_distance == -1:
-                #     continue
-
-                # add the person to the person tracker
-                person_tracker.add_person(
-                    labels=labels,
-                    trace_id=trace_id,
-                    frame_time=result['seconds'],
-                    bounds=[obj['x'], obj['y'],
-                            obj['width'], obj['height']]
-                )
+        #
+        #  1. iterate through the eyepop results and add the people to the person tracker
+        #
+        source_width, source_height = ingest_results(results, person_tracker)
 
         # filter and consolidate the people in the person tracker
         person_tracker.filter_map(source_width, source_height, threshold=2)
@@ -138,48 +344,107 @@ def main(video_file_path: str, target_jersey_number: str, analyze=False, smoothi
         if (debug):
             # print all the keys in the person tracker
             for key in person_tracker.people.keys():
-                if len(person_tracker.people[key]['seconds']) > 30:
+                if len(person_tracker.people[key]) > min_detections:
                     print('Player found:', key,  ' frames detected: ',
-                          len(person_tracker.people[key]['seconds']))
-            return
+                          len(person_tracker.people[key]))
+
+            print('Tracked detections use', person_tracker.nbytes(), 'bytes')
+            return []
 
         #
-        #   2. create the output videos
+        #   2. create the output videos, every player is rendered from a single pass over the video
         #
-        for key in person_tracker.people.keys():
-            person = person_tracker.people[key]
-
-            if target_jersey_number and target_jersey_number != key:
-                continue
-
-            # if the player has less than 30 frames of video, we ignore them
-            if len(person['seconds']) < 30:
-                continue
-
+        targets = {}
+        for key, person in select_players(person_tracker, target_jersey_number, min_detections):
             file_name = 'player_' + key + '.mp4'
 
-            print(video_file_path, file_name, person['time_segments'])
-
-            time.sleep(1)
-
-            mm.create_video(video_file_path, file_name,
-                            person['time_segments'], person['bounds'], resolution=(720, 600), draw_bounds=draw_bounds)
-
-    upload_video(video_file_path)
-
-
-# adds command line arguments allowing the user to specify the video file path
-#  and a target jersey number that is compared against the detected labels
-args = ap.ArgumentParser()
-args.add_argument("--video", type=str, default='./video/Video.MOV')
-args.add_argument("--target", type=str, default=None, nargs='?')
-args.add_argument("--analyze", action="store_true")
-args.add_argument("--smoothing", type=float, default=.95, nargs='?')
-args.add_argument("--draw_bounds", action="store_true")
-args.add_argument("--debug", action="store_true")
-args = args.parse_args()
-
-print(args)
-
-main(args.video, args.target, analyze=args.analyze,
-     smoothing=args.smoothing, draw_bounds=args.draw_bounds, debug=args.debug)
+            print(video_file_path, file_name, person.time_segments)
+
+            targets[file_name] = (person.time_segments, person.track)
+
+        if not targets:
+            return []
+
+        output_files = mm.create_videos(video_file_path, targets, resolution=(
+            720, 600), draw_bounds=draw_bounds, encoder=encoder, workers=workers, chunk_seconds=chunk_seconds, interpolation=interpolation,
+            preview_every=preview_every, backend=backend, threads=threads, output_dir=output_dir)
+        return list(output_files.values())
+
+    return upload_video(video_file_path)
+
+
+if __name__ == "__main__":
+    # adds command line arguments allowing the user to specify the video file path
+    #  and a target jersey number that is compared against the detected labels
+    args = ap.ArgumentParser()
+    args.add_argument("--video", type=str, default='./video/Video.MOV')
+    args.add_argument("--target", type=str, default=None, nargs='?')
+    args.add_argument("--analyze", action="store_true")
+    args.add_argument("--smoothing", type=str, default='.95', nargs='?')
+    args.add_argument("--draw_bounds", action="store_true")
+    args.add_argument("--debug", action="store_true")
+    args.add_argument("--encoder", type=str, default='pipe',
+                      choices=['pipe', 'jpeg', 'opencv'])
+    args.add_argument("--backend", type=str, default='opencv', choices=list(mm.BACKENDS),
+                      help="composite in Python with OpenCV, or compile each player's render into one ffmpeg filter graph")
+    args.add_argument("--workers", type=int, default=1)
+    args.add_argument("--threads", type=int, default=0,
+                      help="decode, composite on this many threads and encode in a staged pipeline in each render process")
+    args.add_argument("--chunk_seconds", type=float, default=None)
+    args.add_argument("--interpolation", type=str, default='linear',
+                      choices=['linear', 'hold', 'nearest'])
+    args.add_argument("--trace_resolution", type=str, default='recent',
+                      choices=['recent', 'majority'])
+    args.add_argument("--min_label_reads", type=int, default=pt.MIN_LABEL_READS,
+                      help="drop jersey numbers read fewer times than this and merge each trace's detections into its player, 0 keeps every label as read. Counted at the full frame rate, --sample_every scales it down")
+    args.add_argument("--output_dir", type=str, default=mm.OUTPUT_DIR,
+                      help="write the reels here")
+    args.add_argument("--results", type=str, default=None,
+                      help="read results from this file instead of the inference cache, e.g. an old data.json")
+    args.add_argument("--cache_dir", type=str, default=ic.DEFAULT_CACHE_DIR)
+    args.add_argument("--cache_size_gb", type=float,
+                      default=ic.DEFAULT_MAX_BYTES / 1024 ** 3)
+    args.add_argument("--profile", action="store_true",
+                      help="print the time and count of each stage and the peak memory at the end")
+    args.add_argument("--profile_json", type=str, default=None,
+                      help="write the --profile report to this JSON file instead of printing it")
+    args.add_argument("--cprofile", type=str, default=None,
+                      help="run under cProfile, dump the stats to this file and print the top functions")
+    args.add_argument("--tracemalloc", type=int, default=0,
+                      help="trace allocations and print this many of the lines holding the most memory")
+    args.add_argument("--preview", type=int, default=0, metavar="N",
+                      help="show every Nth rendered frame in a window, rendering is headless by default")
+    args.add_argument("--ball_distance", type=float, default=None,
+                      help="only render footage where the player is within this distance of the ball, as a fraction of the frame, e.g. 0.4")
+    args.add_argument("--sample_every", type=int, default=1,
+                      help="with --analyze, send only every Nth frame for inference")
+    args.add_argument("--sample_motion", type=float, default=None,
+                      help="with --analyze, also send a frame early once this much motion built up since the last one sent")
+    args.add_argument("--resume", action="store_true",
+                      help="continue an --analyze run that stopped early from its results log, implies --analyze")
+    args.add_argument("--pipeline", action="store_true",
+                      help="render each player segment as soon as it closes instead of after all results are in")
+    args = args.parse_args()
+
+    print(args)
+
+    profiling.enable(args.profile or args.profile_json is not None)
+
+    with profiling.hooks(cprofile_path=args.cprofile, tracemalloc_top=args.tracemalloc):
+        main(args.video, args.target, analyze=args.analyze or args.resume,
+             smoothing=args.smoothing, draw_bounds=args.draw_bounds, debug=args.debug, encoder=args.encoder,
+             workers=args.workers, chunk_seconds=args.chunk_seconds, interpolation=args.interpolation,
+             trace_resolution=args.trace_resolution, results_path=args.results, cache_dir=args.cache_dir,
+             cache_size=int(args.cache_size_gb * 1024 ** 3), pipeline=args.pipeline,
+             preview_every=args.preview, ball_distance=args.ball_distance,
+             sample_every=args.sample_every, sample_motion=args.sample_motion, resume=args.resume,
+             backend=args.backend, threads=args.threads, min_label_reads=args.min_label_reads,
+             output_dir=args.output_dir)
+
+    if profiling.enabled:
+        stats = profiling.report()
+        if args.profile_json:
+            with open(args.profile_json, "w") as profile_file:
+                json.dump(stats, profile_file, indent=2)
+        else:
+            print(profiling.format_report(stats))
@@ -1,40 +1,45 @@
 from moviepy.editor import VideoFileClip, concatenate_videoclips, CompositeVideoClip, ColorClip, transfx
 from moviepy.video.VideoClip import VideoClip
 import os
-import subprocess
+import contextlib
+import bisect
+import concurrent.futures
+import queue
+import threading
+import time
+import shutil
 import numpy as np
 import cv2
-import subprocess
 
 import twod
+import filtergraph
+import profiling
+import progress
+import bounds_track as bt
+import video_tools as vt
+import video_writer as vw
 
-sprite = cv2.imread("indicator.png", cv2.IMREAD_UNCHANGED)
+SPRITE_PATH = "indicator.png"
 
+sprite = cv2.imread(SPRITE_PATH, cv2.IMREAD_UNCHANGED)
 
-def get_bounds_at_time(time_bounds, t):
-    """ Interpolate or retrieve bounds at given time `t`. """
-    closest_time = min(time_bounds.keys(), key=lambda x: abs(x - t))
-    return time_bounds[closest_time]
+# how output frames are made: 'opencv' composites in Python and hands frames to a writer,
+#  'ffmpeg' compiles each player's render into one ffmpeg filter graph, see filtergraph.py
+BACKENDS = ('opencv', 'ffmpeg')
 
 
-def create_video(video_path, output_video_path, segments, bounds, resolution=(720, 720), draw_bounds=False):
+def get_bounds_at_time(track, t, interpolation='linear'):
+    """
+    Interpolate or retrieve bounds at given time `t` from a BoundsTrack. A {seconds: bounds}
+    dict is turned into one once with bt.as_track, not on every lookup.
+    """
+    if not isinstance(track, bt.BoundsTrack):
+        raise TypeError("get_bounds_at_time needs a BoundsTrack, convert the bounds with bt.as_track first")
+    return track.at(t, interpolation=interpolation)
 
-    video_file_name = os.path.basename(video_path)
-    video_file_name = ''.join(e for e in video_file_name if e.isalnum())
-
-    cap = cv2.VideoCapture(video_path)
-    frame_rate = cap.get(cv2.CAP_PROP_FPS)
-
-    output_folder = 'output\\' + output_video_path + '_temp\\'
-
-    print(video_file_name, video_path, output_video_path, output_folder)
-
-    # Create output folder if it doesn't exist
-    os.makedirs(output_folder, exist_ok=True)
-
-    dst = False
-    count = 0
 
+def get_output_rects(resolution):
+    """ Returns the (output_rect, dst_rect) pair: the full output frame and the padded square the roi is drawn into. """
     output_rect = twod.get_rect(x=0, y=0, w=resolution[0], h=resolution[1])
 
     dst_padding = 10
@@ -42,118 +47,766 @@ def create_video(video_path, output_video_path, segments, bounds, resolution=(72
     dst_rect = twod.get_rect(
         center_x=output_rect['center_x'], center_y=output_rect['center_y'], w=dst_size, h=dst_size)
 
-    for i, (start, end) in enumerate(segments):
+    return output_rect, dst_rect
 
-        for t in np.arange(start, end, 1.0 / frame_rate):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, int(t * frame_rate))
-            ret, frame = cap.read()
-            output = None
 
-            if not ret:
-                print("Error reading frame: " + str(t))
-                break
+# box blur kernel of the background, in source pixels
+BLUR_KERNEL = 51
 
-            frame_rect = twod.get_rect(
-                x=0, y=0, w=frame.shape[1], h=frame.shape[0])
-            blur_rect = twod.get_rect_fit_inside_another_rect(
-                inner_rect=output_rect, outer_rect=frame_rect)
+# resized sprites by size: (premultiplied foreground, inverse alpha), both uint16
+_sprite_cache = {}
 
-            bounds_at_time = get_bounds_at_time(bounds, t)
-            x1, y1, w, h = bounds_at_time[0], bounds_at_time[1], bounds_at_time[2], bounds_at_time[3]
-            bounds_rect = twod.get_rect(x=x1, y=y1, w=w, h=h)
+# blending scratch buffers by sprite size, one set per compositor thread
+_scratch = threading.local()
 
-            count += 1
+# background crop geometry by (frame width, frame height, output width, output height)
+_background_cache = {}
 
-            if draw_bounds:
-                cv2.rectangle(frame, (bounds_rect['left'], bounds_rect['top']),
-                              (bounds_rect['right'], bounds_rect['bottom']), (0, 255, 0), 2)
 
-            # calculate the size of the region of interest, keeping it a square
-            roi_padding = 200  # w // 2
-            desired_roi_size = int(bounds_rect['max_dim'] + 2 * roi_padding)
-            roi_size = min(max(500, desired_roi_size), frame_rect['min_dim'])
-            roi_rect = twod.get_rect_clamped_inside_another_rect(
-                center_x=bounds_rect['center_x'], center_y=bounds_rect['center_y'], w=roi_size, h=roi_size, outer_rect=frame_rect)
+def get_sprite(width, height):
+    """
+    The indicator sprite resized to width x height, prepared for fixed-point blending:
+    the foreground premultiplied by alpha and the inverse alpha, both on a 0-256 scale.
+    """
+    key = (width, height)
+    if key not in _sprite_cache:
+        sprite_resized = cv2.resize(sprite, (width, height))
 
-            # calculate the size of the sprite
-            sprite_min_size = 20
-            sprite_max_size = 50
-            # Adjust the scale factor as needed
-            sprite_width = min(
-                max(sprite_min_size, int(w * 0.3)), sprite_max_size)
-            sprite_height = int(sprite_width)
-            sprite_resized = cv2.resize(sprite, (sprite_width, sprite_height))
-            sprite_rect = twod.get_rect_clamped_inside_another_rect(
-                center_x=bounds_rect['center_x'], center_y=bounds_rect['top']-sprite_height/2, w=sprite_width, h=sprite_height, outer_rect=roi_rect)
+        # alpha 0-255 mapped onto 0-256 so a fully opaque pixel replaces the background exactly
+        alpha = sprite_resized[:, :, 3:4].astype(np.uint16)
+        alpha += alpha >> 7
 
-            # Add the sprite to the cropped frame, respecting alpha channel
-            alpha = sprite_resized[:, :, 3] / 255.0
-            foreground = sprite_resized[:, :, :3]
-            background = frame[twod.to_slice(sprite_rect)]
+        foreground = sprite_resized[:, :, :3] * alpha
+        _sprite_cache[key] = (foreground, 256 - alpha)
 
-            # Expand the dimensions of alpha to match the shape of foreground and background
-            alpha_expanded = np.expand_dims(alpha, axis=2)
+    return _sprite_cache[key]
 
-            # Multiply alpha_expanded with foreground and (1 - alpha_expanded) with background
-            blended = (alpha_expanded * foreground +
-                       (1 - alpha_expanded) * background).astype(np.uint8)
 
-            frame[twod.to_slice(sprite_rect)] = blended
-            roi = frame[twod.to_slice(roi_rect)]
+def blend_sprite(background, width, height):
+    """ Alpha blends the sprite onto the uint8 `background` view in place. """
+    foreground, inverse_alpha = get_sprite(width, height)
 
-            # fill in the rest of the frame with a blurred version of the frame
-            blurred_frame = cv2.blur(frame, (51, 51))
-            blurred_frame = cv2.resize(
-                blurred_frame, [frame.shape[1], frame.shape[0]])
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    scratch = buffers.get((width, height))
+    if scratch is None:
+        scratch = buffers[(width, height)] = np.empty_like(foreground)
 
-            output = cv2.resize(blurred_frame[twod.to_slice(
-                blur_rect)], (output_rect['w'], output_rect['h']))
+    # a sprite clamped against the frame edge can lose its last row or column
+    rows, cols = background.shape[:2]
+    if (rows, cols) != (height, width):
+        foreground = foreground[:rows, :cols]
+        inverse_alpha = inverse_alpha[:rows, :cols]
+        scratch = scratch[:rows, :cols]
 
-            roi_resized = cv2.resize(roi, (dst_rect['w'], dst_rect['h']))
-            output[twod.to_slice(dst_rect)] = roi_resized
+    np.multiply(background, inverse_alpha, out=scratch)
+    scratch += foreground
+    scratch >>= 8
+    np.copyto(background, scratch, casting='unsafe')
 
-            if draw_bounds:
-                # uncomment to show roi within frame. red is roi, green is bounds
-                cv2.rectangle(frame, *twod.to_corners(roi_rect),
-                              (0, 0, 255), 2)
-                output = frame
 
-            print(f"Writing frame {
-                  t} to " + os.path.join(output_folder, str(count).zfill(4) + ".jpg"))
+def get_background_plan(frame_rect, output_rect):
+    """
+    Where the blurred background comes from. The part of the frame that fills the output,
+    padded by the blur radius so the edges blur as if the whole frame had been blurred,
+    is downscaled to output scale first and blurred there with a kernel shrunk by the same
+    scale, a fraction of the work of blurring the full frame.
+
+    Returns (crop slices in the frame, scaled crop size, kernel size, output slices in the scaled crop).
+    """
+    key = (frame_rect['w'], frame_rect['h'], output_rect['w'], output_rect['h'])
+    if key in _background_cache:
+        return _background_cache[key]
 
-            cv2.imwrite(os.path.join(output_folder, str(
-                count).zfill(4) + ".jpg"), output)
+    blur_rect = twod.get_rect_fit_inside_another_rect(
+        inner_rect=output_rect, outer_rect=frame_rect)
+    scale_x = output_rect['w'] / blur_rect['w']
+    scale_y = output_rect['h'] / blur_rect['h']
+
+    radius = BLUR_KERNEL // 2
+    left = max(frame_rect['left'], blur_rect['left'] - radius)
+    top = max(frame_rect['top'], blur_rect['top'] - radius)
+    right = min(frame_rect['right'], blur_rect['right'] + radius)
+    bottom = min(frame_rect['bottom'], blur_rect['bottom'] + radius)
+
+    offset_x = int(round((blur_rect['left'] - left) * scale_x))
+    offset_y = int(round((blur_rect['top'] - top) * scale_y))
+    scaled_size = (max(offset_x + output_rect['w'], int(round((right - left) * scale_x))),
+                   max(offset_y + output_rect['h'], int(round((bottom - top) * scale_y))))
+
+    kernel = (max(1, int(round(BLUR_KERNEL * scale_x))),
+              max(1, int(round(BLUR_KERNEL * scale_y))))
+
+    plan = ((slice(top, bottom), slice(left, right)), scaled_size, kernel,
+            (slice(offset_y, offset_y + output_rect['h']), slice(offset_x, offset_x + output_rect['w'])))
+    _background_cache[key] = plan
+    return plan
 
-            cv2.imshow('frame' + output_video_path, output)
 
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                exit()
-                break
-        cv2.destroyAllWindows()
+class RenderPlan:
+    """
+    Where everything goes in every output frame of one reel, computed for all frames at once
+    by get_render_plan before any frame is decoded, so the frame loop only indexes arrays.
+
+    `bounds`, `roi` and `sprite` are N x 4 integer [x, y, w, h] arrays in source frame
+    pixels, one row per output frame: the player, the square region shown around them and
+    the indicator sprite above them. The output rects and the blurred background's window
+    only depend on the frame size and resolution, so they are kept once for the reel.
+    A plan can be saved to an .npz file and loaded back with load_render_plan.
+    """
+
+    __slots__ = ('frame_size', 'resolution', 'bounds', 'roi', 'sprite',
+                 'output_rect', 'dst_rect', 'background')
+
+    def __init__(self, frame_size, resolution, bounds, roi, sprite):
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.resolution = (int(resolution[0]), int(resolution[1]))
+        self.bounds = bounds
+        self.roi = roi
+        self.sprite = sprite
+
+        self.output_rect, self.dst_rect = get_output_rects(self.resolution)
+        frame_rect = twod.get_rect(
+            x=0, y=0, w=self.frame_size[0], h=self.frame_size[1])
+        self.background = get_background_plan(frame_rect, self.output_rect)
+
+    def layout(self, k):
+        """ The (bounds, roi, sprite) [x, y, w, h] lists of output frame `k`. """
+        return self.bounds[k].tolist(), self.roi[k].tolist(), self.sprite[k].tolist()
+
+    def save(self, path):
+        np.savez(path, frame_size=self.frame_size, resolution=self.resolution,
+                 bounds=self.bounds, roi=self.roi, sprite=self.sprite)
+
+    def __len__(self):
+        return len(self.bounds)
+
+
+def load_render_plan(path):
+    with np.load(path) as plan:
+        return RenderPlan(plan['frame_size'], plan['resolution'], plan['bounds'], plan['roi'], plan['sprite'])
+
+
+def get_render_plan(frame_size, resolution, boxes):
+    """ The RenderPlan of a reel from its resampled [x, y, w, h] boxes, one row per output frame. """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    frame_rect = np.array([0, 0, frame_size[0], frame_size[1]])
+
+    bounds = twod.get_rects(
+        x=boxes[:, 0], y=boxes[:, 1], w=boxes[:, 2], h=boxes[:, 3])
+    x, y, w, h = bounds.T
+    center_x = x + w // 2
+    center_y = y + h // 2
+
+    # calculate the size of the region of interest, keeping it a square
+    roi_padding = 200  # w // 2
+    desired_roi_size = np.maximum(w, h) + 2 * roi_padding
+    roi_size = np.minimum(np.maximum(500, desired_roi_size), min(frame_size))
+    roi = twod.get_rects_clamped_inside_another_rect(
+        center_x, center_y, roi_size, roi_size, frame_rect)
+
+    # calculate the size of the sprite
+    sprite_min_size = 20
+    sprite_max_size = 50
+    # Adjust the scale factor as needed, sized from the unrounded box width
+    sprite_size = np.minimum(np.maximum(
+        sprite_min_size, (boxes[:, 2] * 0.3).astype(np.int64)), sprite_max_size)
+    sprite = twod.get_rects_clamped_inside_another_rect(
+        center_x, y - sprite_size / 2, sprite_size, sprite_size, roi)
+
+    return RenderPlan(frame_size, resolution, bounds, roi, sprite)
+
+
+def compose_frame(frame, plan, k, draw_bounds=False):
+    """
+    Composites output frame `k` of a RenderPlan: the region around the player over a
+    blurred copy of the source frame, with the indicator sprite above the player. Draws on `frame`.
+    """
+    bounds_rect, roi_rect, sprite_rect = plan.layout(k)
+
+    if draw_bounds:
+        cv2.rectangle(frame, *twod.row_to_corners(bounds_rect), (0, 255, 0), 2)
+
+    # Add the sprite to the frame, respecting alpha channel
+    blend_sprite(frame[twod.row_to_slice(sprite_rect)],
+                 sprite_rect[2], sprite_rect[3])
+
+    roi = frame[twod.row_to_slice(roi_rect)]
 
-    cap.release()
+    # fill in the rest of the frame with a blurred version of the frame, blurred at output scale
+    crop, scaled_size, kernel, output_slice = plan.background
+    # a plain linear resize is enough, the blur removes any aliasing it leaves
+    background = cv2.resize(frame[crop], scaled_size)
+    output = np.ascontiguousarray(cv2.blur(background, kernel)[output_slice])
 
-    combine_images_to_video(
-        output_folder, f"output\\{video_file_name}_{output_video_path}.mp4", resolution=resolution, fps=frame_rate)
+    dst_rect = plan.dst_rect
+    roi_resized = cv2.resize(roi, (dst_rect['w'], dst_rect['h']))
+    output[twod.to_slice(dst_rect)] = roi_resized
 
+    if draw_bounds:
+        # uncomment to show roi within frame. red is roi, green is bounds
+        cv2.rectangle(frame, *twod.row_to_corners(roi_rect),
+                      (0, 0, 255), 2)
+        output = frame
 
-def combine_images_to_video(image_folder, output_path, resolution, fps):
-    current_path = os.path.dirname(os.path.abspath(__file__))
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-r", str(int(fps)),
-        "-i", os.path.join(current_path, image_folder, "%04d.jpg"),
-        "-c:v", "libx264",
-        "-vf", f"fps={int(fps)}",
-        "-pix_fmt", "yuv420p",
-        os.path.join(current_path, output_path),
-        '-y'
-    ]
+    return output
 
-    print('\n\n\n\n\n\n\n\n', ' '.join(ffmpeg_cmd), '\n\n\n\n\n\n\n\n')
 
-    subprocess.run(ffmpeg_cmd, check=True)
+# where rendered reels are written, relative to the working directory
+OUTPUT_DIR = 'output'
+
+
+def get_output_file(video_path, output_video_path, output_dir=OUTPUT_DIR):
+    video_file_name = os.path.basename(video_path)
+    video_file_name = ''.join(e for e in video_file_name if e.isalnum())
+
+    return os.path.join(output_dir, f"{video_file_name}_{output_video_path}.mp4")
+
+
+def create_video(video_path, output_video_path, segments, bounds, resolution=(720, 720), draw_bounds=False, encoder='pipe', workers=1, chunk_seconds=None, interpolation='linear', preview_every=0, progress_callback=progress.print_progress, backend='opencv', threads=0, output_dir=OUTPUT_DIR):
+    """
+    Renders the highlight reel for one player. `encoder` picks the frame sink from
+    video_writer: 'pipe' streams raw frames into ffmpeg, 'jpeg' is the original
+    folder-of-JPEGs path, 'opencv' uses cv2.VideoWriter. `interpolation` picks how
+    boxes between detections are filled in, see bounds_track.BoundsTrack. See
+    create_videos for the other arguments.
+    """
+    create_videos(video_path, {output_video_path: (segments, bounds)},
+                  resolution=resolution, draw_bounds=draw_bounds, encoder=encoder,
+                  workers=workers, chunk_seconds=chunk_seconds, interpolation=interpolation,
+                  preview_every=preview_every, progress_callback=progress_callback, backend=backend,
+                  threads=threads, output_dir=output_dir)
+
+
+def create_videos(video_path, targets, resolution=(720, 720), draw_bounds=False, encoder='pipe', workers=1, chunk_seconds=None, interpolation='linear', preview_every=0, progress_callback=progress.print_progress, backend='opencv', threads=0, output_dir=OUTPUT_DIR):
+    """
+    Renders the highlight reels of several players in one decode pass over the video.
+
+    `targets` maps each output name to its (segments, bounds). All segments are merged
+    into one timeline, every source frame is decoded once and handed to the compositor
+    and writer of each player that needs it. Segments are expected in time order.
+
+    With `workers` > 1 the timeline is split into render units, each rendered by a
+    worker process with its own capture and writers, see render_parallel.
+
+    Rendering is headless: progress goes to `progress_callback` every couple of seconds,
+    see progress.ProgressReporter, None silences it. With `preview_every` N > 0 every Nth
+    output frame is shown in a window, in-process renders only.
+
+    `backend` picks the compositor, one of BACKENDS, and `threads` the compositor threads of
+    each render, see render_to_files. The reels are written to `output_dir`, and their
+    files returned by output name.
+    """
+    if workers > 1:
+        return render_parallel(video_path, targets, resolution=resolution, draw_bounds=draw_bounds,
+                               encoder=encoder, workers=workers, chunk_seconds=chunk_seconds, interpolation=interpolation,
+                               progress_callback=progress_callback, backend=backend, threads=threads,
+                               output_dir=output_dir)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_files = {}
+    for output_video_path in targets:
+        output_files[output_video_path] = get_output_file(
+            video_path, output_video_path, output_dir)
+        print(video_path, output_video_path,
+              output_files[output_video_path])
+
+    render_to_files(video_path, targets, output_files, resolution=resolution,
+                    draw_bounds=draw_bounds, encoder=encoder, interpolation=interpolation,
+                    preview_every=preview_every, progress_callback=progress_callback, backend=backend,
+                    threads=threads)
+
+    return output_files
+
+
+def composite_frames(reader, frame_times, plans, draw_bounds=False):
+    """
+    Yields (key, output frame) for every output frame of the targets in `frame_times` in
+    order, decoding and compositing on this thread. `plans` holds each target's RenderPlan.
+    """
+    for frame, users in reader.shared_frames(frame_times):
+
+        for i, (key, k, t) in enumerate(users):
+
+            # compositing draws on the frame, so all but the last user get their own copy
+            target_frame = frame if i == len(users) - 1 else frame.copy()
+
+            with profiling.stage('composite'):
+                output = compose_frame(
+                    target_frame, plans[key], k, draw_bounds=draw_bounds)
+
+            yield key, output
+
+
+# how many decoded frames may wait for a compositor, per compositor thread
+QUEUE_FRAMES_PER_THREAD = 2
+
+
+def composite_frames_threaded(reader, frame_times, plans, draw_bounds=False, threads=2):
+    """
+    The same frames as composite_frames, from a staged pipeline: a decoder thread, `threads`
+    compositor threads, and the caller taking the outputs in order as the writer. Decoding
+    and compositing are mostly OpenCV calls that release the GIL, so the stages overlap.
+
+    Source frames are decoded into a fixed pool of preallocated buffers, a buffer going back
+    to the pool once its frame is composited, and the outputs are new arrays the caller owns.
+    A source frame takes one of the pool's slots when it is decoded and gives it back once
+    the caller has taken its outputs, so no more than the pool size in frames is ever decoded
+    ahead of the writer, however slow it is. Time each stage spends blocked is recorded as
+    decode_wait, composite_wait and write_wait, and the depth of the decoded frame queue and
+    of the frames composited out of order as gauges, see profiling.
+    """
+    depth = QUEUE_FRAMES_PER_THREAD * threads
+    free = queue.Queue()
+    decoded = queue.Queue(maxsize=depth)
+    composited = queue.Queue()
+
+    # buffers are allocated once the frame size is known, up to the pool size
+    pool = {'allocated': 0, 'size': depth + threads + 1}
+    # frames between the decoder and the caller, released as the caller takes each frame's outputs
+    slots = threading.Semaphore(pool['size'])
+
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # blocking puts give up once the pipeline is stopped
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def acquire(semaphore):
+        while not stop.is_set():
+            if semaphore.acquire(timeout=0.1):
+                return True
+        return False
+
+    def take_buffer():
+        try:
+            return free.get_nowait()
+        except queue.Empty:
+            pass
+        if pool['allocated'] < pool['size']:
+            pool['allocated'] += 1
+            # without a known frame size the first read allocates the buffer
+            if reader.width and reader.height:
+                return np.empty((reader.height, reader.width, 3), dtype=np.uint8)
+            return None
+        return get(free)
+
+    def decode():
+        try:
+            sequence = 0
+            for frame_index, users in vt.merge_frame_times(frame_times):
+                start = time.perf_counter()
+                if not acquire(slots):
+                    return
+                buffer = take_buffer()
+                profiling.add('decode_wait', time.perf_counter() - start, 0)
+                if stop.is_set():
+                    return
+
+                frame = reader.read(frame_index, out=buffer)
+                if frame is None:
+                    print("Error reading frame: " + str(frame_index))
+                    if buffer is not None:
+                        free.put(buffer)
+                    slots.release()
+                    continue
+
+                start = time.perf_counter()
+                profiling.gauge('decode_queue', decoded.qsize())
+                if not put(decoded, (sequence, frame, users)):
+                    return
+                profiling.add('decode_wait', time.perf_counter() - start, 0)
+                sequence += 1
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(threads):
+                put(decoded, None)
+
+    def composite():
+        try:
+            while True:
+                start = time.perf_counter()
+                item = get(decoded)
+                profiling.add('composite_wait', time.perf_counter() - start, 0)
+                if item is None:
+                    return
+
+                sequence, frame, users = item
+                outputs = []
+                for i, (key, k, t) in enumerate(users):
+                    # with draw_bounds the output is the frame drawn on, so even the last user
+                    #  gets a copy and the pooled buffer never leaves the pipeline
+                    target_frame = frame if i == len(users) - 1 and not draw_bounds else frame.copy()
+
+                    with profiling.stage('composite'):
+                        outputs.append((key, compose_frame(
+                            target_frame, plans[key], k, draw_bounds=draw_bounds)))
+
+                free.put(frame)
+                composited.put((sequence, outputs))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            composited.put(None)
+
+    workers = [threading.Thread(target=decode, daemon=True)]
+    workers += [threading.Thread(target=composite, daemon=True)
+                for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        # outputs composited ahead of the next one in order, by sequence number
+        pending = {}
+        next_sequence = 0
+        running = threads
+
+        while running:
+            start = time.perf_counter()
+            item = get(composited)
+            profiling.add('write_wait', time.perf_counter() - start, 0)
+
+            if item is None:
+                if stop.is_set():
+                    break
+                running -= 1
+                continue
+
+            pending[item[0]] = item[1]
+            profiling.gauge('reorder_frames', len(pending))
+
+            while next_sequence in pending:
+                yield from pending.pop(next_sequence)
+                next_sequence += 1
+                # the caller has taken this frame's outputs, the decoder may read one more
+                slots.release()
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        raise errors[0]
+
+
+def render_to_files(video_path, targets, output_files, resolution=(720, 720), draw_bounds=False, encoder='pipe', preview_every=0, frame_times=None, interpolation='linear', progress_callback=None, backend='opencv', threads=0):
+    """
+    Renders every target in `targets` into its file in `output_files` from one reader.
+    `frame_times` optionally restricts each target to a list of (t, frame_index) output frames.
+    Each target's boxes for all its output frames are resampled from its bounds and laid
+    out into a RenderPlan up front, so the frame loop only indexes arrays. Every `preview_every`th output frame is shown
+    in a window when it is above 0, `progress_callback` gets rate-limited progress reports.
+
+    With `threads` above 0, frames are decoded, composited on that many threads and written
+    in a staged pipeline, see composite_frames_threaded.
+
+    The 'ffmpeg' backend renders each target with its own ffmpeg run instead, see
+    render_with_ffmpeg. Drawing bounds and previews need the frames in Python, so they
+    always use the 'opencv' backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+
+    reader = vt.FrameReader(video_path)
+    frame_rate = reader.frame_rate
+
+    if frame_times is None:
+        frame_times = {key: reader.segment_frames(
+            target[0]) for key, target in targets.items()}
+
+    plans = {}
+    for key, times in frame_times.items():
+        track = bt.as_track(targets[key][1])
+        boxes = track.resample(
+            [t for t, _ in times], interpolation=interpolation)
+
+        with profiling.stage('plan', count=len(times)):
+            plans[key] = get_render_plan(
+                (reader.width, reader.height), resolution, boxes)
+
+    reporter = progress.ProgressReporter(
+        total=sum(len(times) for times in frame_times.values()), callback=progress_callback)
+    preview = preview_every > 0
+
+    if backend == 'ffmpeg' and not draw_bounds and not preview:
+        reader.release()
+        for key, output_file in output_files.items():
+            render_with_ffmpeg(video_path, output_file,
+                               frame_times[key], plans[key], reader.frame_rate)
+            reporter.update(len(frame_times[key]))
+        reporter.finish()
+        return
+
+    with reader, contextlib.ExitStack() as stack:
+        writers = {}
+        for output_video_path, output_file in output_files.items():
+            writers[output_video_path] = stack.enter_context(
+                vw.open_writer(encoder, output_file, frame_rate))
+
+        if threads > 0:
+            outputs = composite_frames_threaded(reader, frame_times, plans,
+                                                draw_bounds=draw_bounds, threads=threads)
+        else:
+            outputs = composite_frames(
+                reader, frame_times, plans, draw_bounds=draw_bounds)
+
+        # closed before the writers, so the pipeline's threads stop first on an error
+        stack.enter_context(contextlib.closing(outputs))
+
+        for output_video_path, output in outputs:
+
+            with profiling.stage('encode'):
+                writers[output_video_path].write(output)
+
+            reporter.update()
+
+            if not preview or reporter.done % preview_every:
+                continue
+
+            cv2.imshow('frame' + output_video_path, output)
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                exit()
+
+    reporter.finish()
+
+    if preview:
+        cv2.destroyAllWindows()
+
 
-    # Delete the image folder
-    subprocess.run(["cmd", "/c", "rmdir", "/s", "/q",
-                   os.path.join(current_path, image_folder)])
+def render_with_ffmpeg(video_path, output_file, frame_times, plan, frame_rate):
+    """
+    Renders one target's (t, frame_index) output frames, laid out by their RenderPlan, with
+    a single ffmpeg run.
+    """
+    frame_indices = np.array([frame_index for _, frame_index in frame_times], dtype=np.int64)
+    if len(frame_indices) == 0:
+        return
+
+    # ffmpeg selects each source frame at most once, in order
+    keep = np.ones(len(frame_indices), dtype=bool)
+    keep[1:] = frame_indices[1:] > np.maximum.accumulate(frame_indices)[:-1]
+
+    filtergraph.render(video_path, output_file, frame_indices[keep].tolist(), plan.roi[keep], plan.sprite[keep],
+                       frame_rate, plan.frame_size, plan.background, plan.dst_rect, SPRITE_PATH)
+
+
+def get_render_units(frame_times, frame_rate, chunk_seconds=None):
+    """
+    Splits the targets' output frames into independent render units in time order.
+
+    `frame_times` maps target names to their (t, frame_index) output frames. Overlapping
+    frame ranges of all targets are merged into disjoint spans, so a frame shared by
+    several players stays in one unit and is still decoded once. With `chunk_seconds`,
+    spans longer than that are cut into chunks of that length. Each unit maps target
+    names to their output frames inside it.
+    """
+    # runs of consecutive source frames, across all targets
+    frame_indices = sorted({frame_index for times in frame_times.values()
+                            for _, frame_index in times})
+
+    merged = []
+    for frame_index in frame_indices:
+        if merged and frame_index == merged[-1][1] + 1:
+            merged[-1][1] = frame_index
+        else:
+            merged.append([frame_index, frame_index])
+
+    chunk_frames = max(1, int(round(chunk_seconds * frame_rate))
+                       ) if chunk_seconds else None
+
+    windows = []
+    for first, last in merged:
+        step = chunk_frames or (last - first + 1)
+        windows.extend((start, min(start + step, last + 1))
+                       for start in range(first, last + 1, step))
+
+    window_starts = [start for start, _ in windows]
+
+    units = [{} for _ in windows]
+    for key, times in frame_times.items():
+        for t, frame_index in times:
+            u = bisect.bisect_right(window_starts, frame_index) - 1
+            units[u].setdefault(key, []).append((t, frame_index))
+
+    return [unit for unit in units if unit]
+
+
+def render_unit(job):
+    """
+    Worker entry point, renders one render unit of every target into its part files.
+    Returns the part files and the worker's profiling totals for the unit.
+    """
+    video_path, targets, unit, part_files, resolution, draw_bounds, encoder, interpolation, backend, threads, profile = job
+
+    # a forked worker starts with a copy of the parent's totals, only the unit's own are handed back
+    profiling.enable(profile)
+    profiling.reset()
+
+    render_to_files(video_path, targets, part_files, resolution=resolution, draw_bounds=draw_bounds,
+                    encoder=encoder, frame_times=unit, interpolation=interpolation, backend=backend, threads=threads)
+    return part_files, profiling.snapshot()
+
+
+def render_parallel(video_path, targets, resolution=(720, 720), draw_bounds=False, encoder='pipe', workers=4, chunk_seconds=None, interpolation='linear', progress_callback=progress.print_progress, backend='opencv', threads=0, output_dir=OUTPUT_DIR):
+    """
+    Renders the targets across a process pool. Each render unit becomes one part file per
+    target, rendered by a worker with its own capture and writers, and each target's
+    parts are joined in order with a stream-copy concat. Progress is reported as units finish.
+    Returns the output files by output name.
+    """
+    reader = vt.FrameReader(video_path)
+    frame_rate = reader.frame_rate
+    frame_times = {key: reader.segment_frames(
+        target[0]) for key, target in targets.items()}
+    reader.release()
+
+    units = get_render_units(
+        frame_times, frame_rate, chunk_seconds=chunk_seconds)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = []
+    parts_folders = {}
+    for u, unit in enumerate(units):
+        unit_targets = {}
+        part_files = {}
+        for key in unit:
+            output_file = get_output_file(video_path, key, output_dir)
+            parts_folders[key] = output_file + '_parts'
+            os.makedirs(parts_folders[key], exist_ok=True)
+
+            # ship each worker the compact track rather than the raw bounds
+            unit_targets[key] = (targets[key][0], bt.as_track(targets[key][1]))
+            part_files[key] = os.path.join(
+                parts_folders[key], str(u).zfill(4) + '.mp4')
+
+        jobs.append((video_path, unit_targets, unit, part_files,
+                    resolution, draw_bounds, encoder, interpolation, backend, threads, profiling.enabled))
+
+    print(f"Rendering {len(jobs)} units across {workers} workers")
+
+    reporter = progress.ProgressReporter(total=sum(
+        len(times) for times in frame_times.values()), callback=progress_callback)
+
+    parts = {key: [] for key in targets}
+    output_files = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # map keeps the units in time order
+            for unit, (part_files, stats) in zip(units, executor.map(render_unit, jobs)):
+                profiling.merge(stats)
+                reporter.update(sum(len(times) for times in unit.values()))
+                for key, part_file in part_files.items():
+                    parts[key].append(part_file)
+
+        for key, part_files in parts.items():
+            if part_files:
+                output_files[key] = get_output_file(video_path, key, output_dir)
+                vw.concat_videos(part_files, output_files[key])
+
+        reporter.finish()
+    finally:
+        for parts_folder in parts_folders.values():
+            shutil.rmtree(parts_folder, ignore_errors=True)
+
+    return output_files
+
+
+class StreamingRenderer:
+    """
+    Renders players' segments while the rest of the video is still being analyzed.
+
+    Every submission is rendered on a process pool into its own part file as soon as
+    it is submitted, and finish() joins each player's parts in submission order with a
+    stream-copy concat. A player's segments must be submitted in time order. A run that
+    fails before finish() calls close() to stop the pool and remove the parts.
+    """
+
+    def __init__(self, video_path, resolution=(720, 720), draw_bounds=False, encoder='pipe', workers=1, interpolation='linear', backend='opencv', threads=0, output_dir=OUTPUT_DIR):
+        self.video_path = video_path
+        self.output_dir = output_dir
+        self.resolution = resolution
+        self.draw_bounds = draw_bounds
+        self.encoder = encoder
+        self.interpolation = interpolation
+        self.backend = backend
+        self.threads = threads
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, workers))
+        # output name -> futures of its part files, in time order
+        self.parts = {}
+        self.parts_folders = {}
+
+        os.makedirs(output_dir, exist_ok=True)
+
+    def submit(self, output_video_path, segments, track):
+        """ Queues (start, end) segments of a player for rendering into one part with their BoundsTrack. """
+        if output_video_path not in self.parts:
+            parts_folder = get_output_file(
+                self.video_path, output_video_path, self.output_dir) + '_parts'
+            os.makedirs(parts_folder, exist_ok=True)
+            self.parts_folders[output_video_path] = parts_folder
+            self.parts[output_video_path] = []
+
+        futures = self.parts[output_video_path]
+        part_file = os.path.join(
+            self.parts_folders[output_video_path], str(len(futures)).zfill(4) + '.mp4')
+
+        job = (self.video_path, {output_video_path: (segments, track)}, None, {output_video_path: part_file},
+               self.resolution, self.draw_bounds, self.encoder, self.interpolation, self.backend, self.threads, profiling.enabled)
+        futures.append(self.executor.submit(render_unit, job))
+
+    def finish(self):
+        """ Waits for every part and joins each player's parts into its output file, returns the output files. """
+        output_files = []
+        try:
+            for output_video_path, futures in self.parts.items():
+                part_files = []
+                for future in futures:
+                    unit_files, stats = future.result()
+                    profiling.merge(stats)
+                    part_files.append(unit_files[output_video_path])
+
+                # a segment too short to cover a single frame leaves no part behind
+                part_files = [part_file for part_file in part_files
+                              if os.path.exists(part_file)]
+                if not part_files:
+                    continue
+
+                output_file = get_output_file(
+                    self.video_path, output_video_path, self.output_dir)
+                vw.concat_videos(part_files, output_file)
+                output_files.append(output_file)
+        finally:
+            self.close()
+
+        return output_files
+
+    def close(self):
+        """ Drops the parts not started yet, waits for the running ones and removes every part file. """
+        self.executor.shutdown(cancel_futures=True)
+        for parts_folder in self.parts_folders.values():
+            shutil.rmtree(parts_folder, ignore_errors=True)
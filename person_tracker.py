@@ -1,28 +1,319 @@
 import numpy as np
-import scipy.signal
+
+import bounds_track as bt
+import profiling
+import smoothing as sm
 
 # A PersonTracker class which has a map of people, where the key is a traceID and the values are the person's jersey number and the number of frames the person has been in the video. The class should have the following methods:
 #
 # person_tracker.py
 #
 
+# trace id stored for detections that came without one
+NO_TRACE_ID = -1
+
+
+class GrowableArray:
+    """
+    A typed NumPy array that grows by doubling, so appending a detection is amortized O(1)
+    and stores raw numbers instead of Python objects.
+    """
+
+    __slots__ = ('data', 'size')
+
+    def __init__(self, dtype, width=None, capacity=16):
+        shape = (capacity,) if width is None else (capacity, width)
+        self.data = np.empty(shape, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.data):
+            # set() can leave no capacity at all, doubling it must still make room
+            self.data = np.resize(self.data, (max(1, 2 * len(self.data)),) + self.data.shape[1:])
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            self.data = np.resize(
+                self.data, (max(needed, 2 * len(self.data)),) + self.data.shape[1:])
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def set(self, values):
+        """ Replaces the contents with `values`, trimming the spare capacity. """
+        self.data = np.array(values, dtype=self.data.dtype).reshape((-1,) + self.data.shape[1:])
+        self.size = len(self.data)
+
+    @property
+    def values(self):
+        """ A view of the filled part of the array, only valid until the next append. """
+        return self.data[:self.size]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.size
+
+
+def latest_per_time(seconds):
+    """ Row order sorting `seconds`, keeping only the last row added for each distinct time. """
+    order = np.argsort(seconds, kind='stable')
+
+    # after a stable sort, the last of a run of equal times is the latest added
+    sorted_seconds = seconds[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[:-1] = sorted_seconds[1:] != sorted_seconds[:-1]
+    return order[keep]
+
+
+def near_ball(ball_distances, max_distance):
+    """
+    Mask of the detections to keep for a ball distance limit. Frames where the ball wasn't
+    detected (NaN) take the last known distance, and until the ball is first seen a player
+    is kept, so footage is only dropped when the ball is known to be far away.
+    """
+    known = ~np.isnan(ball_distances)
+    last_known = np.maximum.accumulate(
+        np.where(known, np.arange(len(ball_distances)), 0))
+    filled = ball_distances[last_known]
+
+    return np.isnan(filled) | (filled <= max_distance)
+
+
+def time_segments(times, threshold=2):
+    """ Splits sorted detection times into (start, end) segments wherever the gap exceeds `threshold` seconds. """
+    if len(times) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(times) > threshold)
+    starts = np.concatenate(([times[0]], times[breaks + 1]))
+    ends = np.concatenate((times[breaks], [times[-1]]))
+
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+class Player:
+    """
+    One tracked jersey number, every detection stored column by column.
+
+    `seconds`, `trace_ids` and `boxes` ([x, y, w, h] rows) grow together, one entry per
+    detection. `time_segments` and `track` (a bounds_track.BoundsTrack for the renderer)
+    are filled in by PersonTracker.filter_map.
+    """
+
+    __slots__ = ('label', 'seconds', 'trace_ids', 'boxes',
+                 'time_segments', 'track', 'closed')
+
+    def __init__(self, label):
+        self.label = label
+        self.seconds = GrowableArray(np.float64)
+        self.trace_ids = GrowableArray(np.int64)
+        self.boxes = GrowableArray(np.float32, width=4)
+        self.time_segments = []
+        self.track = None
+        # number of rows already handed out by PersonTracker.close_segments
+        self.closed = 0
+
+    def add(self, trace_id, frame_time, bounds):
+        self.seconds.append(frame_time)
+        self.trace_ids.append(NO_TRACE_ID if trace_id is None else trace_id)
+        self.boxes.append(bounds)
+
+    def extend(self, other, rows=None):
+        """ Appends the other player's detections, only the ones selected by `rows` when given. """
+        for column, other_column in ((self.seconds, other.seconds), (self.trace_ids, other.trace_ids),
+                                     (self.boxes, other.boxes)):
+            values = other_column.values
+            column.extend(values if rows is None else values[rows])
+
+    def sort(self):
+        """
+        Orders the detections by time. Of several detections at the same time the last one
+        added is kept, as the bounds dict keyed by time used to do.
+        """
+        order = latest_per_time(self.seconds.values)
+
+        self.seconds.set(self.seconds.values[order])
+        self.trace_ids.set(self.trace_ids.values[order])
+        self.boxes.set(self.boxes.values[order])
+
+    @property
+    def nbytes(self):
+        return self.seconds.nbytes + self.trace_ids.nbytes + self.boxes.nbytes
+
+    def __len__(self):
+        return len(self.seconds)
+
+
+class TraceLabels:
+    """
+    The jersey labels read for one trace id, kept up to date as labels arrive so resolving
+    the trace is O(1). A trace can pick up several labels when OCR misreads a number or
+    the tracker jumps from one player to another.
+    """
+
+    __slots__ = ('counts', 'recent', 'majority', 'majority_count')
+
+    def __init__(self):
+        self.counts = {}
+        self.recent = None
+        self.majority = None
+        self.majority_count = 0
+
+    def observe(self, label):
+        count = self.counts.get(label, 0) + 1
+        self.counts[label] = count
+        self.recent = label
+
+        # on a tie the label that got there first keeps the majority
+        if count > self.majority_count:
+            self.majority = label
+            self.majority_count = count
+
+
+# how a trace id that was read with several jersey labels is resolved
+TRACE_RESOLUTIONS = ('recent', 'majority')
+
+# a jersey label read fewer times than this over the whole video is taken for an OCR misread
+MIN_LABEL_READS = 2
+
+# a player detected fewer times than this over the whole video is not rendered
+MIN_DETECTIONS = 30
+
+
+class DisjointSet:
+    """ Union-find over hashable items, with path halving and union by size so every operation is near O(1). """
+
+    __slots__ = ('parent', 'size')
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.size[item] = 1
+            return item
+
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        """ Joins the sets of two roots and returns the root of the joined set. """
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+
+def resolve_identities(trace_labels, label_reads, min_reads=MIN_LABEL_READS):
+    """
+    Groups trace ids and jersey labels into athletes. Every (trace id, label) pair read
+    together is an edge weighted by its number of reads, and the edges are joined with
+    union-find from the heaviest down.
+
+    A label read at least `min_reads` times is a strong label, a real player. Two strong
+    labels are never joined, an edge that would do so is skipped, so every athlete has at
+    most one. Weak labels join whichever athlete their traces lead to, and athletes without
+    a strong label are dropped.
+
+    Returns (trace_owner, label_owner), the strong label each trace id and each label
+    belongs to, None for the dropped ones.
+    """
+    edges = [(count, trace_id, label) for trace_id, labels in trace_labels.items()
+             for label, count in labels.counts.items()]
+    # the sort is stable, ties are joined in the order the labels were read
+    edges.sort(key=lambda edge: edge[0], reverse=True)
+
+    sets = DisjointSet()
+    # root -> the strong label of its set
+    owners = {}
+    for label, reads in label_reads.items():
+        if reads >= min_reads:
+            owners[sets.find(('label', label))] = label
+
+    for _, trace_id, label in edges:
+        a = sets.find(('trace', trace_id))
+        b = sets.find(('label', label))
+        if a == b:
+            continue
+
+        owner_a, owner_b = owners.pop(a, None), owners.pop(b, None)
+        if owner_a is not None and owner_b is not None:
+            owners[a], owners[b] = owner_a, owner_b
+            continue
+
+        owner = owner_a if owner_a is not None else owner_b
+        if owner is not None:
+            owners[sets.union(a, b)] = owner
+        else:
+            sets.union(a, b)
+
+    trace_owner = {trace_id: owners.get(sets.find(('trace', trace_id))) for trace_id in trace_labels}
+    label_owner = {label: owners.get(sets.find(('label', label))) for label in label_reads}
+
+    return trace_owner, label_owner
+
 
 class PersonTracker:
 
-    def __init__(self, smoothing=20):
+    def __init__(self, smoothing=20, trace_resolution='recent', ball_distance=None, min_label_reads=MIN_LABEL_READS):
         self.people = {}
-        self.smoothing = smoothing
+        # only footage where the player is within this normalized distance of the ball is kept, None keeps all
+        self.ball_distance = ball_distance
+
+        # one row per frame the ball was detected in: its time and its center as a fraction of the frame size
+        self.ball_seconds = GrowableArray(np.float64)
+        self.ball_centers = GrowableArray(np.float64, width=2)
+        self.frame_size = None
+        # (method, strength), smoothing accepts anything smoothing.parse_smoothing does
+        self.smoothing = sm.parse_smoothing(smoothing)
+
+        if trace_resolution not in TRACE_RESOLUTIONS:
+            raise ValueError(
+                f"Unknown trace resolution '{trace_resolution}', expected one of {', '.join(TRACE_RESOLUTIONS)}")
+        self.trace_resolution = trace_resolution
+
+        # trace_id -> TraceLabels, the labels read for every trace so far
+        self.trace_labels = {}
+        # label -> times it was read, with or without a trace id
+        self.label_reads = {}
+        # labels read fewer times are dropped by consolidate_people, 0 turns consolidation off
+        self.min_label_reads = min_label_reads
+
+    # the jersey label an unlabeled detection of this trace belongs to, or None
+    def resolve_trace(self, trace_id):
+        trace_labels = self.trace_labels.get(trace_id)
+        if trace_labels is None:
+            return None
+
+        if self.trace_resolution == 'majority':
+            return trace_labels.majority
+        return trace_labels.recent
 
     # add a person to the people map
     def add_person(self, labels: [], trace_id: int, frame_time: float, bounds: []) -> None:
 
         # If there are not labels, we try to find the person by trace_id
-        #   This may introduce error if the traceID Jumps from one player to another
-        if len(labels) == 0:
-            for person in self.people:
-                if trace_id in self.people[person]['ids']:
-                    labels.append(person)
-                    break
+        #   This may introduce error if the traceID Jumps from one player to another,
+        #   trace_resolution decides which label wins when it does
+        labeled = len(labels) > 0
+        if not labeled:
+            label = self.resolve_trace(trace_id)
+            if label is not None:
+                labels.append(label)
 
         for label in labels:
 
@@ -30,206 +321,207 @@ class PersonTracker:
                 continue
 
             if label not in self.people:
-
-                self.people[label] = {
-                    'ids': [trace_id],
-                    'seconds': [],
-                    'time_segments': [],
-                    'bounds': {},
-                }
-
-            self.people[label]['ids'].append(trace_id)
-            self.people[label]['seconds'].append(frame_time)
-            self.people[label]['bounds'][frame_time] = bounds
+                self.people[label] = Player(label)
+
+            self.people[label].add(trace_id, frame_time, bounds)
+
+            if labeled:
+                self.label_reads[label] = self.label_reads.get(label, 0) + 1
+
+            if labeled and trace_id is not None:
+                self.trace_labels.setdefault(
+                    trace_id, TraceLabels()).observe(label)
+
+    # record where the ball is in a frame, people are measured against it all at once in filter_map
+    def add_ball(self, frame_time, bounds, frame_width, frame_height):
+        x, y, w, h = bounds
+        self.ball_seconds.append(frame_time)
+        self.ball_centers.append(
+            ((x + w / 2) / frame_width, (y + h / 2) / frame_height))
+        self.frame_size = (frame_width, frame_height)
+
+    # normalized distance from each detection to the ball in its frame, NaN where no ball was detected
+    def ball_distances(self, seconds, boxes):
+        distances = np.full(len(seconds), np.nan)
+        if len(self.ball_seconds) == 0 or len(seconds) == 0:
+            return distances
+
+        # results arrive in time order, so the ball rows are sorted and a detection's frame is found by its time
+        ball_seconds = self.ball_seconds.values
+        rows = np.minimum(np.searchsorted(ball_seconds, seconds), len(ball_seconds) - 1)
+        matched = ball_seconds[rows] == seconds
+
+        centers = (boxes[:, :2] + boxes[:, 2:] / 2) / self.frame_size
+        offsets = centers[matched] - self.ball_centers.values[rows[matched]]
+        distances[matched] = np.hypot(offsets[:, 0], offsets[:, 1])
+        return distances
+
+    # the detection times to build segments from, only those near the ball with a ball distance limit
+    def segment_times(self, seconds, boxes):
+        if self.ball_distance is None:
+            return seconds
+        return seconds[near_ball(self.ball_distances(seconds, boxes), self.ball_distance)]
+
+    # memory used by the tracked detections, in bytes
+    def nbytes(self):
+        return sum(person.nbytes for person in self.people.values())
 
     def filter_map(self,  width, height, threshold=2):
-        # self.consolidate_people()
-        self.filter_times(threshold)
-        # self.scale_bounds(max_width=width, max_height=height)
-        self.smooth_bounds()
-
-    # combine any people entries with the same jersey number, and remove the duplicates
-    def consolidate_people(self):
-        people = self.people
-
-        for person in people:
-
-            for other_person in people:
-
-                people[person]['seconds'].extend(
-                    people[other_person]['seconds'])
-                people[person]['seconds'].sort()
-
-                people[person]['bounds'].update(
-                    people[other_person]['bounds'])
-
-                people[person]['ids'].extend(
-                    people[other_person]['ids'])
-
-                people[other_person]['ids'] = []
-
-        people_to_remove = []
-
-        for person in people:
-
-            # next we remove duplicate labels
-            people[person]['ids'] = list(set(people[person]['ids']))
-            people[person]['seconds'] = list(
-                set(people[person]['seconds']))
-            people[person]['seconds'].sort()
-
-            # add the person to the removal list if they have no labels
-            if people[person]['ids'] == []:
-                people_to_remove.append(person)
-
-        # remove the people with no labels
-        for person in people_to_remove:
-            del people[person]
-
-    # scale the bounds up to a minimum size of 500x500 and keep the center of the bounding box the same
-    def scale_bounds(self, max_width, max_height):
-        for person in self.people:
+        with profiling.stage('track', count=sum(len(person) for person in self.people.values())):
+            self.consolidate_people()
+
+            for person in self.people.values():
+                person.sort()
+
+            self.filter_times(threshold)
+            # self.scale_bounds(max_width=width, max_height=height)
+            self.smooth_bounds()
+
+            # the renderer looks boxes up through a time-indexed track
+            for person in self.people.values():
+                person.track = bt.BoundsTrack(
+                    person.seconds.values, person.boxes.values)
+
+    # hand out the runs of detections that can't grow any more, for rendering while detections still arrive
+    def close_segments(self, now, threshold=2):
+        """
+        Returns (label, start_row, end_row) for every player whose latest run of detections
+        ended more than `threshold` seconds before `now`, the same gap filter_times splits
+        segments on. Each row is handed out once, pass now=math.inf to close every open run.
+        """
+        closed = []
+
+        for person in self.people.values():
+            if person.closed == len(person):
+                continue
 
-            for time in self.people[person]['bounds']:
+            if now - person.seconds.values[-1] > threshold:
+                closed.append((person.label, person.closed, len(person)))
+                person.closed = len(person)
 
-                x, y, w, h = self.people[person]['bounds'][time]
+        return closed
 
-                # Calculate the center of the bounding box
-                x_center = x + w / 2
-                y_center = y + h / 2
+    # the time segments and smoothed bounds track of a run of one player's detections, only the ones selected by `rows` when given
+    def segment_track(self, label, start_row, end_row, threshold=2, rows=None):
+        person = self.people[label]
+        seconds = person.seconds.values[start_row:end_row]
+        boxes = person.boxes.values[start_row:end_row]
+        if rows is not None:
+            seconds, boxes = seconds[rows], boxes[rows]
 
-                # Calculate the new width and height
-                new_w = max(max_width//1.5, w)
-                new_h = max(max_width//1.5, h)
+        order = latest_per_time(seconds)
+        seconds = seconds[order]
+        boxes = boxes[order]
 
-                # Ensure the x+width and y+height are less than the max_width and max_height
-                if x + new_w > max_width:
-                    new_w = max_width - x
-                if y + new_h > max_height:
-                    new_h = max_height - y
+        # the whole run is smoothed as one, only its spans near the ball are rendered
+        segment_times = self.segment_times(seconds, boxes)
 
-                # Calculate the new x and y
-                new_x = x_center - new_w / 2
-                new_y = y_center - new_h / 2
+        method, strength = self.smoothing
+        if method != 'none':
+            boxes = sm.smooth_boxes(seconds, boxes, method, strength)
 
-                self.people[person]['bounds'][time] = [
-                    new_x, new_y, new_w, new_h]
+        return time_segments(segment_times, threshold), bt.BoundsTrack(seconds, boxes)
 
-    # consolidate person time list into segments of times in tuples with a threshold of seconds
-    def filter_times(self, threshold=2):
+    # move every detection to the player its trace resolves to, and drop the players that were only misread
+    def consolidate_people(self):
+        """
+        A detection stays with its label when its trace read that label at least
+        min_label_reads times, which keeps both players of a trace the tracker moved from one
+        player to another. Otherwise it moves to the player resolve_identities gives its trace,
+        or its label when it has no trace id, and is dropped when there is none.
+        """
+        if not self.min_label_reads:
+            return
 
-        for key in self.people.keys():
+        identities = self.identities()
 
-            times = self.people[key]['seconds']
-            start_time = times[0]
+        merged = {}
+        for label, person in self.people.items():
+            trace_ids, inverse = np.unique(
+                person.trace_ids.values, return_inverse=True)
+            owners = self.trace_owners(label, trace_ids, identities)
 
-            for j in range(1, len(times)):
-                if times[j] - times[j - 1] > threshold:
-                    self.people[key]['time_segments'].append(
-                        (start_time, times[j - 1]))
-                    start_time = times[j]
+            for owner in set(owners) - {None}:
+                rows = np.array([other == owner for other in owners])[inverse]
+                merged.setdefault(owner, Player(owner)).extend(person, rows)
 
-            # Add the last segment
-            self.people[key]['time_segments'].append((start_time, times[-1]))
+        # same order as before, sorting in filter_map also drops the duplicate times merging made
+        self.people = {label: merged[label]
+                       for label in self.people if label in merged}
 
-    def average_bounds(self):
-        if self.smoothing <= 0:
-            return
+    # the players resolved from the labels read so far, see consolidate_people
+    def identities(self):
+        """ Returns (trace_owner, label_owner, strong_pairs), strong_pairs the (trace id, label) pairs read at least min_label_reads times. """
+        trace_owner, label_owner = resolve_identities(
+            self.trace_labels, self.label_reads, self.min_label_reads)
 
-        same_person_threshold = np.inf
-        times_before = 4
-        times_after = 4
+        strong_pairs = {(trace_id, label) for trace_id, labels in self.trace_labels.items()
+                        for label, count in labels.counts.items() if count >= self.min_label_reads}
 
-        for key in self.people.keys():
-            bounds = self.people[key]['bounds']
-            seconds = self.people[key]['seconds']
+        return trace_owner, label_owner, strong_pairs
 
-            for s in range(len(seconds)):
-                second = seconds[s]
+    # the player each of a label's trace ids belongs to, None where its detections are dropped
+    def trace_owners(self, label, trace_ids, identities):
+        trace_owner, label_owner, strong_pairs = identities
+        return [label if (trace_id, label) in strong_pairs else
+                trace_owner[trace_id] if trace_id in trace_owner else label_owner.get(label)
+                for trace_id in trace_ids.tolist()]
 
-                times_to_average = seconds[max(
-                    0, s - times_before):min(len(seconds), s + times_after + 1)]
+    # which rows of a run of a player's detections consolidate_people would leave with the player, going by the labels read so far
+    def owned_rows(self, label, start_row, end_row, identities):
+        trace_ids, inverse = np.unique(
+            self.people[label].trace_ids.values[start_row:end_row], return_inverse=True)
+        owners = self.trace_owners(label, trace_ids, identities)
+        return np.array([owner == label for owner in owners], dtype=bool)[inverse]
 
-                x_values = []
-                y_values = []
-                w_values = []
-                h_values = []
+    # scale the bounds up to a minimum size of 500x500 and keep the center of the bounding box the same
+    def scale_bounds(self, max_width, max_height):
+        for person in self.people.values():
 
-                x_start = bounds[second][0]
-                y_start = bounds[second][1]
-                w_start = bounds[second][2]
-                h_start = bounds[second][3]
+            x, y, w, h = person.boxes.values.T
 
-                x_current_center = bounds[second][0] + bounds[second][2] / 2
-                y_current_center = bounds[second][1] + bounds[second][3] / 2
+            # Calculate the center of the bounding box
+            x_center = x + w / 2
+            y_center = y + h / 2
 
-                # average distance between the centers of the bounding boxes
-                average_distance = 0
-                for time in times_to_average:
-                    x1, y1, w, h = bounds[time]
-                    x_center = x1 + w / 2
-                    y_center = y1 + h / 2
+            # Calculate the new width and height
+            new_w = np.maximum(max_width // 1.5, w)
+            new_h = np.maximum(max_width // 1.5, h)
 
-                    average_distance += np.sqrt((x_center - x_current_center)
-                                                ** 2 + (y_center - y_current_center)**2)
+            # Ensure the x+width and y+height are less than the max_width and max_height
+            new_w = np.where(x + new_w > max_width, max_width - x, new_w)
+            new_h = np.where(y + new_h > max_height, max_height - y, new_h)
 
-                same_person_threshold = average_distance / 2
+            # Calculate the new x and y
+            new_x = x_center - new_w / 2
+            new_y = y_center - new_h / 2
 
-                for time in times_to_average:
-                    x1, y1, w, h = bounds[time]
-                    x_center = x1 + w / 2
-                    y_center = y1 + h / 2
+            person.boxes.set(np.stack([new_x, new_y, new_w, new_h], axis=1))
 
-                    if abs(x_center - x_current_center) > same_person_threshold or \
-                            abs(y_center - y_current_center) > same_person_threshold:
-                        continue
+    # consolidate person time list into segments of times in tuples with a threshold of seconds
+    def filter_times(self, threshold=2):
 
-                    x_values.append(x1)
-                    y_values.append(y1)
-                    w_values.append(w)
-                    h_values.append(h)
+        for person in self.people.values():
 
-                x_mean = np.mean(x_values)
-                y_mean = np.mean(y_values)
-                w_mean = np.mean(w_values)
-                h_mean = np.mean(h_values)
+            # with a ball distance limit only the detections near the ball make segments
+            times = self.segment_times(
+                person.seconds.values, person.boxes.values)
 
-                bounds[times_to_average[0]] = [x_mean, y_mean, w_mean, h_mean]
+            # a segment ends wherever the gap to the next detection exceeds the threshold
+            person.time_segments.extend(time_segments(times, threshold))
 
+    # smooth every player's boxes with the filter picked by the smoothing setting, see smoothing.parse_smoothing
     def smooth_bounds(self):
-        if self.smoothing <= 0.0:
+        method, strength = self.smoothing
+        if method == 'none':
             return
 
-        self.average_bounds()
-
-        alpha = self.smoothing  # Smoothing factor. Adjust this to increase or decrease smoothing
-
-        for key in self.people.keys():
-            bounds = self.people[key]['bounds']
-            seconds = self.people[key]['seconds']
-            ema_bounds = {}
-
-            sorted_seconds = sorted(seconds)
-            if sorted_seconds:
-                ema_bounds[sorted_seconds[0]] = bounds[sorted_seconds[0]]
-
-            for i in range(1, len(sorted_seconds)):
-                current_time = sorted_seconds[i]
-                previous_time = sorted_seconds[i - 1]
-
-                previous_bounds = ema_bounds[previous_time]
-                current_bounds = bounds[current_time]
-
-                x1, y1, w, h = current_bounds
-                prev_x, prev_y, prev_w, prev_h = previous_bounds
-
-                # Calculate the exponential moving average
-                x_mean = alpha * x1 + (1 - alpha) * prev_x
-                y_mean = alpha * y1 + (1 - alpha) * prev_y
-                w_mean = alpha * w + (1 - alpha) * prev_w
-                h_mean = alpha * h + (1 - alpha) * prev_h
+        for person in self.people.values():
+            seconds = person.seconds.values
 
-                ema_bounds[current_time] = [x_mean, y_mean, w_mean, h_mean]
+            # each time segment is smoothed on its own
+            breaks = np.searchsorted(
+                seconds, [start for start, _ in person.time_segments[1:]])
 
-            # Update the original bounds with the smoothed values
-            # bounds.update(ema_bounds)
+            person.boxes.set(sm.smooth_boxes(
+                seconds, person.boxes.values, method, strength, breaks=breaks))
@@ -0,0 +1,220 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is reported as None there
+    resource = None
+
+#
+# profiling.py
+#
+# Wall time and counts per pipeline stage, collected while `enabled` is set by --profile.
+#  Stages are timed with `with profiling.stage('name'):` around the work. When profiling
+#  is off stage() hands back one shared no-op context manager, so instrumented hot loops
+#  only pay for a function call and a flag check.
+#
+# Stages recorded across the project:
+#   inference   waiting on EyePop for the next result
+#   ingest      adding results to the person tracker
+#   track       sorting, segmenting and smoothing in filter_map
+#   plan        laying out every output frame of a reel in movie_maker.get_render_plan
+#   seek        seeking the capture, counted per seek
+#   decode      grabbing and decoding source frames
+#   composite   compositing output frames
+#   encode      handing frames to the writer, including waits on a full ffmpeg pipe
+#   ffmpeg      waiting for ffmpeg to finish encoding, combining and concatenating
+#   colors      averaging region colors in VideoTools.get_average_colors, counted per region
+#   filtergraph whole renders run inside ffmpeg by the ffmpeg backend, counted per output frame
+#   decode_wait, composite_wait, write_wait
+#               stalls of the threaded render pipeline's stages, see movie_maker.composite_frames_threaded
+#
+# Gauges record sampled levels rather than durations, such as the depth of a queue, and are
+#  reported as their mean and maximum.
+#
+
+enabled = False
+
+# stage name -> [seconds, count]
+_stages = {}
+
+# gauge name -> [sum, samples, max]
+_gauges = {}
+
+# stages are added to from render threads too
+_lock = threading.Lock()
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage:
+
+    __slots__ = ('name', 'count', 'start')
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add(self.name, time.perf_counter() - self.start, self.count)
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    _stages.clear()
+    _gauges.clear()
+
+
+def stage(name, count=1):
+    """ Context manager adding its wall time and `count` items to stage `name`, a no-op when profiling is off. """
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name, count)
+
+
+def add(name, seconds, count=1):
+    """ Adds a measured duration and item count to stage `name`. """
+    if not enabled:
+        return
+    with _lock:
+        totals = _stages.get(name)
+        if totals is None:
+            totals = _stages[name] = [0.0, 0]
+        totals[0] += seconds
+        totals[1] += count
+
+
+def gauge(name, value):
+    """ Samples a level such as a queue depth for gauge `name`. """
+    if not enabled:
+        return
+    with _lock:
+        totals = _gauges.get(name)
+        if totals is None:
+            totals = _gauges[name] = [0.0, 0, value]
+        totals[0] += value
+        totals[1] += 1
+        totals[2] = max(totals[2], value)
+
+
+def snapshot():
+    """ A picklable copy of the stage and gauge totals, for worker processes to hand back to the parent. """
+    with _lock:
+        return {'stages': {name: list(totals) for name, totals in _stages.items()},
+                'gauges': {name: list(totals) for name, totals in _gauges.items()}}
+
+
+def merge(other):
+    """ Adds a snapshot taken in another process to the stage and gauge totals. """
+    for name, (seconds, n) in other['stages'].items():
+        add(name, seconds, n)
+
+    if not enabled:
+        return
+    with _lock:
+        for name, (total, samples, maximum) in other['gauges'].items():
+            totals = _gauges.setdefault(name, [0.0, 0, maximum])
+            totals[0] += total
+            totals[1] += samples
+            totals[2] = max(totals[2], maximum)
+
+
+def peak_rss():
+    """ Returns (this process, its children) peak resident set size in bytes, None when unknown. """
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def report():
+    """ The stage totals, gauges and peak RSS as a JSON-ready dict. """
+    stages = {}
+    for name, (seconds, n) in _stages.items():
+        stages[name] = {'seconds': seconds, 'count': n,
+                        'per_second': n / seconds if seconds > 0 and n else None}
+
+    gauges = {}
+    for name, (total, samples, maximum) in _gauges.items():
+        gauges[name] = {'mean': total / samples if samples else None,
+                        'max': maximum, 'samples': samples}
+
+    rss, children_rss = peak_rss()
+    return {'stages': stages, 'gauges': gauges, 'peak_rss_bytes': rss, 'peak_children_rss_bytes': children_rss}
+
+
+def format_report(stats):
+    """ Formats a report() as a table, stages by descending time. """
+    lines = [f"{'stage':<16}{'seconds':>10}{'count':>10}{'per second':>14}"]
+
+    for name, totals in sorted(stats['stages'].items(), key=lambda item: -item[1]['seconds']):
+        per_second = f"{totals['per_second']:.1f}" if totals['per_second'] is not None else '-'
+        lines.append(
+            f"{name:<16}{totals['seconds']:>10.3f}{totals['count']:>10}{per_second:>14}")
+
+    if stats.get('gauges'):
+        lines.append(f"{'gauge':<16}{'mean':>10}{'max':>10}")
+        for name, totals in sorted(stats['gauges'].items()):
+            lines.append(f"{name:<16}{totals['mean']:>10.1f}{totals['max']:>10}")
+
+    for label, key in (('peak RSS', 'peak_rss_bytes'), ('peak child RSS', 'peak_children_rss_bytes')):
+        if stats[key] is not None:
+            lines.append(f"{label}: {stats[key] / 1024 ** 2:.1f} MiB")
+
+    return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def hooks(cprofile_path=None, tracemalloc_top=0):
+    """
+    Optionally runs the body under cProfile, dumping the stats to `cprofile_path` and printing
+    the top functions by cumulative time, and under tracemalloc, printing the `tracemalloc_top`
+    source lines that allocated the most memory still held at the end.
+    """
+    profiler = cProfile.Profile() if cprofile_path else None
+
+    if tracemalloc_top:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(os.path.dirname(os.path.abspath(cprofile_path)), exist_ok=True)
+            profiler.dump_stats(cprofile_path)
+
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats(
+                'cumulative').print_stats(20)
+            print(summary.getvalue())
+
+        if tracemalloc_top:
+            allocations = tracemalloc.take_snapshot().statistics('lineno')
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"tracemalloc peak: {peak / 1024 ** 2:.1f} MiB")
+            for allocation in allocations[:tracemalloc_top]:
+                print(allocation)
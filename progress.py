@@ -0,0 +1,68 @@
+import time
+
+#
+# progress.py
+#
+# Rate-limited progress reporting for long loops such as rendering. update() is cheap enough
+#  to call once per frame; the callback only runs once every `interval` seconds and at the end.
+#
+
+
+def print_progress(label, done, total, rate, eta):
+    """ The default progress callback, one line per report. """
+    line = f"{label}: {done}/{total} frames" if total else f"{label}: {done} frames"
+    line += f", {rate:.1f} fps"
+    if eta is not None:
+        line += f", ETA {format_seconds(eta)}"
+    print(line, flush=True)
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class ProgressReporter:
+    """
+    Counts finished items and calls `callback(label, done, total, rate, eta)` at most once every
+    `interval` seconds, with the rate in items per second and the ETA in seconds (None when
+    `total` is unknown). finish() reports unless the last report already had the final count.
+    """
+
+    def __init__(self, total=None, label='render', interval=2.0, callback=print_progress):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.callback = callback
+
+        self.done = 0
+        self.reported = None
+        self.start = time.monotonic()
+        self.next_report = self.start + interval
+
+    def update(self, n=1):
+        self.done += n
+
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.report(now)
+
+    def report(self, now=None):
+        if self.callback is None:
+            return
+        self.reported = self.done
+
+        elapsed = (now or time.monotonic()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if self.total and rate > 0:
+            eta = max(0.0, (self.total - self.done) / rate)
+
+        self.callback(self.label, self.done, self.total, rate, eta)
+
+    def finish(self):
+        if self.reported != self.done:
+            self.report()
@@ -0,0 +1,263 @@
+import json
+import argparse as ap
+
+import numpy as np
+import cv2
+
+import video_tools as vt
+import video_writer as vw
+
+#
+# sampling.py
+#
+# Frame-sampled inference. Instead of uploading every frame, a shorter video made of every
+#  Nth frame, plus extra frames wherever the picture changes quickly, is sent to the pop.
+#  The results are mapped back onto the original timeline, and the renderer fills in the
+#  frames in between by interpolating each player's track (bounds_track 'linear').
+#
+# The report at the bottom compares the cached sampled run of a video against its cached
+#  full run: the share of each player's footage still found, how well the interpolated
+#  boxes match, and the share of frames sent:
+#
+#   python sampling.py --video game.mp4 --sample_every 5
+#
+
+# downscaled width the motion between frames is measured at
+MOTION_WIDTH = 160
+
+
+def signature(every=1, motion_threshold=None):
+    """ Cache signature suffix for a sampling setting, empty for full inference so its cache keys don't change. """
+    if every <= 1 and motion_threshold is None:
+        return ''
+    return json.dumps({'sample_every': every, 'sample_motion': motion_threshold}, sort_keys=True)
+
+
+def scale_count(count, every=1):
+    """
+    The number of a player's detections or label reads a run sampled every `every`th frame
+    sees where a full run sees `count`, so thresholds set for full runs keep the same players.
+    Never below 1 for a positive count. Frames sent early for motion only add to a sampled run.
+    """
+    if every <= 1 or count <= 0:
+        return count
+    return max(1, count // every)
+
+
+def motion(previous, frame):
+    """ Mean absolute difference of two small grayscale frames, 0-255. """
+    return float(cv2.absdiff(previous, frame).mean())
+
+
+def write_sampled_video(video_path, output_path, every=5, motion_threshold=None, min_every=1, start_seconds=None):
+    """
+    Writes every `every`th frame of the video to `output_path` at the original frame rate.
+    With `start_seconds`, only the frames after the one at that time are written, which is
+    how a resumed inference run uploads the rest of a video.
+
+    With `motion_threshold`, a frame is also sent early, though never less than `min_every`
+    frames after the last one sent, once the motion accumulated since the last frame sent
+    exceeds the threshold (mean absolute difference, 0-255, between consecutive
+    downscaled grayscale frames). Fast play then gets close to full sampling while still
+    play is sent at the base rate.
+
+    Returns (times, frame_rate, total_frames): the original time of each sampled frame.
+    """
+    cap = cv2.VideoCapture(video_path)
+    frame_rate = cap.get(cv2.CAP_PROP_FPS)
+
+    # index of the last frame skipped, -1 to skip none
+    skip_to = -1 if start_seconds is None else vt.time_to_frame(start_seconds, frame_rate)
+
+    times = []
+    total_frames = 0
+    since_sent = 0
+    accumulated = 0.0
+    previous = None
+
+    try:
+        with vw.open_writer('pipe', output_path, frame_rate) as writer:
+            while True:
+                if total_frames <= skip_to:
+                    # skipped frames are only grabbed, never decoded into an image
+                    if not cap.grab():
+                        break
+                    total_frames += 1
+                    continue
+
+                success, frame = cap.read()
+                if not success:
+                    break
+
+                if motion_threshold is not None:
+                    height = max(1, frame.shape[0] * MOTION_WIDTH // frame.shape[1])
+                    small = cv2.cvtColor(cv2.resize(
+                        frame, (MOTION_WIDTH, height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+                    if previous is not None:
+                        accumulated += motion(previous, small)
+                    previous = small
+
+                send = not times or since_sent + 1 >= every or (
+                    motion_threshold is not None and since_sent + 1 >= min_every and accumulated >= motion_threshold)
+
+                if send:
+                    writer.write(frame)
+                    times.append(total_frames / frame_rate)
+                    since_sent = 0
+                    accumulated = 0.0
+                else:
+                    since_sent += 1
+
+                total_frames += 1
+    finally:
+        cap.release()
+
+    return np.array(times), frame_rate, total_frames
+
+
+def remap_results(results, times, frame_rate):
+    """
+    Yields the results of a sampled video with their `seconds` moved back onto the original
+    video's timeline. `times` and `frame_rate` are what write_sampled_video returned.
+    """
+    last = len(times) - 1
+
+    for result in results:
+        if 'seconds' in result:
+            # the sampled video plays its frames back to back at the original frame rate
+            k = min(max(vt.time_to_frame(result['seconds'], frame_rate), 0), last)
+            result = dict(result, seconds=float(times[k]))
+        yield result
+
+
+#
+# Accuracy versus throughput report
+#
+
+
+def box_iou(a, b):
+    """ Intersection over union of matching rows of two N x 4 [x, y, w, h] arrays. """
+    left = np.maximum(a[:, 0], b[:, 0])
+    top = np.maximum(a[:, 1], b[:, 1])
+    right = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2])
+    bottom = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3])
+
+    intersection = np.clip(right - left, 0, None) * \
+        np.clip(bottom - top, 0, None)
+    union = a[:, 2] * a[:, 3] + b[:, 2] * b[:, 3] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+def segments_overlap(segments, others):
+    """ Seconds of `segments` also covered by `others`, both lists of sorted, disjoint (start, end) pairs. """
+    overlap = 0.0
+    j = 0
+    for start, end in segments:
+        while j < len(others) and others[j][1] < start:
+            j += 1
+        k = j
+        while k < len(others) and others[k][0] <= end:
+            overlap += max(0.0, min(end, others[k][1]) - max(start, others[k][0]))
+            k += 1
+    return overlap
+
+
+def compare_trackers(full_tracker, sampled_tracker, min_detections=30, interpolation='linear'):
+    """
+    Compares the players of a sampled run with a full run, both after filter_map.
+
+    For every player the full run renders, reports the share of its segment time the
+    sampled run also renders, and the mean IoU between the full run's boxes and the sampled
+    run's interpolated track at the full run's detection times.
+    """
+    players = {}
+
+    for label, full in full_tracker.people.items():
+        if len(full) < min_detections:
+            continue
+
+        full_seconds = sum(end - start for start, end in full.time_segments)
+        sampled = sampled_tracker.people.get(label)
+
+        if sampled is None or len(sampled) == 0:
+            players[label] = {'segment_seconds': full_seconds,
+                              'coverage': 0.0, 'mean_iou': None}
+            continue
+
+        boxes = sampled.track.resample(
+            full.seconds.values, interpolation=interpolation)
+        iou = box_iou(full.track.boxes, boxes)
+
+        players[label] = {
+            'segment_seconds': full_seconds,
+            'coverage': segments_overlap(full.time_segments, sampled.time_segments) / full_seconds if full_seconds > 0 else 1.0,
+            'mean_iou': float(iou.mean()),
+        }
+
+    matched = [player for player in players.values()
+               if player['mean_iou'] is not None]
+
+    return {
+        'players': players,
+        'players_found': len(matched),
+        'players_expected': len(players),
+        'mean_coverage': float(np.mean([player['coverage'] for player in players.values()])) if players else None,
+        'mean_iou': float(np.mean([player['mean_iou'] for player in matched])) if matched else None,
+    }
+
+
+if __name__ == "__main__":
+    import main
+    import person_tracker as pt
+    import inference_cache as ic
+    import inference_io as iio
+
+    args = ap.ArgumentParser(
+        description="Compare a frame-sampled inference run against a full run of the same video")
+    args.add_argument("--video", type=str, required=True)
+    args.add_argument("--sample_every", type=int, default=1)
+    args.add_argument("--sample_motion", type=float, default=None)
+    args.add_argument("--full", type=str, default=None,
+                      help="results of the full run, instead of the cached full run of the video")
+    args.add_argument("--sampled", type=str, default=None,
+                      help="results of the sampled run on the video's timeline, instead of the cached sampled run")
+    args.add_argument("--full_seconds", type=float, default=None,
+                      help="wall time of the full inference run, for the speedup")
+    args.add_argument("--sampled_seconds", type=float, default=None,
+                      help="wall time of the sampled inference run, for the speedup")
+    args.add_argument("--smoothing", type=str, default='.95')
+    args.add_argument("--cache_dir", type=str, default=ic.DEFAULT_CACHE_DIR)
+    args = args.parse_args()
+
+    cache = ic.InferenceCache(args.cache_dir)
+    runs = {
+        'full': iio.iter_results(args.full) if args.full else main.load_results(args.video, cache),
+        'sampled': iio.iter_results(args.sampled) if args.sampled else main.load_results(
+            args.video, cache, sample_every=args.sample_every, sample_motion=args.sample_motion),
+    }
+
+    trackers = {}
+    frames = {}
+    for name, results in runs.items():
+        if results is None:
+            raise SystemExit(f"No {name} run of {args.video} to compare")
+
+        results = list(results)
+        every = args.sample_every if name == 'sampled' else 1
+        tracker = pt.PersonTracker(smoothing=args.smoothing,
+                                   min_label_reads=scale_count(pt.MIN_LABEL_READS, every))
+        width, height = main.ingest_results(results, tracker)
+        tracker.filter_map(width, height)
+        trackers[name] = tracker
+        frames[name] = len(results)
+
+    report = compare_trackers(trackers['full'], trackers['sampled'])
+    report['frames_full'] = frames['full']
+    report['frames_sampled'] = frames['sampled']
+    report['frames_ratio'] = frames['sampled'] / \
+        frames['full'] if frames['full'] else None
+
+    if args.full_seconds and args.sampled_seconds:
+        report['speedup'] = args.full_seconds / args.sampled_seconds
+
+    print(json.dumps(report, indent=2))
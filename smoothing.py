@@ -0,0 +1,208 @@
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+
+#
+# smoothing.py
+#
+# Filters over whole (N x 4) arrays of [x, y, w, h] boxes, one row per detection in time
+#  order. Everything runs column-wise in NumPy / SciPy, there is no per-detection Python loop.
+#
+
+METHODS = ('none', 'ema', 'savgol', 'one_euro')
+
+# strength used when only a method name is given
+DEFAULT_STRENGTH = {
+    'none': 0.0,
+    'ema': 0.95,
+    'savgol': 15,
+    'one_euro': 1.0,
+}
+
+
+def parse_smoothing(value):
+    """
+    Parses the --smoothing value into a (method, strength) pair.
+
+    Accepts a bare number, kept as the original EMA factor (0 disables smoothing), or
+    'method' / 'method:strength' with method one of 'none', 'ema', 'savgol', 'one_euro':
+        ema:0.3      - EMA factor, the weight of the newest box. Values above 1 are read as a
+                       span in detections, alpha = 2 / (span + 1)
+        savgol:15    - Savitzky-Golay window length in detections
+        one_euro:1.0 - one-euro minimum cutoff frequency in Hz, lower is smoother
+    """
+    if isinstance(value, (int, float)):
+        return ('ema', float(value)) if value > 0 else ('none', 0.0)
+
+    method, _, strength = str(value).partition(':')
+    method = method.strip().lower().replace('-', '_')
+
+    try:
+        return parse_smoothing(float(method))
+    except ValueError:
+        pass
+
+    if method not in METHODS:
+        raise ValueError(
+            f"Unknown smoothing method '{method}', expected one of {', '.join(METHODS)}")
+
+    strength = float(strength) if strength else DEFAULT_STRENGTH[method]
+    if strength <= 0:
+        return ('none', 0.0)
+
+    return (method, strength)
+
+
+def ema(boxes, alpha):
+    """ Exponential moving average down the rows, y[n] = alpha * x[n] + (1 - alpha) * y[n - 1], started at x[0]. """
+    if alpha > 1:
+        alpha = 2.0 / (alpha + 1.0)
+
+    if len(boxes) == 0 or alpha >= 1:
+        return boxes.copy()
+
+    # the EMA is the linear filter b = [alpha], a = [1, alpha - 1], with its state primed so y[0] = x[0]
+    zi = (1.0 - alpha) * boxes[:1]
+    smoothed, _ = scipy.signal.lfilter(
+        [alpha], [1.0, alpha - 1.0], boxes, axis=0, zi=zi)
+    return smoothed
+
+
+def savgol(boxes, window=15, polyorder=2):
+    """ Savitzky-Golay filter down the rows, keeps peaks better than an EMA and adds no lag. """
+    window = int(min(window, len(boxes)))
+    if window % 2 == 0:
+        window -= 1
+    if window <= polyorder:
+        return boxes.copy()
+
+    return scipy.signal.savgol_filter(boxes, window, polyorder, axis=0, mode='interp')
+
+
+def _linear_recurrence(inputs, decays, block=16):
+    """
+    Solves y[n] = decays[n] * y[n - 1] + inputs[n] down the rows, with y[-1] = 0.
+
+    Inside fixed-size blocks the recursion has a closed form in cumulative products, solved for
+    all blocks at once. The value carried from block to block follows the same recursion
+    over the block ends, solved by the same function on an input `block` times shorter.
+    """
+    n = len(inputs)
+    padding = (-n) % block
+
+    # products of short blocks of clipped decays stay far from underflow, a decay below
+    #  1e-12 only drops contributions that are already negligible
+    decays = np.clip(decays, 1e-12, 1.0)
+    decays = np.concatenate((decays, np.ones(padding))).reshape(-1, block)
+    inputs = np.concatenate(
+        (inputs, np.zeros((padding,) + inputs.shape[1:]))).reshape((-1, block) + inputs.shape[1:])
+
+    # y[i] = P[i] * sum_k<=i inputs[k] / P[k] with P the running product of decays
+    products = np.cumprod(decays, axis=1)[:, :, None]
+    solved = products * np.cumsum(inputs / products, axis=1)
+
+    if len(solved) > 1:
+        block_ends = _linear_recurrence(
+            solved[:, -1], products[:, -1, 0], block=block)
+        solved[1:] += products[1:] * block_ends[:-1, None]
+
+    return solved.reshape((-1,) + inputs.shape[2:])[:n]
+
+
+def _varying_ema(values, alphas):
+    """ EMA with a different factor per row, y[n] = alphas[n] * values[n] + (1 - alphas[n]) * y[n - 1], y[0] = values[0]. """
+    if len(values) == 0:
+        return values.copy()
+
+    alphas = alphas.copy()
+    alphas[0] = 1.0
+
+    return _linear_recurrence(alphas[:, None] * values, 1.0 - alphas)
+
+
+def _cutoff_alpha(cutoff, dt):
+    tau = 1.0 / (2.0 * np.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+def one_euro(times, boxes, min_cutoff=1.0, beta=0.01, derivative_cutoff=1.0):
+    """
+    One-euro filter: an EMA whose cutoff rises with the speed of the box, so a still player
+    is held steady while a sprinting one is followed without lag.
+    """
+    if len(boxes) < 2:
+        return boxes.copy()
+
+    dt = np.diff(times, prepend=times[0])
+    dt[0] = dt[1:].min() if np.any(dt[1:] > 0) else 1.0
+    dt = np.maximum(dt, 1e-6)
+
+    # speed of each column, itself smoothed with a fixed cutoff
+    speed = np.diff(boxes, axis=0, prepend=boxes[:1]) / dt[:, None]
+    speed = _varying_ema(speed, _cutoff_alpha(derivative_cutoff, dt))
+
+    # one adaptive cutoff per row, driven by the fastest moving column
+    cutoff = min_cutoff + beta * np.abs(speed).max(axis=1)
+
+    return _varying_ema(boxes, _cutoff_alpha(cutoff, dt))
+
+
+def reject_outliers(boxes, window=9, threshold=1.0):
+    """
+    Replaces boxes whose center jumps away from the rolling median center by more than
+    `threshold` times the rolling median box height, typically a detection of another player
+    under the same label. Rejected rows are interpolated from their accepted neighbours.
+    """
+    if len(boxes) < 3:
+        return boxes.copy()
+
+    centers = boxes[:, :2] + boxes[:, 2:] / 2
+    median_centers = np.stack([scipy.ndimage.median_filter(
+        centers[:, i], size=window, mode='nearest') for i in range(2)], axis=1)
+    median_height = scipy.ndimage.median_filter(
+        boxes[:, 3], size=window, mode='nearest')
+
+    distance = np.linalg.norm(centers - median_centers, axis=1)
+    accepted = distance <= threshold * np.maximum(median_height, 1.0)
+
+    if accepted.all() or not accepted.any():
+        return boxes.copy()
+
+    rows = np.arange(len(boxes))
+    cleaned = boxes.copy()
+    for column in range(boxes.shape[1]):
+        cleaned[~accepted, column] = np.interp(
+            rows[~accepted], rows[accepted], boxes[accepted, column])
+
+    return cleaned
+
+
+def smooth_boxes(times, boxes, method, strength, breaks=None):
+    """
+    Rejects outliers and applies `method` to the boxes, returning a new float64 array.
+
+    `breaks` are the row indices where a new time segment starts. Each segment is filtered
+    on its own so a filter never blends a player's position across a gap in the footage.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+
+    if method == 'none' or len(boxes) == 0:
+        return boxes.copy()
+
+    edges = [0, *(breaks if breaks is not None else []), len(boxes)]
+    smoothed = np.empty_like(boxes)
+
+    for start, end in zip(edges[:-1], edges[1:]):
+        run = reject_outliers(boxes[start:end])
+
+        if method == 'ema':
+            run = ema(run, strength)
+        elif method == 'savgol':
+            run = savgol(run, window=strength)
+        elif method == 'one_euro':
+            run = one_euro(times[start:end], run, min_cutoff=strength)
+
+        smoothed[start:end] = run
+
+    return smoothed
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import bounds_track as bt
+import movie_maker as mm
+
+
+def reference_box(time_bounds, t, interpolation):
+    """ The box at `t` worked out by scanning every detection, as the dict lookup did. """
+    times = sorted(time_bounds)
+    if interpolation == 'nearest':
+        return time_bounds[min(time_bounds, key=lambda x: abs(x - t))]
+
+    earlier = [x for x in times if x <= t]
+    later = [x for x in times if x > t]
+    if not earlier:
+        return time_bounds[times[0]]
+    if not later:
+        return time_bounds[times[-1]]
+    if interpolation == 'hold':
+        return time_bounds[earlier[-1]]
+
+    t0, t1 = earlier[-1], later[0]
+    fraction = (t - t0) / (t1 - t0)
+    return [a * (1 - fraction) + b * fraction for a, b in zip(time_bounds[t0], time_bounds[t1])]
+
+
+@pytest.mark.parametrize('interpolation', bt.INTERPOLATIONS)
+def test_resample_matches_a_scan_over_the_detections(interpolation):
+    rng = np.random.default_rng(0)
+    # unsorted, as detections of merged traces arrive
+    time_bounds = {float(t): rng.uniform(0, 500, size=4).tolist() for t in rng.uniform(0, 20, size=200)}
+    track = bt.BoundsTrack.from_dict(time_bounds)
+
+    times = np.concatenate([rng.uniform(-2, 22, size=500), list(time_bounds)[:20]])
+    boxes = track.resample(times, interpolation=interpolation)
+
+    for t, box in zip(times, boxes):
+        assert np.allclose(box, reference_box(time_bounds, t, interpolation))
+        assert np.allclose(mm.get_bounds_at_time(track, t, interpolation=interpolation), box)
+
+
+def test_nearest_picks_the_earlier_detection_on_a_tie():
+    track = bt.BoundsTrack([2.0, 1.0], [[2, 2, 2, 2], [1, 1, 1, 1]])
+    assert track.at(1.5, interpolation='nearest').tolist() == [1, 1, 1, 1]
+
+
+def test_empty_track():
+    track = bt.BoundsTrack([], [])
+    assert track.resample([]).shape == (0, 4)
+    with pytest.raises(ValueError):
+        track.at(1.0)
+
+
+def test_get_bounds_at_time_needs_a_track():
+    with pytest.raises(TypeError):
+        mm.get_bounds_at_time({0.0: [1, 2, 3, 4]}, 0.0)
@@ -0,0 +1,231 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip('eyepop')
+pytest.importorskip('aiofiles')
+
+import batch
+import eyepop_manager as em
+import inference_cache as ic
+import inference_io as iio
+
+
+class ReplayEndpoint:
+    """
+    A local stand-in for the asynchronous EyePop endpoint. Accepts the pop setup calls and
+    answers each upload by replaying the results `results_for(location)` returns. The first
+    `failures[location]` uploads of a location fail with a ConnectionError, and the first
+    `drops[location]` jobs of a location fail with one halfway through their results.
+    """
+
+    def __init__(self, results_for, failures=None, drops=None):
+        self.results_for = results_for
+        self.failures = dict(failures or {})
+        self.drops = dict(drops or {})
+        self.uploads = []
+        self.cancelled = []
+        self.manifest = []
+        self.models = []
+        self.pop_comp = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+    async def get_manifest(self):
+        return list(self.manifest)
+
+    async def set_manifest(self, manifest):
+        self.manifest = manifest
+
+    async def load_model(self, model_definition):
+        self.models.append(model_definition)
+
+    async def set_pop_comp(self, pop_comp):
+        self.pop_comp = pop_comp
+
+    async def upload(self, location):
+        self.uploads.append(location)
+        if self.failures.get(location, 0) > 0:
+            self.failures[location] -= 1
+            raise ConnectionError(f"upload of {location} dropped")
+        results = self.results_for(location)
+        drop_after = None
+        if self.drops.get(location, 0) > 0:
+            self.drops[location] -= 1
+            drop_after = len(results) // 2
+        return ReplayJob(iter(results), drop_after, lambda: self.cancelled.append(location))
+
+
+class ReplayJob:
+
+    def __init__(self, results, drop_after=None, on_cancel=None):
+        self.results = results
+        self.drop_after = drop_after
+        self.on_cancel = on_cancel
+        self.count = 0
+
+    async def predict(self):
+        await asyncio.sleep(0)
+        if self.count == self.drop_after:
+            raise ConnectionError("job dropped")
+        self.count += 1
+        return next(self.results, None)
+
+    async def cancel(self):
+        self.results = iter(())
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+
+def make_results(location, frames=100):
+    return [{'seconds': frame / 10, 'source_width': 640, 'source_height': 360,
+             'objects': [{'classLabel': 'person', 'x': frame, 'y': 10, 'width': 20, 'height': 40,
+                          'traceId': hash(location) % 1000}]}
+            for frame in range(frames)]
+
+
+def test_analyze_videos_configures_each_connection(tmp_path):
+    endpoints = []
+
+    def endpoint_factory():
+        endpoints.append(ReplayEndpoint(make_results))
+        return endpoints[-1]
+
+    jobs = [(f"video{i}.mp4", str(tmp_path / f"video{i}.jsonl")) for i in range(5)]
+    outcomes = asyncio.run(em.analyze_videos(jobs, concurrency=4, connections=2,
+                                             endpoint_factory=endpoint_factory))
+
+    assert outcomes == {location: None for location, _ in jobs}
+    assert len(endpoints) == 2
+    assert all(endpoint.pop_comp == em.POP_COMP for endpoint in endpoints)
+    assert all(len(endpoint.models) == len(em.MODEL_DEFINITIONS) for endpoint in endpoints)
+    assert sorted(location for endpoint in endpoints for location in endpoint.uploads) == \
+        sorted(location for location, _ in jobs)
+
+    for location, output_path in jobs:
+        assert list(iio.iter_results(output_path)) == make_results(location)
+        assert iio.read_checkpoint(output_path)['complete']
+
+
+def test_analyze_videos_retries_failed_uploads(tmp_path):
+    endpoint = ReplayEndpoint(make_results, failures={'flaky.mp4': 2, 'broken.mp4': 10})
+    jobs = [(name, str(tmp_path / (name + '.jsonl'))) for name in ('flaky.mp4', 'steady.mp4', 'broken.mp4')]
+
+    outcomes = asyncio.run(em.analyze_videos(jobs, concurrency=2, retries=3, backoff=0,
+                                             endpoint_factory=lambda: endpoint))
+
+    assert outcomes['flaky.mp4'] is None
+    assert outcomes['steady.mp4'] is None
+    assert isinstance(outcomes['broken.mp4'], ConnectionError)
+    assert endpoint.uploads.count('flaky.mp4') == 3
+    assert endpoint.uploads.count('broken.mp4') == 4
+
+    assert list(iio.iter_results(jobs[0][1])) == make_results('flaky.mp4')
+    # a video that never finished leaves no partial log behind
+    assert not os.path.exists(jobs[2][1])
+
+
+def test_analyze_videos_cancels_a_dropped_job_before_retrying_it(tmp_path):
+    endpoint = ReplayEndpoint(make_results, drops={'flaky.mp4': 1})
+    jobs = [('flaky.mp4', str(tmp_path / 'flaky.jsonl'))]
+
+    outcomes = asyncio.run(em.analyze_videos(jobs, retries=1, backoff=0,
+                                             endpoint_factory=lambda: endpoint))
+
+    assert outcomes == {'flaky.mp4': None}
+    assert endpoint.uploads == ['flaky.mp4', 'flaky.mp4']
+    assert endpoint.cancelled == ['flaky.mp4']
+    assert list(iio.iter_results(jobs[0][1])) == make_results('flaky.mp4')
+
+
+class BrokenSetupEndpoint(ReplayEndpoint):
+    """ An endpoint whose pop setup fails. """
+
+    async def get_manifest(self):
+        raise ConnectionError("manifest unavailable")
+
+
+def test_analyze_videos_retries_failed_connections(tmp_path):
+    attempts = []
+
+    def endpoint_factory():
+        # the first connection can't be opened, the second can't be configured
+        attempts.append(len(attempts))
+        if len(attempts) == 1:
+            raise ConnectionError("refused")
+        if len(attempts) == 2:
+            return BrokenSetupEndpoint(make_results)
+        return ReplayEndpoint(make_results)
+
+    jobs = [(f"video{i}.mp4", str(tmp_path / f"video{i}.jsonl")) for i in range(3)]
+    outcomes = asyncio.run(em.analyze_videos(jobs, concurrency=2, retries=2, backoff=0,
+                                             endpoint_factory=endpoint_factory))
+
+    assert outcomes == {location: None for location, _ in jobs}
+    assert len(attempts) == 3
+    for location, output_path in jobs:
+        assert list(iio.iter_results(output_path)) == make_results(location)
+
+
+def test_analyze_videos_fails_the_jobs_of_connections_that_give_up(tmp_path):
+    attempts = []
+
+    def endpoint_factory():
+        attempts.append(len(attempts))
+        raise ConnectionError("refused")
+
+    jobs = [(f"video{i}.mp4", str(tmp_path / f"video{i}.jsonl")) for i in range(4)]
+    outcomes = asyncio.run(em.analyze_videos(jobs, concurrency=2, connections=2, retries=1, backoff=0,
+                                             endpoint_factory=endpoint_factory))
+
+    # every video gets an outcome instead of the whole batch raising
+    assert sorted(outcomes) == sorted(location for location, _ in jobs)
+    assert all(isinstance(error, ConnectionError) for error in outcomes.values())
+    assert len(attempts) == 4
+    assert not any(os.path.exists(output_path) for _, output_path in jobs)
+
+    # a connection that gives up leaves its share to the one that works
+    healthy = ReplayEndpoint(make_results)
+    factories = iter([endpoint_factory, lambda: healthy])
+    outcomes = asyncio.run(em.analyze_videos(jobs, concurrency=2, connections=2, retries=0, backoff=0,
+                                             endpoint_factory=lambda: next(factories)()))
+    assert outcomes == {location: None for location, _ in jobs}
+    assert sorted(healthy.uploads) == sorted(location for location, _ in jobs)
+
+
+def test_batch_analyze_fills_the_cache(tmp_path):
+    videos = []
+    for name in ('a', 'b', 'c'):
+        video_path = tmp_path / (name + '.mp4')
+        video_path.write_bytes(name.encode() * 1000)
+        videos.append(str(video_path))
+
+    options = {'sample_every': 1, 'sample_motion': None,
+               'cache_dir': str(tmp_path / 'cache'), 'cache_size': ic.DEFAULT_MAX_BYTES}
+    jobs, records = batch.plan_jobs([(video, None, None) for video in videos],
+                                    str(tmp_path / 'batch'), options, analyze=True)
+    assert len(jobs) == 3 and not records
+
+    endpoint = ReplayEndpoint(make_results, failures={videos[0]: 1, videos[2]: 10})
+    jobs, failed = batch.analyze_jobs(jobs, connections=2, concurrency=2, progress_callback=None,
+                                      endpoint_factory=lambda: endpoint, retries=1, backoff=0)
+
+    assert [job['video'] for job in jobs] == videos[:2]
+    assert [record['video'] for record in failed] == videos[2:]
+    assert failed[0]['status'] == 'failed'
+
+    cache = ic.InferenceCache(options['cache_dir'])
+    signature = em.pop_signature()
+    for video in videos[:2]:
+        assert batch.is_cached(video, options)
+        assert [result['seconds'] for result in cache.get(video, signature)] == \
+            [result['seconds'] for result in make_results(video)]
+    assert not batch.is_cached(videos[2], options)
+
+    # the logs were packed into the cache entries
+    assert not [name for name in os.listdir(options['cache_dir']) if name.endswith('.jsonl')]
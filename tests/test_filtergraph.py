@@ -0,0 +1,100 @@
+import re
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+import filtergraph
+import movie_maker as mm
+import video_tools as vt
+import video_writer as vw
+
+
+def evaluate(expression, n):
+    """ Evaluates a frame_expression or select_expression for frame number `n`. """
+    tokens = re.findall(r'[a-z]+|\d+|[(),+]', expression.replace('\\,', ','))
+    position = 0
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def arguments():
+        take()  # (
+        values = [term()]
+        while take() == ',':
+            values.append(term())
+        return values
+
+    def term():
+        token = take()
+        if token.isdigit():
+            value = int(token)
+        elif token == 'n':
+            value = n
+        else:
+            args = arguments()
+            value = {'if': lambda: args[1] if args[0] else args[2],
+                     'lt': lambda: int(args[0] < args[1]),
+                     'between': lambda: int(args[1] <= args[0] <= args[2])}[token]()
+        while position < len(tokens) and tokens[position] == '+':
+            take()
+            value += term()
+        return value
+
+    return term()
+
+
+def test_select_expression_passes_exactly_the_given_frames():
+    frames = [3, 4, 5, 9, 12, 13, 40]
+    expression = filtergraph.select_expression(frames)
+    assert expression.count('between') == 4
+    assert [n for n in range(50) if evaluate(expression, n)] == frames
+
+
+def test_frame_expression_gives_each_frames_value():
+    rng = np.random.default_rng(0)
+    for count in (1, 2, 7, 64, 300):
+        values = np.repeat(rng.integers(0, 500, size=count), rng.integers(1, 4, size=count)).tolist()
+        expression = filtergraph.frame_expression(values)
+        assert [evaluate(expression, n) for n in range(len(values))] == values
+
+
+LEVELS = 30
+
+
+@pytest.fixture(scope='module')
+def video_path(tmp_path_factory):
+    """ A video whose frame k is filled with gray level 8 * k, so a render shows which frame it picked. """
+    path = str(tmp_path_factory.mktemp('video') / 'levels.avi')
+    with vw.open_writer('opencv', path, 30, fourcc='MJPG') as writer:
+        for k in range(LEVELS):
+            writer.write(np.full((180, 320, 3), 8 * k, dtype=np.uint8))
+    return path
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs an ffmpeg binary")
+@pytest.mark.parametrize('segments', [[(0.0, 0.3)], [(0.3, 0.5), (0.6, 0.9)]])
+def test_render_picks_the_selected_frames(video_path, tmp_path, segments):
+    reader = vt.FrameReader(video_path)
+    frame_times = reader.segment_frames(segments)
+    plan = mm.get_render_plan((reader.width, reader.height), (360, 300),
+                              np.tile([[100, 40, 40, 80]], (len(frame_times), 1)))
+    reader.release()
+
+    output_path = str(tmp_path / 'out.mp4')
+    mm.render_with_ffmpeg(video_path, output_path, frame_times, plan, 30)
+
+    capture = cv2.VideoCapture(output_path)
+    levels = []
+    while True:
+        read, frame = capture.read()
+        if not read:
+            break
+        # a corner of the blurred background, away from the sprite
+        levels.append(frame[-20:, -20:].mean() / 8)
+    capture.release()
+
+    assert np.allclose(levels, [frame_index for _, frame_index in frame_times], atol=0.5)
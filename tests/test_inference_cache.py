@@ -0,0 +1,57 @@
+import os
+import time
+
+import inference_cache as ic
+
+
+def make_file(folder, name, size, age):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as cache_file:
+        cache_file.write(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_results_round_trip_through_the_cache(tmp_path):
+    video_path = tmp_path / 'video.mp4'
+    video_path.write_bytes(b'video' * 100)
+    results = [{'seconds': 0.5, 'source_width': 640, 'source_height': 360, 'objects': [
+        {'classLabel': 'person', 'traceId': 3, 'x': 1.0, 'y': 2.0, 'width': 3.0, 'height': 4.0,
+         'objects': [{'classLabel': 'text', 'labels': [{'label': '7'}, {'label': '71'}]}]},
+        {'classLabel': 'person', 'x': 5.0, 'y': 6.0, 'width': 7.0, 'height': 8.0},
+        {'classLabel': 'sports ball', 'confidence': 0.25, 'x': 9.0, 'y': 9.0, 'width': 2.0, 'height': 2.0},
+        {'classLabel': 'sports ball', 'confidence': 0.75, 'x': 20.0, 'y': 9.0, 'width': 2.0, 'height': 2.0},
+    ]}, {'seconds': 1.0, 'source_width': 640, 'source_height': 360, 'objects': []}]
+
+    cache = ic.InferenceCache(str(tmp_path / 'cache'))
+    assert cache.get(str(video_path), 'pop') is None
+    cache.put(str(video_path), 'pop', iter(results))
+
+    assert list(cache.get(str(video_path), 'pop')) == results
+    assert cache.get(str(video_path), 'other pop') is None
+
+
+def test_evict_removes_whole_keys_least_recently_used_first(tmp_path):
+    cache_dir = str(tmp_path)
+    cache = ic.InferenceCache(cache_dir, max_bytes=2500)
+    old, running, writing, newer, kept = (letter * 64 for letter in 'abcde')
+
+    # an old entry with the stale log of an earlier run
+    make_file(cache_dir, old + '.npz', 1000, 9000)
+    make_file(cache_dir, old + '.jsonl', 500, 8000)
+    make_file(cache_dir, old + '.jsonl.checkpoint', 10, 8000)
+    # an inference still writing its log, next to an older sampled upload
+    make_file(cache_dir, running + '.jsonl', 1000, 10)
+    make_file(cache_dir, running + '.sampled.mp4', 1000, 7200)
+    # an entry another process is writing, not counted
+    make_file(cache_dir, writing + '.npz.tmp.npz', 5000, 9999)
+    make_file(cache_dir, newer + '.npz', 400, 100)
+    keep = make_file(cache_dir, kept + '.npz', 1000, 0)
+    make_file(cache_dir, 'digests.json', 10, 9999)
+
+    cache.evict(keep=keep)
+
+    assert sorted(os.listdir(cache_dir)) == sorted([
+        running + '.jsonl', running + '.sampled.mp4', writing + '.npz.tmp.npz',
+        kept + '.npz', 'digests.json'])
@@ -0,0 +1,98 @@
+import io
+import json
+import os
+
+import pytest
+
+import inference_io as iio
+
+
+def make_results(count, start=0):
+    # labels with brackets, commas and escapes, which a naive splitter would cut on
+    return [{'seconds': (start + i) / 30, 'source_width': 1920, 'source_height': 1080,
+             'objects': [{'classLabel': 'person', 'x': i, 'y': 2.5, 'width': 10, 'height': 20,
+                          'objects': [{'classLabel': 'text', 'labels': [{'label': f'{i}], ["x", \\"y\\"'}]}]}]}
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1000, 1 << 20])
+def test_iter_json_array_across_chunk_boundaries(chunk_size):
+    results = make_results(20)
+    for text in (json.dumps(results, indent=4), json.dumps(results, separators=(',', ':')),
+                 '\n  ' + json.dumps(results) + '\n'):
+        assert list(iio._iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == results
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 20])
+def test_iter_json_array_empty_and_truncated(chunk_size):
+    assert list(iio._iter_json_array(io.StringIO(' [ ] '), chunk_size=chunk_size)) == []
+
+    text = json.dumps(make_results(3))
+    with pytest.raises(ValueError):
+        list(iio._iter_json_array(io.StringIO(text[:-1]), chunk_size=chunk_size))
+    with pytest.raises(ValueError):
+        list(iio._iter_json_array(io.StringIO(text[:len(text) // 2]), chunk_size=chunk_size))
+    with pytest.raises(ValueError):
+        list(iio._iter_json_array(io.StringIO('{"seconds": 0}'), chunk_size=chunk_size))
+
+
+def test_iter_results_reads_both_formats(tmp_path):
+    results = make_results(10)
+
+    array_path = tmp_path / 'data.json'
+    array_path.write_text(json.dumps(results, indent=2))
+    assert list(iio.iter_results(str(array_path))) == results
+
+    lines_path = str(tmp_path / 'data.jsonl')
+    with iio.ResultWriter(lines_path) as writer:
+        writer.write_many(results)
+    assert list(iio.iter_results(lines_path)) == results
+    assert iio.read_checkpoint(lines_path)['complete']
+
+
+def test_result_writer_resumes_after_a_torn_line(tmp_path):
+    path = str(tmp_path / 'data.jsonl')
+    results = make_results(12)
+
+    # a run that checkpointed 5 results, wrote 3 more and died halfway through the next line
+    writer = iio.ResultWriter(path, checkpoint_interval=3600)
+    writer.write_many(results[:5])
+    writer.checkpoint()
+    writer.write_many(results[5:8])
+    writer.file.write(json.dumps(results[8])[:25])
+    writer.file.flush()
+
+    checkpoint = iio.read_checkpoint(path)
+    assert checkpoint['count'] == 5
+    assert checkpoint['seconds'] == results[4]['seconds']
+    assert not checkpoint['complete']
+
+    resumed = iio.ResultWriter(path, resume=True)
+    assert resumed.count == 5
+    assert resumed.last_seconds == results[4]['seconds']
+    resumed.write_many(results[5:])
+    resumed.close()
+
+    assert list(iio.iter_results(path)) == results
+    assert iio.read_checkpoint(path) == {'offset': os.path.getsize(path), 'count': 12,
+                                         'seconds': results[-1]['seconds'], 'complete': True}
+
+
+def test_result_writer_starts_over_without_a_usable_checkpoint(tmp_path):
+    path = str(tmp_path / 'data.jsonl')
+
+    with iio.ResultWriter(path) as writer:
+        writer.write_many(make_results(5))
+
+    # a log shorter than its checkpoint was rewritten by someone else
+    with open(path, "w") as log_file:
+        log_file.write(json.dumps(make_results(1)[0]) + '\n')
+    assert iio.read_checkpoint(path) is None
+
+    resumed = iio.ResultWriter(path, resume=True)
+    assert resumed.count == 0
+    resumed.close()
+    assert list(iio.iter_results(path)) == []
+
+    iio.remove_log(path)
+    assert not os.path.exists(path) and not os.path.exists(iio.checkpoint_path(path))
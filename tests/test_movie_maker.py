@@ -0,0 +1,140 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import movie_maker as mm
+import twod
+import video_tools as vt
+import video_writer as vw
+
+WIDTH, HEIGHT, FPS = 640, 360, 30
+
+
+@pytest.fixture(scope='module')
+def video_path(tmp_path_factory):
+    """ A short video of noise, so every frame and every crop of it differs. """
+    path = str(tmp_path_factory.mktemp('video') / 'noise.mp4')
+    rng = np.random.default_rng(0)
+    with vw.open_writer('opencv', path, FPS) as writer:
+        for _ in range(60):
+            writer.write(rng.integers(0, 255, size=(HEIGHT, WIDTH, 3), dtype=np.uint8))
+    return path
+
+
+def random_boxes(count, seed):
+    rng = np.random.default_rng(seed)
+    w = rng.uniform(10, 300, size=count)
+    h = rng.uniform(10, 340, size=count)
+    x = rng.uniform(-50, WIDTH, size=count)
+    y = rng.uniform(-50, HEIGHT, size=count)
+    return np.stack([x, y, w, h], axis=1)
+
+
+def dict_layout(frame_size, box):
+    """ The layout of one output frame with the dict rect functions, as compose_frame worked it out per frame. """
+    frame_rect = twod.get_rect(x=0, y=0, w=frame_size[0], h=frame_size[1])
+    bounds_rect = twod.get_rect(x=box[0], y=box[1], w=box[2], h=box[3])
+
+    roi_size = min(max(500, int(bounds_rect['max_dim'] + 2 * 200)), frame_rect['min_dim'])
+    roi_rect = twod.get_rect_clamped_inside_another_rect(
+        center_x=bounds_rect['center_x'], center_y=bounds_rect['center_y'], w=roi_size, h=roi_size, outer_rect=frame_rect)
+
+    sprite_size = min(max(20, int(box[2] * 0.3)), 50)
+    sprite_rect = twod.get_rect_clamped_inside_another_rect(
+        center_x=bounds_rect['center_x'], center_y=bounds_rect['top'] - sprite_size / 2, w=sprite_size, h=sprite_size,
+        outer_rect=roi_rect)
+
+    return [[rect[name] for name in ('x', 'y', 'w', 'h')] for rect in (bounds_rect, roi_rect, sprite_rect)]
+
+
+@pytest.mark.parametrize('frame_size', [(WIDTH, HEIGHT), (1920, 1080), (400, 900)])
+def test_render_plan_matches_the_dict_layout(frame_size, tmp_path):
+    boxes = random_boxes(2000, seed=frame_size[0])
+    plan = mm.get_render_plan(frame_size, (720, 600), boxes)
+
+    for k, box in enumerate(boxes):
+        assert [list(rect) for rect in plan.layout(k)] == dict_layout(frame_size, box)
+
+    plan.save(str(tmp_path / 'plan.npz'))
+    loaded = mm.load_render_plan(str(tmp_path / 'plan.npz'))
+    assert [loaded.layout(k) for k in range(len(loaded))] == [plan.layout(k) for k in range(len(plan))]
+
+
+def render(video_path, threads):
+    reader = vt.FrameReader(video_path)
+    # two targets sharing frames, one of them with a gap
+    frame_times = {
+        'a': reader.segment_frames([(0.0, 1.5)]),
+        'b': reader.segment_frames([(0.5, 0.9), (1.2, 1.9)]),
+    }
+    plans = {key: mm.get_render_plan((WIDTH, HEIGHT), (720, 600), random_boxes(len(times), seed=i))
+             for i, (key, times) in enumerate(frame_times.items())}
+
+    with reader:
+        if threads:
+            outputs = mm.composite_frames_threaded(reader, frame_times, plans, draw_bounds=True, threads=threads)
+        else:
+            outputs = mm.composite_frames(reader, frame_times, plans, draw_bounds=True)
+        return [(key, output.copy()) for key, output in outputs]
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_composite_frames_threaded_matches_composite_frames(video_path, threads):
+    expected = render(video_path, 0)
+    outputs = render(video_path, threads)
+
+    assert len(expected) > 60
+    assert [key for key, _ in outputs] == [key for key, _ in expected]
+    for (_, output), (_, expected_output) in zip(outputs, expected):
+        assert np.array_equal(output, expected_output)
+
+
+def test_composite_frames_threaded_stops_when_closed_early(video_path):
+    reader = vt.FrameReader(video_path)
+    frame_times = {'a': reader.segment_frames([(0.0, 1.9)])}
+    plans = {'a': mm.get_render_plan((WIDTH, HEIGHT), (720, 600), random_boxes(len(frame_times['a']), seed=0))}
+
+    threads_before = threading.active_count()
+    with reader:
+        outputs = mm.composite_frames_threaded(reader, frame_times, plans, threads=2)
+        for _ in range(5):
+            next(outputs)
+        assert threading.active_count() > threads_before
+        outputs.close()
+
+    # the decoder and compositors are joined, not left blocked on a full queue
+    assert threading.active_count() == threads_before
+
+
+class CountingReader(vt.FrameReader):
+    """ A FrameReader that counts the frames decoded. """
+
+    def __init__(self, video_path):
+        super().__init__(video_path)
+        self.reads = 0
+
+    def read(self, frame_index, out=None):
+        self.reads += 1
+        return super().read(frame_index, out=out)
+
+
+@pytest.mark.parametrize('draw_bounds', [False, True])
+def test_composite_frames_threaded_runs_a_bounded_way_ahead_of_a_slow_writer(video_path, draw_bounds):
+    threads = 2
+    pool_size = mm.QUEUE_FRAMES_PER_THREAD * threads + threads + 1
+
+    reader = CountingReader(video_path)
+    frame_times = {'a': reader.segment_frames([(0.0, 1.9)])}
+    plans = {'a': mm.get_render_plan((WIDTH, HEIGHT), (720, 600), random_boxes(len(frame_times['a']), seed=0))}
+    assert len(frame_times['a']) > 4 * pool_size
+
+    with reader:
+        outputs = mm.composite_frames_threaded(reader, frame_times, plans, draw_bounds=draw_bounds, threads=threads)
+        for written in range(1, 6):
+            next(outputs)
+            time.sleep(0.1)
+            assert reader.reads <= written + pool_size
+
+        outputs.close()
@@ -0,0 +1,138 @@
+import numpy as np
+
+import person_tracker as pt
+
+
+def test_growable_array_grows_again_after_being_emptied():
+    for width, value in ((None, 1.5), (4, [1, 2, 3, 4])):
+        array = pt.GrowableArray(np.float64, width=width, capacity=2)
+        array.extend([value] * 3)
+        array.set([])
+        assert len(array) == 0
+        assert array.values.shape == ((0,) if width is None else (0, width))
+
+        for _ in range(5):
+            array.append(value)
+        array.extend([value] * 7)
+        assert len(array) == 12
+        assert np.array_equal(array.values, np.array([value] * 12))
+
+
+def trace_labels_from(reads):
+    """ TraceLabels per trace id from (trace id, label) reads in the order they arrive. """
+    trace_labels = {}
+    for trace_id, label in reads:
+        trace_labels.setdefault(trace_id, pt.TraceLabels()).observe(label)
+    return trace_labels
+
+
+def reference_resolve_identities(trace_labels, label_reads, min_reads):
+    """ The same heaviest-first grouping, every group a set that is copied to all its members on a join. """
+    edges = sorted(((count, trace_id, label) for trace_id, labels in trace_labels.items()
+                    for label, count in labels.counts.items()), key=lambda edge: -edge[0])
+
+    nodes = [('trace', trace_id) for trace_id in trace_labels] + [('label', label) for label in label_reads]
+    groups = {node: {node} for node in nodes}
+
+    def strong_labels(group):
+        return [label for kind, label in group if kind == 'label' and label_reads[label] >= min_reads]
+
+    for _, trace_id, label in edges:
+        a, b = groups[('trace', trace_id)], groups[('label', label)]
+        if a is b or (strong_labels(a) and strong_labels(b)):
+            continue
+        joined = a | b
+        for node in joined:
+            groups[node] = joined
+
+    def owner(node):
+        strong = strong_labels(groups[node])
+        assert len(strong) <= 1
+        return strong[0] if strong else None
+
+    return ({trace_id: owner(('trace', trace_id)) for trace_id in trace_labels},
+            {label: owner(('label', label)) for label in label_reads})
+
+
+def test_resolve_identities_keeps_strong_labels_apart():
+    # trace 1 is mostly 7 and once 9, trace 2 is 9 and a misread 19, trace 3 only ever reads 44
+    reads = [(1, '7')] * 5 + [(1, '9'), (2, '9'), (2, '9'), (2, '19'), (3, '44')]
+    trace_labels = trace_labels_from(reads)
+    label_reads = {'7': 5, '9': 3, '19': 1, '44': 1}
+
+    trace_owner, label_owner = pt.resolve_identities(trace_labels, label_reads, min_reads=2)
+
+    assert trace_owner == {1: '7', 2: '9', 3: None}
+    assert label_owner == {'7': '7', '9': '9', '19': '9', '44': None}
+
+
+def test_resolve_identities_matches_a_reference_grouping():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        labels = [str(label) for label in rng.choice(99, size=rng.integers(1, 12), replace=False)]
+        reads = [(int(rng.integers(0, 20)), labels[rng.integers(len(labels))])
+                 for _ in range(rng.integers(1, 80))]
+        trace_labels = trace_labels_from(reads)
+
+        label_reads = {label: 0 for label in labels}
+        for _, label in reads:
+            label_reads[label] += 1
+        # detections without a trace id add reads too
+        for label in labels:
+            label_reads[label] += int(rng.integers(0, 2))
+
+        min_reads = int(rng.integers(1, 6))
+        assert pt.resolve_identities(trace_labels, label_reads, min_reads) == \
+            reference_resolve_identities(trace_labels, label_reads, min_reads)
+
+
+def reference_near_ball(ball_distances, max_distance):
+    keep = []
+    last = np.nan
+    for distance in ball_distances:
+        if not np.isnan(distance):
+            last = distance
+        # kept until the ball is first seen, then by the last distance known
+        keep.append(bool(np.isnan(last) or last <= max_distance))
+    return keep
+
+
+def test_near_ball_carries_the_last_known_distance():
+    rng = np.random.default_rng(0)
+    for size in [0, 1, 2, 5, 50, 500] * 20:
+        distances = rng.uniform(0, 1, size)
+        distances[rng.random(size) < rng.uniform(0, 1)] = np.nan
+        max_distance = rng.uniform(0, 1)
+
+        assert pt.near_ball(distances, max_distance).tolist() == reference_near_ball(distances, max_distance)
+
+
+def test_ball_distances_measure_each_detection_against_its_frames_ball():
+    rng = np.random.default_rng(0)
+    width, height = 1280, 720
+    tracker = pt.PersonTracker(ball_distance=0.3)
+
+    ball_centers = {}
+    for frame in range(300):
+        # the ball is missed now and then
+        if rng.random() < 0.7:
+            x, y = rng.uniform(0, width), rng.uniform(0, height)
+            tracker.add_ball(frame / 30, [x - 10, y - 10, 20, 20], width, height)
+            ball_centers[frame / 30] = (x / width, y / height)
+
+    seconds = np.sort(rng.choice(300, size=200)) / 30
+    boxes = np.column_stack([rng.uniform(0, width, 200), rng.uniform(0, height, 200),
+                             rng.uniform(10, 60, 200), rng.uniform(30, 150, 200)])
+
+    expected = []
+    for t, (x, y, w, h) in zip(seconds, boxes):
+        if t not in ball_centers:
+            expected.append(np.nan)
+            continue
+        ball_x, ball_y = ball_centers[t]
+        expected.append(np.hypot((x + w / 2) / width - ball_x, (y + h / 2) / height - ball_y))
+
+    distances = tracker.ball_distances(seconds, boxes)
+    assert np.allclose(distances, expected, equal_nan=True)
+    assert np.array_equal(tracker.segment_times(seconds, boxes),
+                          seconds[reference_near_ball(distances, 0.3)])
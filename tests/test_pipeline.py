@@ -0,0 +1,105 @@
+import pytest
+
+pytest.importorskip('eyepop')
+
+import benchmark
+import main
+import person_tracker as pt
+import sampling
+
+
+class RecordingRenderer:
+    """ Collects the segments run_pipeline submits instead of rendering them. """
+
+    def __init__(self):
+        self.segments = {}
+        self.closed = False
+
+    def submit(self, output_video_path, segments, track):
+        self.segments.setdefault(output_video_path, []).extend(segments)
+
+    def finish(self):
+        return sorted(self.segments)
+
+    def close(self):
+        self.closed = True
+
+
+def batch_reels(results, min_label_reads, min_detections=pt.MIN_DETECTIONS):
+    person_tracker = pt.PersonTracker(smoothing='.95', min_label_reads=min_label_reads)
+    main.ingest_results(results, person_tracker)
+    person_tracker.filter_map(1280, 720)
+    return sorted('player_' + label + '.mp4'
+                  for label, _ in main.select_players(person_tracker, min_detections=min_detections))
+
+
+# (first frame, frames) each player of windowed_results is on the field for
+WINDOWS = [(0, 600), (100, 300), (200, 90), (300, 45), (400, 40), (500, 20), (550, 10)]
+
+
+def windowed_results():
+    """ 20 seconds of results where every detection's number is read, each player on the field for one of the WINDOWS. """
+    labels, boxes = benchmark.make_tracks(len(WINDOWS), 20, 30, 1280, 720)
+    for frame, result in enumerate(benchmark.make_results(labels, boxes, 30, 1280, 720, label_rate=1.0,
+                                                          label_noise=0, trace_switch=0)):
+        # the people come first, in player order, then the ball
+        result['objects'] = [obj for player, obj in enumerate(result['objects'])
+                             if player >= len(WINDOWS) or 0 <= frame - WINDOWS[player][0] < WINDOWS[player][1]]
+        yield result
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_pipeline_resolves_identities_like_the_batch_path(seed):
+    labels, boxes = benchmark.make_tracks(10, 60, 30, 1280, 720, seed=seed)
+    results = list(benchmark.make_results(labels, boxes, 30, 1280, 720,
+                                          label_noise=0.05, seed=seed + 2))
+
+    renderer = RecordingRenderer()
+    output_files = main.run_pipeline('video.mp4', iter(results), pt.PersonTracker(smoothing='.95'),
+                                     renderer=renderer)
+
+    assert output_files == batch_reels(results, pt.MIN_LABEL_READS)
+    assert {'player_' + label + '.mp4' for label in labels} <= set(output_files)
+
+
+def test_pipeline_keeps_every_number_without_min_label_reads():
+    labels, boxes = benchmark.make_tracks(10, 60, 30, 1280, 720)
+    results = list(benchmark.make_results(labels, boxes, 30, 1280, 720, label_noise=0.05))
+
+    output_files = main.run_pipeline('video.mp4', iter(results), pt.PersonTracker(smoothing='.95', min_label_reads=0),
+                                     renderer=RecordingRenderer())
+
+    assert output_files == batch_reels(results, 0)
+    assert len(output_files) > len(labels)
+
+
+def test_pipeline_closes_the_renderer_when_results_fail():
+    labels, boxes = benchmark.make_tracks(3, 20, 30, 1280, 720)
+
+    def failing_results():
+        yield from benchmark.make_results(labels, boxes, 30, 1280, 720)
+        raise ConnectionError('inference dropped')
+
+    renderer = RecordingRenderer()
+    with pytest.raises(ConnectionError):
+        main.run_pipeline('video.mp4', failing_results(), pt.PersonTracker(), renderer=renderer)
+    assert renderer.closed
+
+
+@pytest.mark.parametrize('every', [2, 5])
+def test_sampled_runs_keep_the_players_of_the_full_run(every):
+    results = list(windowed_results())
+    full_reels = batch_reels(results, pt.MIN_LABEL_READS)
+    assert len(full_reels) == sum(frames >= pt.MIN_DETECTIONS for _, frames in WINDOWS)
+
+    # what inference of every Nth frame returns, on the video's timeline
+    sampled = results[::every]
+    min_label_reads = sampling.scale_count(pt.MIN_LABEL_READS, every)
+    min_detections = sampling.scale_count(pt.MIN_DETECTIONS, every)
+
+    # thresholds counted at the full frame rate drop the players on the field for a short while
+    assert batch_reels(sampled, pt.MIN_LABEL_READS) != full_reels
+
+    assert batch_reels(sampled, min_label_reads, min_detections) == full_reels
+    assert main.run_pipeline('video.mp4', iter(sampled), pt.PersonTracker(smoothing='.95', min_label_reads=min_label_reads),
+                             min_detections=min_detections, renderer=RecordingRenderer()) == full_reels
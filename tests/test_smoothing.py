@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import smoothing as sm
+
+
+def reference_ema(boxes, alpha):
+    smoothed = [boxes[0]]
+    for box in boxes[1:]:
+        smoothed.append(alpha * box + (1 - alpha) * smoothed[-1])
+    return np.array(smoothed)
+
+
+def reference_one_euro(times, boxes, min_cutoff, beta, derivative_cutoff):
+    """ The one-euro filter one detection at a time, the speed of the fastest column driving the cutoff. """
+
+    def alpha(cutoff, dt):
+        tau = 1.0 / (2.0 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    smoothed = [boxes[0]]
+    # the first row has no previous box, its speed is 0
+    speed = np.zeros(boxes.shape[1])
+    for n in range(1, len(boxes)):
+        dt = max(times[n] - times[n - 1], 1e-6)
+        a = alpha(derivative_cutoff, dt)
+        speed = a * (boxes[n] - boxes[n - 1]) / dt + (1 - a) * speed
+
+        a = alpha(min_cutoff + beta * np.abs(speed).max(), dt)
+        smoothed.append(a * boxes[n] + (1 - a) * smoothed[-1])
+    return np.array(smoothed)
+
+
+def reference_savgol(boxes, window, polyorder):
+    """ A polynomial fit around every row, the first and last windows' fits for the rows near the ends. """
+    half = window // 2
+    rows = np.arange(len(boxes))
+    smoothed = np.empty_like(boxes)
+    for n in range(len(boxes)):
+        start = min(max(n - half, 0), len(boxes) - window)
+        for column in range(boxes.shape[1]):
+            fit = np.polyfit(rows[start:start + window], boxes[start:start + window, column], polyorder)
+            smoothed[n, column] = np.polyval(fit, n)
+    return smoothed
+
+
+def random_walk(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(0, 5, size=(rows, 4)), axis=0) + [300, 200, 40, 100]
+
+
+@pytest.mark.parametrize('rows', [1, 2, 17, 500])
+@pytest.mark.parametrize('alpha', [0.05, 0.5, 0.95, 9])
+def test_ema_matches_the_recurrence(rows, alpha):
+    boxes = random_walk(rows)
+    expected = reference_ema(boxes, alpha if alpha <= 1 else 2 / (alpha + 1))
+    assert np.allclose(sm.ema(boxes, alpha), expected)
+
+
+@pytest.mark.parametrize('rows', [1, 15, 16, 17, 255, 256, 257, 5000])
+def test_varying_ema_matches_the_recurrence(rows):
+    rng = np.random.default_rng(rows)
+    values = random_walk(rows, seed=rows)
+    # factors from barely moving to 1, where the decay underflows over a block
+    alphas = rng.choice([1e-4, 0.01, 0.3, 0.9, 1.0], size=rows)
+
+    expected = [values[0]]
+    for value, alpha in zip(values[1:], alphas[1:]):
+        expected.append(alpha * value + (1 - alpha) * expected[-1])
+
+    assert np.allclose(sm._varying_ema(values, alphas), expected)
+
+
+@pytest.mark.parametrize('rows', [2, 3, 40, 600])
+@pytest.mark.parametrize('min_cutoff, beta', [(1.0, 0.01), (0.05, 0.5), (5.0, 0.0)])
+def test_one_euro_matches_the_recurrence(rows, min_cutoff, beta):
+    rng = np.random.default_rng(rows)
+    boxes = random_walk(rows, seed=rows)
+    # uneven frame times, with a repeated time and a gap
+    times = np.cumsum(rng.choice([0.0, 1 / 30, 1 / 15, 1.0], size=rows, p=[0.05, 0.8, 0.1, 0.05]))
+
+    expected = reference_one_euro(times, boxes, min_cutoff, beta, 1.0)
+    assert np.allclose(sm.one_euro(times, boxes, min_cutoff=min_cutoff, beta=beta), expected)
+
+
+@pytest.mark.parametrize('rows, window', [(40, 15), (40, 8), (10, 15), (3, 15)])
+def test_savgol_matches_a_polynomial_fit_per_row(rows, window):
+    boxes = random_walk(rows)
+    # the window is cut down to the rows and made odd
+    fitted = min(window, rows)
+    if fitted % 2 == 0:
+        fitted -= 1
+    expected = reference_savgol(boxes, fitted, 2) if fitted > 2 else boxes
+    assert np.allclose(sm.savgol(boxes, window=window), expected)
+
+
+@pytest.mark.parametrize('method, strength', [('ema', 0.5), ('savgol', 9), ('one_euro', 1.0)])
+def test_smooth_boxes_filters_each_segment_on_its_own(method, strength):
+    boxes = random_walk(90)
+    times = np.arange(90) / 30
+    breaks = [30, 31, 60]
+
+    edges = [0, *breaks, 90]
+    expected = np.concatenate([sm.smooth_boxes(times[start:end], boxes[start:end], method, strength)
+                               for start, end in zip(edges[:-1], edges[1:])])
+    assert np.allclose(sm.smooth_boxes(times, boxes, method, strength, breaks=breaks), expected)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+import video_tools as vt
+import video_writer as vw
+
+WIDTH, HEIGHT, FPS = 160, 90, 30
+
+
+@pytest.fixture(scope='module')
+def video_path(tmp_path_factory):
+    """ A video whose frame k is filled with the gray level k, so a frame shows its own index. """
+    path = str(tmp_path_factory.mktemp('video') / 'levels.mp4')
+    with vw.open_writer('opencv', path, FPS, fourcc='MJPG') as writer:
+        for k in range(40):
+            writer.write(np.full((HEIGHT, WIDTH, 3), k * 6, dtype=np.uint8))
+    return path
+
+
+@pytest.mark.parametrize('frame_rate', [30, 29.97, 25, 60000 / 1001])
+def test_time_to_frame_maps_frame_times_back_to_their_frames(frame_rate):
+    frames = np.arange(100000)
+    times = frames / frame_rate
+
+    assert np.array_equal(vt.time_to_frame(times, frame_rate), frames)
+    assert [vt.time_to_frame(t, frame_rate) for t in times[:3000].tolist()] == frames[:3000].tolist()
+    assert isinstance(vt.time_to_frame(1.0, frame_rate), int)
+
+
+def test_rendering_and_color_sampling_read_the_same_frame(video_path):
+    tools = vt.VideoTools(video_path)
+    reader = vt.FrameReader(video_path)
+
+    frame_times = reader.segment_frames([(0.0, 1.2)])
+    queries = [(t, 0, 0, WIDTH, HEIGHT) for t, _ in frame_times]
+    colors = tools.get_average_colors(queries)
+
+    for (t, frame_index), color in zip(frame_times, colors):
+        level = reader.read(frame_index).mean()
+        assert abs(tools.get_image_at_time(t).mean() - level) < 1
+        assert abs(color.mean() - level) < 1
+
+    reader.release()
+    tools.release()
+
+
+def reference_means(frame, rects):
+    """ numpy's mean of each region cut to the frame, NaN for the empty ones. """
+    height, width = frame.shape[:2]
+    pixels = frame.reshape(height, width, -1).astype(np.float64)
+    means = []
+    for x, y, w, h in rects:
+        x1, x2 = int(np.clip(x, 0, width)), int(np.clip(x + w, 0, width))
+        y1, y2 = int(np.clip(y, 0, height)), int(np.clip(y + h, 0, height))
+        region = pixels[y1:y2, x1:x2]
+        means.append(region.mean(axis=(0, 1)) if region.size else np.full(pixels.shape[2], np.nan))
+    return np.array(means)
+
+
+@pytest.mark.parametrize('min_coverage', [0.0, np.inf], ids=['integral', 'direct'])
+@pytest.mark.parametrize('channels', [3, 1])
+def test_region_means_matches_the_mean_of_each_region(monkeypatch, min_coverage, channels):
+    monkeypatch.setattr(vt, 'INTEGRAL_MIN_COVERAGE', min_coverage)
+    rng = np.random.default_rng(channels)
+    frame = rng.integers(0, 256, size=(HEIGHT, WIDTH, channels), dtype=np.uint8).squeeze()
+
+    rects = np.column_stack([rng.uniform(-40, WIDTH + 10, 200), rng.uniform(-40, HEIGHT + 10, 200),
+                             rng.uniform(0, 80, 200), rng.uniform(0, 60, 200)])
+    # whole frame, one pixel, zero width, entirely outside on each side
+    rects[:6] = [[0, 0, WIDTH, HEIGHT], [5, 7, 1, 1], [10, 10, 0, 20],
+                 [-30, 10, 20, 20], [WIDTH, 0, 10, 10], [10, HEIGHT + 1, 5, 5]]
+
+    means = vt.region_means(frame, rects)
+    expected = reference_means(frame, rects)
+
+    assert means.shape == (len(rects), channels)
+    assert np.array_equal(np.isnan(means), np.isnan(expected))
+    assert np.isnan(means[3:6]).all()
+    assert np.allclose(means[~np.isnan(expected)], expected[~np.isnan(expected)])
+
+
+def test_average_colors_match_each_querys_own_frame(video_path):
+    tools = vt.VideoTools(video_path)
+    reader = vt.FrameReader(video_path)
+    rng = np.random.default_rng(0)
+
+    # out of time order, several queries per frame and one past the end of the video
+    times = np.append(rng.integers(0, 40, 60) / FPS, 10.0)
+    queries = np.column_stack([times, rng.uniform(-20, WIDTH, 61), rng.uniform(-20, HEIGHT, 61),
+                               rng.uniform(1, 80, 61), rng.uniform(1, 60, 61)])
+
+    colors = tools.get_average_colors(queries)
+
+    for query, color in zip(queries[:-1], colors[:-1]):
+        frame = reader.read(vt.time_to_frame(query[0], FPS))
+        assert np.allclose(color, reference_means(frame, [query[1:]])[0], equal_nan=True)
+    assert np.isnan(colors[-1]).all()
+
+    reader.release()
+    tools.release()
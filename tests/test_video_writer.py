@@ -0,0 +1,154 @@
+import os
+import shutil
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import video_writer as vw
+
+
+class StalledPipe:
+    """ An ffmpeg stdin that accepts nothing until released, or breaks once the process is killed. """
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.killed = False
+        self.frames = 0
+
+    def write(self, data):
+        self.released.wait(timeout=10)
+        if self.killed:
+            raise BrokenPipeError("ffmpeg was killed")
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+class StalledProcess:
+
+    def __init__(self):
+        self.stdin = StalledPipe()
+
+    def kill(self):
+        self.stdin.killed = True
+        self.stdin.released.set()
+
+    def wait(self):
+        return -9 if self.stdin.killed else 0
+
+
+@pytest.fixture
+def stalled_ffmpeg(monkeypatch):
+    process = StalledProcess()
+    monkeypatch.setattr(vw.subprocess, 'Popen', lambda cmd, stdin: process)
+    return process
+
+
+def frame(value=0):
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_pipe_writer_blocks_while_ffmpeg_falls_behind(stalled_ffmpeg, tmp_path):
+    writer = vw.FFmpegPipeWriter(str(tmp_path / 'out.mp4'), 30, queue_size=2)
+    written = []
+
+    def produce():
+        for i in range(10):
+            writer.write(frame(i))
+            written.append(i)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    # one frame held by the pump thread, two in the queue, and the next write blocked
+    wait_for(lambda: len(written) == 3)
+    time.sleep(0.2)
+    assert producer.is_alive()
+    assert len(written) == 3
+    assert stalled_ffmpeg.stdin.frames == 0
+
+    stalled_ffmpeg.stdin.released.set()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+
+    writer.close()
+    assert writer.frames_written == 10
+    assert stalled_ffmpeg.stdin.frames == 10
+
+
+def test_pipe_writer_abort_unblocks_a_stalled_ffmpeg(stalled_ffmpeg, tmp_path):
+    output_path = tmp_path / 'out.mp4'
+    writer = vw.FFmpegPipeWriter(str(output_path), 30, queue_size=2)
+    for i in range(3):
+        writer.write(frame(i))
+    wait_for(lambda: writer.queue.full())
+    output_path.write_bytes(b'partial')
+
+    pump = writer.thread
+    writer.abort()
+
+    assert not pump.is_alive()
+    assert writer.process is None
+    assert not output_path.exists()
+    assert stalled_ffmpeg.stdin.killed
+
+
+def test_pipe_writer_aborts_on_an_exception(stalled_ffmpeg, tmp_path):
+    output_path = tmp_path / 'out.mp4'
+    stalled_ffmpeg.stdin.released.set()
+
+    with pytest.raises(RuntimeError):
+        with vw.open_writer('pipe', str(output_path), 30) as writer:
+            writer.write(frame())
+            output_path.write_bytes(b'partial')
+            raise RuntimeError("render failed")
+
+    assert not output_path.exists()
+    assert writer.process is None
+
+
+def test_pipe_writer_rejects_a_frame_of_another_size(stalled_ffmpeg, tmp_path):
+    stalled_ffmpeg.stdin.released.set()
+    writer = vw.FFmpegPipeWriter(str(tmp_path / 'out.mp4'), 30)
+    writer.write(frame())
+    with pytest.raises(vw.VideoWriterError):
+        writer.write(np.zeros((40, 64, 3), dtype=np.uint8))
+    writer.abort()
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs an ffmpeg binary")
+def test_pipe_writer_writes_every_frame(tmp_path):
+    output_path = str(tmp_path / 'out.mp4')
+    with vw.open_writer('pipe', output_path, 30, queue_size=2) as writer:
+        for i in range(25):
+            writer.write(frame(i * 10))
+
+    capture = cv2.VideoCapture(output_path)
+    frames = 0
+    while capture.read()[0]:
+        frames += 1
+    capture.release()
+    assert frames == 25
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs an ffmpeg binary")
+def test_pipe_writer_abort_removes_the_output(tmp_path):
+    output_path = str(tmp_path / 'out.mp4')
+    writer = vw.open_writer('pipe', output_path, 30)
+    for i in range(25):
+        writer.write(frame(i))
+    writer.abort()
+
+    assert writer.process is None
+    assert not os.path.exists(output_path)
@@ -1,3 +1,5 @@
+import numpy as np
+
 # 2D geometry functions
 # currently does rectangle operations, hash tag get_rect
 
@@ -47,3 +49,35 @@ def to_slice(rect):
 
 def to_corners(rect):
 	return (rect['left'], rect['top']), (rect['right'], rect['bottom'])
+
+# Array versions of the rect operations, for computing every frame of a reel at once.
+#  A rect is an integer [x, y, w, h] row and N rects an N x 4 array, each function giving
+#  the same numbers row by row as its dict version above
+
+def get_rects(x=None, y=None, center_x=None, center_y=None, w=1, h=1):
+	# astype truncates toward zero, as int() does
+	w = np.asarray(w).astype(np.int64)
+	h = np.asarray(h).astype(np.int64)
+	if x is not None and y is not None:
+		x = np.asarray(x).astype(np.int64)
+		y = np.asarray(y).astype(np.int64)
+	elif center_x is not None and center_y is not None:
+		x = np.asarray(center_x).astype(np.int64) - w // 2
+		y = np.asarray(center_y).astype(np.int64) - h // 2
+	return np.stack(np.broadcast_arrays(x, y, w, h), axis=-1)
+
+def get_rects_clamped_inside_another_rect(center_x, center_y, w, h, outer_rects):
+	w = np.asarray(w)
+	h = np.asarray(h)
+	left, top, outer_w, outer_h = np.moveaxis(np.asarray(outer_rects), -1, 0)
+	center_x = np.minimum(np.maximum(center_x, left + w // 2), left + outer_w - w // 2) #  keep inside the left and right edges
+	center_y = np.minimum(np.maximum(center_y, top + h // 2), top + outer_h - h // 2) #  keep inside the top and bottom edges
+	return get_rects(center_x=center_x, center_y=center_y, w=w, h=h)
+
+def row_to_slice(rect):
+	x, y, w, h = rect
+	return slice(y, y + h), slice(x, x + w)
+
+def row_to_corners(rect):
+	x, y, w, h = rect
+	return (x, y), (x + w, y + h)
@@ -1,35 +1,231 @@
 import cv2
+import numpy as np
+
+import profiling
+
+
+def time_to_frame(seconds, frame_rate):
+    """
+    The index of the frame shown at `seconds`, or an array of them for an array of times.
+    Every time to frame conversion goes through here, so the renderer and the color sampling
+    read the same frame for a time. It rounds rather than truncates: k / frame_rate * frame_rate
+    comes out just under k often enough that truncating lands on the frame before.
+    """
+    if np.ndim(seconds) == 0:
+        return int(round(seconds * frame_rate))
+    return np.rint(np.asarray(seconds, dtype=np.float64) * frame_rate).astype(np.int64)
+
+
+def segment_frame_times(segments, frame_rate):
+    """ Yields (segment_index, t, frame_index) for every output frame of the (start, end) segments. """
+    for i, (start, end) in enumerate(segments):
+        for t in np.arange(start, end, 1.0 / frame_rate):
+            yield i, t, time_to_frame(t, frame_rate)
+
+
+def merge_frame_times(frame_times):
+    """
+    Merges the output frames of several targets into one timeline.
+
+    `frame_times` maps a target key to its list of (t, frame_index) output frames. Returns
+    a list of (frame_index, [(key, k, t), ...]) sorted by frame index, where the list holds
+    every target output frame that shows that source frame, `k` being its position in the
+    target's list, in each target's own order.
+    """
+    frame_users = {}
+    for key, times in frame_times.items():
+        for k, (t, frame_index) in enumerate(times):
+            frame_users.setdefault(frame_index, []).append((key, k, t))
+
+    return sorted(frame_users.items())
+
+
+# regions adding up to this many times a frame's area are summed from an integral image, smaller ones averaged directly
+INTEGRAL_MIN_COVERAGE = 3.0
+
+
+def clip_rects(rects, width, height):
+    """ [x, y, w, h] rows as integer [x1, y1, x2, y2] rows clipped to a width x height frame. """
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+    x1 = np.clip(rects[:, 0], 0, width)
+    y1 = np.clip(rects[:, 1], 0, height)
+    x2 = np.clip(rects[:, 0] + rects[:, 2], 0, width)
+    y2 = np.clip(rects[:, 1] + rects[:, 3], 0, height)
+    return np.stack([x1, y1, x2, y2], axis=1).astype(np.int64)
+
+
+def region_means(frame, rects):
+    """
+    The mean color of every [x, y, w, h] region of the frame, an N x channels array with
+    NaN rows for regions entirely outside it. Once the regions add up to more pixels than
+    building an integral image costs, they are summed from one, four lookups each, instead
+    of averaging every region's pixels.
+    """
+    height, width = frame.shape[:2]
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    x1, y1, x2, y2 = clip_rects(rects, width, height).T
+
+    area = (x2 - x1) * (y2 - y1)
+    means = np.full((len(area), channels), np.nan)
+    valid = area > 0
+
+    if area.sum() < INTEGRAL_MIN_COVERAGE * width * height:
+        for i in np.flatnonzero(valid):
+            means[i] = cv2.mean(frame[y1[i]:y2[i], x1[i]:x2[i]])[:channels]
+        return means
+
+    # float64 sums stay exact where int32 ones would overflow on large frames
+    integral = cv2.integral(frame, sdepth=cv2.CV_64F).reshape(height + 1, width + 1, channels)
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    means[valid] = sums[valid] / area[valid, None]
+    return means
+
+
+class FrameReader:
+    """
+    Reads frames from a video by frame index, decoding sequentially whenever it can.
+
+    A seek costs a decode from the nearest keyframe, so the reader only seeks when the
+    requested frame is behind the current position or more than `max_skip` frames ahead.
+    Frames in between are skipped with grab(), which demuxes without a full decode.
+    """
+
+    def __init__(self, video_path, max_skip=None):
+        self.video_path = video_path
+        self.cap = cv2.VideoCapture(video_path)
+        self.frame_rate = self.cap.get(cv2.CAP_PROP_FPS)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        # grabbing forward is cheaper than seeking for short gaps, default to ~2 seconds of frames
+        self.max_skip = max_skip if max_skip is not None else max(
+            1, int(self.frame_rate * 2))
+
+        # index of the frame the next cap.read() returns
+        self.position = 0
+
+        self.seeks = 0
+        self.grabs = 0
+        self.decodes = 0
+
+    def read(self, frame_index, out=None):
+        """
+        Returns the frame at `frame_index`, or None if it can't be read. With `out`, a frame
+        sized array, the frame is decoded into it instead of a newly allocated array.
+        """
+        if frame_index < self.position or frame_index - self.position > self.max_skip:
+            with profiling.stage('seek'):
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            self.position = frame_index
+            self.seeks += 1
+
+        with profiling.stage('decode'):
+            while self.position < frame_index:
+                if not self.cap.grab():
+                    return None
+                self.position += 1
+                self.grabs += 1
+
+            success, frame = self.cap.read(out)
+        if not success:
+            return None
+
+        self.position += 1
+        self.decodes += 1
+        return frame
+
+    def segment_frames(self, segments):
+        """ Returns the (t, frame_index) of every output frame of the (start, end) segments. """
+        return [(t, frame_index) for _, t, frame_index in segment_frame_times(segments, self.frame_rate)]
+
+    def shared_frames(self, frame_times):
+        """
+        Yields (frame, [(key, k, t), ...]) for every source frame any of the targets in
+        `frame_times` needs, decoding each source frame once no matter how many targets
+        or overlapping segments use it. Frames that fail to read are skipped.
+        """
+        for frame_index, users in merge_frame_times(frame_times):
+            frame = self.read(frame_index)
+
+            if frame is None:
+                print("Error reading frame: " + str(frame_index))
+                continue
+
+            yield frame, users
+
+    def release(self):
+        self.cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
 
 class VideoTools:
 
     def __init__(self, video_path):
         self.video_path = video_path
-        self.video_capture = cv2.VideoCapture(video_path)
+        self.reader = FrameReader(video_path)
 
     def get_image_at_time(self, time_in_seconds):
-        self.video_capture.set(cv2.CAP_PROP_POS_MSEC, time_in_seconds * 1000)
-        success, frame = self.video_capture.read()
-        if success:
-            return frame
-        else:
-            return None
+        return self.reader.read(time_to_frame(time_in_seconds, self.reader.frame_rate))
 
     def get_average_color(self, x, y, width, height, time_in_seconds):
-        frame = self.get_image_at_time(time_in_seconds)
-        if frame is not None:
-            # Crop the frame
-            roi = frame[y:y+height, x:x+width]
-            # Calculate the average color
-            average_color = cv2.mean(roi)[:3]
-            return average_color
-        else:
+        colors = self.get_average_colors([(time_in_seconds, x, y, width, height)])
+        if np.isnan(colors[0]).any():
             return None
+        return tuple(colors[0].tolist())
+
+    def get_average_colors(self, queries):
+        """
+        The mean BGR color of many regions at once, `queries` being (time, x, y, w, h) rows.
+        Returns an N x 3 array in query order, NaN rows where the frame couldn't be read or
+        the region is outside it.
+
+        The queries are grouped by frame and the frames decoded in time order, each only
+        once, so the reader mostly decodes forward instead of seeking for every query.
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 5)
+        colors = np.full((len(queries), 3), np.nan)
+
+        frame_indices = time_to_frame(queries[:, 0], self.reader.frame_rate)
+        order = np.argsort(frame_indices, kind='stable')
+        sorted_indices = frame_indices[order]
+        starts = np.flatnonzero(np.diff(sorted_indices, prepend=-1))
+        ends = np.append(starts[1:], len(order))
+
+        for start, end in zip(starts, ends):
+            frame = self.reader.read(int(sorted_indices[start]))
+            if frame is None:
+                continue
+
+            rows = order[start:end]
+            with profiling.stage('colors', count=len(rows)):
+                colors[rows] = region_means(frame, queries[rows, 1:])[:, :3]
+
+        return colors
+
+    @staticmethod
+    def color_distances(colors1, colors2):
+        """ Euclidean distance from every color of `colors1` (N x 3) to every color of `colors2` (M x 3), an N x M array. """
+        colors1 = np.atleast_2d(np.asarray(colors1, dtype=np.float64))
+        colors2 = np.atleast_2d(np.asarray(colors2, dtype=np.float64))
+        differences = colors1[:, None, :] - colors2[None, :, :]
+        return np.sqrt(np.einsum('nmc,nmc->nm', differences, differences))
 
     @staticmethod
     def are_colors_close(color1, color2, threshold):
-        distance = sum((c1 - c2) ** 2 for c1, c2 in zip(color1, color2)) ** 0.5
-        return distance <= threshold
+        """
+        Whether two colors are within `threshold` of each other. Given N x 3 and M x 3 arrays
+        of colors instead, an N x M array of whether each pair is.
+        """
+        close = VideoTools.color_distances(color1, color2) <= threshold
+        if np.ndim(color1) == 1 and np.ndim(color2) == 1:
+            return bool(close[0, 0])
+        return close
 
     def release(self):
-        self.video_capture.release()
+        self.reader.release()
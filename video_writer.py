@@ -0,0 +1,294 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import cv2
+
+import profiling
+
+#
+# video_writer.py
+#
+# Frame sinks for the renderer. Each writer takes BGR frames through write(), and
+#  either finishes the video with close() or throws away partial output with abort().
+#  Used as a context manager, an exception inside the block aborts the writer.
+#
+
+
+class VideoWriterError(Exception):
+    pass
+
+
+class FFmpegPipeWriter:
+    """
+    Streams raw BGR frames over stdin into one long-lived ffmpeg process, so no frame
+    is ever written to disk as an image.
+
+    Frames are handed to a writer thread through a bounded queue. When ffmpeg falls
+    behind the pipe fills up, the queue fills up, and write() blocks, which keeps
+    memory capped no matter how fast frames are produced.
+    """
+
+    def __init__(self, output_path, fps, queue_size=8, codec="libx264"):
+        self.output_path = output_path
+        self.fps = fps
+        self.codec = codec
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.process = None
+        self.thread = None
+        self.frame_size = None
+        self.error = None
+        self.frames_written = 0
+
+    def _start(self, frame):
+        height, width = frame.shape[:2]
+        self.frame_size = (width, height)
+
+        ffmpeg_cmd = [
+            "ffmpeg",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(self.fps),
+            "-i", "-",
+            "-c:v", self.codec,
+            "-pix_fmt", "yuv420p",
+            self.output_path,
+            '-y'
+        ]
+
+        self.process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._pump, daemon=True)
+        self.thread.start()
+
+    def _pump(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+
+            if self.error is not None:
+                continue
+
+            try:
+                self.process.stdin.write(frame.tobytes())
+                self.frames_written += 1
+            except (BrokenPipeError, OSError) as e:
+                self.error = e
+
+    def write(self, frame):
+        if self.process is None:
+            self._start(frame)
+
+        if self.error is not None:
+            raise VideoWriterError(
+                f"ffmpeg stopped accepting frames for {self.output_path}") from self.error
+
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            raise VideoWriterError(
+                f"frame size {frame.shape[1]}x{frame.shape[0]} does not match the stream size {self.frame_size[0]}x{self.frame_size[1]}")
+
+        # blocks while the queue is full, this is the backpressure on the renderer
+        self.queue.put(frame)
+
+    def close(self):
+        if self.process is None:
+            return
+
+        # whatever ffmpeg still has to encode once the last frame is handed over
+        with profiling.stage('ffmpeg', count=0):
+            self.queue.put(None)
+            self.thread.join()
+
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+            return_code = self.process.wait()
+        self.process = None
+
+        if self.error is not None or return_code != 0:
+            raise VideoWriterError(
+                f"ffmpeg failed writing {self.output_path} (exit code {return_code})")
+
+    def abort(self):
+        if self.process is not None:
+            self.error = self.error or VideoWriterError("aborted")
+
+            # unblock the pump thread, then stop ffmpeg without waiting for it to finish the file
+            self.process.kill()
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=0.1)
+                except queue.Full:
+                    pass
+                self.thread.join(timeout=0.1)
+
+            self.process.wait()
+            self.process = None
+
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ImageFolderWriter:
+    """
+    The original path: writes every frame as a numbered JPEG, then runs ffmpeg over the
+    folder and deletes it. Slower, but works with any ffmpeg build and leaves the
+    frames on disk if ffmpeg fails.
+    """
+
+    def __init__(self, output_path, fps, image_folder=None):
+        # absolute paths, combine_images_to_video otherwise resolves them against this file
+        self.output_path = os.path.abspath(output_path)
+        self.fps = fps
+        self.image_folder = os.path.abspath(
+            image_folder or output_path + '_temp')
+        self.frame_size = None
+        self.frames_written = 0
+
+        # Create output folder if it doesn't exist
+        os.makedirs(self.image_folder, exist_ok=True)
+
+    def write(self, frame):
+        self.frame_size = (frame.shape[1], frame.shape[0])
+        self.frames_written += 1
+        cv2.imwrite(os.path.join(self.image_folder, str(
+            self.frames_written).zfill(4) + ".jpg"), frame)
+
+    def close(self):
+        combine_images_to_video(self.image_folder, self.output_path,
+                                resolution=self.frame_size, fps=self.fps)
+
+    def abort(self):
+        shutil.rmtree(self.image_folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class OpenCVWriter:
+    """
+    Local stand-in for the ffmpeg writers using cv2.VideoWriter, no ffmpeg binary required.
+    """
+
+    def __init__(self, output_path, fps, fourcc="mp4v"):
+        self.output_path = output_path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.writer = None
+        self.frame_size = None
+        self.frames_written = 0
+
+    def write(self, frame):
+        if self.writer is None:
+            self.frame_size = (frame.shape[1], frame.shape[0])
+            self.writer = cv2.VideoWriter(self.output_path, cv2.VideoWriter_fourcc(
+                *self.fourcc), self.fps, self.frame_size)
+
+        self.writer.write(frame)
+        self.frames_written += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+WRITERS = {
+    'pipe': FFmpegPipeWriter,
+    'jpeg': ImageFolderWriter,
+    'opencv': OpenCVWriter,
+}
+
+
+def open_writer(encoder, output_path, fps, **kwargs):
+    """ Creates the writer named by `encoder`, one of 'pipe', 'jpeg' or 'opencv'. """
+    if encoder not in WRITERS:
+        raise ValueError(
+            f"Unknown encoder '{encoder}', expected one of {', '.join(WRITERS)}")
+
+    return WRITERS[encoder](output_path, fps, **kwargs)
+
+
+def combine_images_to_video(image_folder, output_path, resolution, fps):
+    current_path = os.path.dirname(os.path.abspath(__file__))
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-r", str(int(fps)),
+        "-i", os.path.join(current_path, image_folder, "%04d.jpg"),
+        "-c:v", "libx264",
+        "-vf", f"fps={int(fps)}",
+        "-pix_fmt", "yuv420p",
+        os.path.join(current_path, output_path),
+        '-y'
+    ]
+
+    print('\n\n\n\n\n\n\n\n', ' '.join(ffmpeg_cmd), '\n\n\n\n\n\n\n\n')
+
+    with profiling.stage('ffmpeg'):
+        subprocess.run(ffmpeg_cmd, check=True)
+
+    # Delete the image folder
+    shutil.rmtree(os.path.join(current_path, image_folder), ignore_errors=True)
+
+
+def concat_videos(video_paths, output_path):
+    """ Joins videos with identical stream parameters end to end without re-encoding. """
+    list_path = output_path + '.concat.txt'
+
+    with open(list_path, "w") as list_file:
+        for video_path in video_paths:
+            # the concat demuxer resolves relative paths against the list file, so write absolute ones
+            path = os.path.abspath(video_path).replace('\\', '/')
+            list_file.write(f"file '{path}'\n")
+
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", list_path,
+        "-c", "copy",
+        output_path,
+        '-y'
+    ]
+
+    try:
+        with profiling.stage('ffmpeg'):
+            subprocess.run(ffmpeg_cmd, check=True)
+    finally:
+        os.remove(list_path)